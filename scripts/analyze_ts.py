@@ -1,66 +1,319 @@
+"""Quality checks for camera timestamp files, for a single file or whole sessions at once.
+
+Every timestamp file is memory-mapped and read in chunks, so memory use doesn't grow with
+the length of the recording, and files are checked in parallel. For each file the summary has:
+    - the mean, standard deviation and range of the inter-frame time error: the time between
+      consecutive frames minus the nominal frame period
+    - gaps: intervals longer than gap_factor frame periods, and how many frames they are missing
+    - FrameID discontinuities: skipped IDs (frames the host never received) and repeated or
+      backwards IDs
+    - drift: the slope of the camera clock against the nominal frame clock, in ppm, fitted by
+      least squares, and how far the last frame ended up from its nominal time
+
+Timestamp files are (n, 2) arrays of (FrameID, TimeStamp in ns), as written by timestamp_file;
+older 1D files of timestamps only are read too.
+
+Example: python -m scripts.analyze_ts D:acquired_data/session_1 D:acquired_data/session_2 --output qc.json --plots qc_plots
+"""
 import argparse
+import glob
+import json
+from multiprocessing import Pool
+import os
+from os import path
 
-import matplotlib.pyplot as plt
 import numpy as np
 
+from scripts import session_manifest
+from scripts.config import constants as config
 
-parser = argparse.ArgumentParser(description='Extracts information from .npy dumps of timestamps')
-parser.add_argument('filepath', type=str, help='Location of the numpy file containing the timestamps')
-parser.add_argument('framerate', type=int, default=30, help='Framerate of the video the data are collected from.')
 
-args = parser.parse_args()
+CHUNK_ROWS = 1 << 20
+GAP_FACTOR = 1.5
+# Gaps listed individually in the summary of each file, the rest are only counted
+MAX_LISTED_GAPS = 20
+# Points of the drift residual kept for plotting
+PLOT_POINTS = 5000
+# Resolution of the inter-frame error histogram the percentiles come from
+HISTOGRAM_BIN_MS = 0.01
 
-ts = np.load(args.filepath) * 1e-6  # Multiply by 10e-6 to convert from nanoseconds to milliseconds
-framerate = args.framerate
-expected = np.linspace(ts[0], ts[0] + 1000/framerate * (ts.shape[0] - 1), ts.shape[0])
-diffs = np.diff(ts)  # Returns the time difference between each consecutive timestamp
-mean = np.mean(diffs)
-std = np.std(diffs)
 
-print('Num timestamps collected: {} frames'.format(ts.shape[0]))
-print('For reference: 1/{} sec = {} ms'.format(framerate, 1000/framerate))
-print('Mean error between frames: {} ms'.format(1000/framerate - mean))
-print('Standard deviation: {} ms'.format(std))
+def is_timestamp_file(filepath):
+    """Whether a .npy file holds timestamps: int64, either (n, 2) or 1D. Rules out the other
+    arrays kept next to the videos, such as the _brightness.npy files and K.npy/D.npy
+    """
+    try:
+        array = np.load(filepath, mmap_mode='r')
+    except Exception:
+        return False
+    return array.dtype == np.int64 and (array.ndim == 1 or (array.ndim == 2 and array.shape[1] == 2))
 
 
-# Both plots use 1000/30 - diffs in order to display the error in the time differences.
-"""
-plt.subplot(1, 2, 1)
-plt.title('Inter-frame Time Error vs. Frame #')
-plt.scatter(np.arange(diffs.shape[0]), 1000/30 - diffs, s=1, color='b', label='Time between frames')
-plt.axhline(1000/30 - mean, color='k', linestyle='dashed', linewidth=1, label='Mean')
-plt.xlabel('Frame')
-plt.ylabel('Error in Inter-frame Time Relative to 1/30sec (ms)')
-plt.legend()
-"""
+def find_timestamp_files(target):
+    """Timestamp files of a session directory, from its manifests if it has them, or a single file.
+    Returns a list of (path, framerate or None)
+    """
+    if not path.isdir(target):
+        return [(target, None)]
+    manifest = session_manifest.SessionManifest(target)
+    files = list()
+    for stream in manifest.streams:
+        for entry in manifest.entries[stream]:
+            if 'timestamps' in entry:
+                files.append((manifest.filepath(entry, 'timestamps'), entry['rate']))
+    if not files:
+        files = [(filepath, None) for filepath in sorted(glob.glob(path.join(target, '*.npy'))) if is_timestamp_file(filepath)]
+    return files
+
+
+class TimestampStats:
+    """Accumulates the statistics of a timestamp file one chunk at a time"""
+    def __init__(self, framerate, gap_factor=GAP_FACTOR, keep_every=0):
+        self.period_ms = 1000 / framerate
+        self.gap_factor = gap_factor
+        self.keep_every = keep_every
+        self.num_frames = 0
+        self.first = None
+        self.last = None
+        self.first_id = None
+        self.last_id = None
+        self.last_offset = 0.0
+
+        self.num_intervals = 0
+        self.error_sum = 0.0
+        self.error_square_sum = 0.0
+        self.error_min = np.inf
+        self.error_max = -np.inf
+        # Errors beyond a frame period either way land in the end bins
+        num_bins = int(np.ceil(2 * self.period_ms / HISTOGRAM_BIN_MS))
+        self.error_histogram = np.zeros(num_bins, dtype=np.int64)
+        self.histogram_edges = -self.period_ms + np.arange(num_bins + 1) * HISTOGRAM_BIN_MS
+
+        self.gaps = list()
+        self.num_gaps = 0
+        self.frames_in_gaps = 0
+        self.skipped_ids = 0
+        self.id_jumps = 0
+        self.repeated_ids = 0
+
+        # Least squares of the time since the first frame against the frame's nominal time,
+        # both relative to the nominal time so the sums stay small
+        self.fit_sums = np.zeros(5)  # n, x, y, xx, xy
+        self.plot_x = list()
+        self.plot_y = list()
+
+    def add(self, chunk):
+        """chunk: (rows, 2) array of (FrameID, TimeStamp), or 1D timestamps, following the previous chunk"""
+        chunk = np.asarray(chunk, dtype=np.int64)
+        if chunk.ndim == 1:
+            frame_ids, timestamps = None, chunk
+        else:
+            frame_ids, timestamps = chunk[:, 0], chunk[:, 1]
+        if not len(timestamps):
+            return
+        if self.first is None:
+            self.first = timestamps[0]
+            self.first_id = frame_ids[0] if frame_ids is not None else None
+        # The first interval of a chunk is measured from the last frame of the previous one.
+        # Interval i ends at frame start + i
+        if self.last is None:
+            intervals_ms = np.diff(timestamps) * 1e-6
+            start = 1
+        else:
+            intervals_ms = np.diff(timestamps, prepend=self.last) * 1e-6
+            start = self.num_frames
+        errors = intervals_ms - self.period_ms
+
+        if len(errors):
+            self.num_intervals += len(errors)
+            self.error_sum += errors.sum()
+            self.error_square_sum += np.square(errors).sum()
+            self.error_min = min(self.error_min, errors.min())
+            self.error_max = max(self.error_max, errors.max())
+            bins = np.clip(((errors - self.histogram_edges[0]) / HISTOGRAM_BIN_MS).astype(np.int64), 0, len(self.error_histogram) - 1)
+            self.error_histogram += np.bincount(bins, minlength=len(self.error_histogram))
+
+            gap = np.flatnonzero(intervals_ms > self.gap_factor * self.period_ms)
+            missing = np.rint(intervals_ms[gap] / self.period_ms).astype(np.int64) - 1
+            self.num_gaps += len(gap)
+            self.frames_in_gaps += int(missing.sum())
+            for index, interval in zip(gap[:MAX_LISTED_GAPS - len(self.gaps)], intervals_ms[gap]):
+                self.gaps.append({'frame': int(start + index), 'interval_ms': float(interval)})
+
+        if frame_ids is not None:
+            id_steps = np.diff(frame_ids) if self.last_id is None else np.diff(frame_ids, prepend=self.last_id)
+            self.skipped_ids += int(np.maximum(id_steps - 1, 0).sum())
+            self.id_jumps += int(np.count_nonzero(id_steps > 1))
+            self.repeated_ids += int(np.count_nonzero(id_steps < 1))
+            self.last_id = frame_ids[-1]
+            # Frames the host never received still took up a frame period
+            nominal_frames = frame_ids - self.first_id
+        else:
+            nominal_frames = self.num_frames + np.arange(len(timestamps))
+        x = nominal_frames * self.period_ms * 1e-3
+        y = (timestamps - self.first) * 1e-9 - x
+        self.fit_sums += (len(x), x.sum(), y.sum(), np.square(x).sum(), (x * y).sum())
+        self.last_offset = y[-1]
+        if self.keep_every:
+            offset = (-self.num_frames) % self.keep_every
+            self.plot_x.append(x[offset::self.keep_every])
+            self.plot_y.append(y[offset::self.keep_every])
+
+        self.num_frames += len(timestamps)
+        self.last = timestamps[-1]
+
+    def drift(self):
+        """Slope and intercept of the camera clock error against nominal time"""
+        n, sx, sy, sxx, sxy = self.fit_sums
+        denominator = n * sxx - sx * sx
+        if n < 2 or denominator <= 0:
+            return 0.0, 0.0
+        slope = (n * sxy - sx * sy) / denominator
+        return slope, (sy - slope * sx) / n
+
+    def percentile(self, q):
+        cumulative = np.cumsum(self.error_histogram)
+        if not cumulative[-1]:
+            return 0.0
+        index = int(np.searchsorted(cumulative, q / 100 * cumulative[-1]))
+        return float(self.histogram_edges[index] + HISTOGRAM_BIN_MS / 2)
+
+    def summary(self):
+        n = max(1, self.num_intervals)
+        mean = self.error_sum / n
+        slope, _ = self.drift()
+        return {
+            'num_frames': int(self.num_frames),
+            'duration_s': float((self.last - self.first) * 1e-9) if self.num_frames else 0.0,
+            'nominal_period_ms': self.period_ms,
+            'interval_error_ms': {
+                'mean': float(mean),
+                'std': float(np.sqrt(max(0.0, self.error_square_sum / n - mean * mean))),
+                'min': float(self.error_min) if self.num_intervals else 0.0,
+                'max': float(self.error_max) if self.num_intervals else 0.0,
+                # To HISTOGRAM_BIN_MS, and clipped to a frame period
+                'p1': self.percentile(1),
+                'p99': self.percentile(99),
+            },
+            'gaps': {'count': self.num_gaps, 'missing_frames': self.frames_in_gaps, 'first': self.gaps},
+            'frame_ids': {'skipped': self.skipped_ids, 'jumps': self.id_jumps, 'repeated': self.repeated_ids},
+            'drift_ppm': float(slope * 1e6),
+            'final_offset_ms': float(self.last_offset * 1000),
+        }
+
+
+def analyze_file(filepath, framerate, plot_dir=None, gap_factor=GAP_FACTOR):
+    """Computes the summary of one timestamp file, and saves its plots to plot_dir if given"""
+    try:
+        timestamps = np.load(filepath, mmap_mode='r')
+    except Exception as e:
+        return {'path': filepath, 'error': str(e)}
+    if not is_timestamp_file(filepath):
+        return {'path': filepath, 'error': 'Not a timestamp file: {} array of shape {}'.format(timestamps.dtype, timestamps.shape)}
+    keep_every = max(1, len(timestamps) // PLOT_POINTS)
+    stats = TimestampStats(framerate, gap_factor, keep_every)
+    for start in range(0, len(timestamps), CHUNK_ROWS):
+        stats.add(timestamps[start:start + CHUNK_ROWS])
+    summary = stats.summary()
+    summary['path'] = filepath
+    summary['framerate'] = framerate
+    if plot_dir is not None and stats.num_frames > 1:
+        summary['plot'] = save_plot(stats, filepath, plot_dir)
+    return summary
+
+
+def save_plot(stats, filepath, plot_dir):
+    # Imported here so the checks themselves run without matplotlib, and never open a window
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, (hist_ax, drift_ax) = plt.subplots(1, 2, figsize=(12, 4))
+    centers = (stats.histogram_edges[:-1] + stats.histogram_edges[1:]) / 2
+    hist_ax.plot(centers, stats.error_histogram, 'b-', drawstyle='steps-mid')
+    hist_ax.set_yscale('log')
+    hist_ax.set_title('Inter-frame time error')
+    hist_ax.set_xlabel('Error relative to 1/{:g} sec (ms)'.format(1000 / stats.period_ms))
+    hist_ax.set_ylabel('Frames')
+
+    x = np.concatenate(stats.plot_x)
+    y = np.concatenate(stats.plot_y)
+    slope, intercept = stats.drift()
+    drift_ax.scatter(x / 3600, y * 1000, s=1, c='r', label='Observed')
+    drift_ax.plot(x / 3600, (intercept + slope * x) * 1000, 'k--', linewidth=1, label='Drift {:.1f} ppm'.format(slope * 1e6))
+    drift_ax.set_title('Timestamp error relative to perfect timing')
+    drift_ax.set_xlabel('Time since start (hrs)')
+    drift_ax.set_ylabel('Timestamp error (ms)')
+    drift_ax.legend()
+
+    figure.tight_layout()
+    os.makedirs(plot_dir, exist_ok=True)
+    plot_path = path.join(plot_dir, '{}.png'.format(path.splitext(path.basename(filepath))[0]))
+    figure.savefig(plot_path, dpi=100)
+    plt.close(figure)
+    return plot_path
+
+
+def _analyze(args):
+    return analyze_file(*args)
+
+
+def analyze(targets, framerate=None, plot_dir=None, processes=None, gap_factor=GAP_FACTOR):
+    """Runs analyze_file on every timestamp file of the targets (session directories or files) in a process pool.
+    Files without a rate in their manifest are checked against framerate, or config['camera_framerate']
+    """
+    if framerate is None:
+        framerate = config['camera_framerate']
+    jobs = list()
+    for target in targets:
+        for filepath, rate in find_timestamp_files(target):
+            jobs.append((filepath, rate or framerate, plot_dir, gap_factor))
+    if processes == 1 or len(jobs) < 2:
+        results = [_analyze(job) for job in jobs]
+    else:
+        with Pool(processes) as pool:
+            results = pool.map(_analyze, jobs, chunksize=1)
+
+    checked = [r for r in results if 'error' not in r]
+    totals = {
+        'files': len(results),
+        'unreadable_files': len(results) - len(checked),
+        'frames': sum(r['num_frames'] for r in checked),
+        'hours': sum(r['duration_s'] for r in checked) / 3600,
+        'gaps': sum(r['gaps']['count'] for r in checked),
+        'missing_frames': sum(r['gaps']['missing_frames'] for r in checked),
+        'skipped_frame_ids': sum(r['frame_ids']['skipped'] for r in checked),
+        'repeated_frame_ids': sum(r['frame_ids']['repeated'] for r in checked),
+        'max_abs_drift_ppm': max((abs(r['drift_ppm']) for r in checked), default=0.0),
+    }
+    return {'totals': totals, 'files': results}
+
+
+def command_line_demo():
+    parser = argparse.ArgumentParser(description='Checks the timing of camera timestamp files')
+    parser.add_argument('targets', type=str, nargs='+', help='Session directories or timestamp .npy files')
+    parser.add_argument('--framerate', type=float, default=None,
+        help='Nominal framerate for files without one in a session manifest. Defaults to config["camera_framerate"]')
+    parser.add_argument('--output', type=str, default=None, help='Write the JSON summary here instead of printing it')
+    parser.add_argument('--plots', type=str, default=None, help='Save a plot of each file to this directory')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes. Defaults to one per core')
+    parser.add_argument('--gap-factor', type=float, default=GAP_FACTOR, help='Intervals longer than this many frame periods count as gaps')
+    args = parser.parse_args()
+
+    report = analyze(args.targets, args.framerate, args.plots, args.processes, args.gap_factor)
+    for result in report['files']:
+        if 'error' in result:
+            print('{}: {}'.format(result['path'], result['error']))
+            continue
+        print('{}: {} frames, interval error {:.3f} +- {:.3f}ms, {} gaps ({} frames), {} skipped IDs, drift {:.1f}ppm'.format(
+            result['path'], result['num_frames'], result['interval_error_ms']['mean'], result['interval_error_ms']['std'],
+            result['gaps']['count'], result['gaps']['missing_frames'], result['frame_ids']['skipped'], result['drift_ppm']))
+    if args.output is not None:
+        with open(args.output, 'w') as ctx:
+            json.dump(report, ctx, indent=2)
+    else:
+        print(json.dumps(report['totals'], indent=2))
 
-# plt.subplot(1, 2, 2)
-plt.title('Distribution of Inter-frame Time Error')
-plt.hist(1000/framerate - diffs, bins=40, label='Time between frames')
-plt.axvline(1000/framerate - mean, color='k', linestyle='dashed', linewidth=1, label='Mean')
-plt.xlabel('Error in Inter-frame Time Relative to 1/{}sec (ms)'.format(framerate))
-plt.ylabel('Frames')
-plt.legend()
-plt.show()
-
-#plt.subplot(2, 2, 3)
-plt.title('Testing for Cumulative Effects of Camera Trigger Mistiming Events')
-relative_ts = ts - ts[0]
-relative_expected = expected - ts[0]
-plt.plot([0, relative_expected.shape[0] - 1], [0, relative_expected[-1]], 'b-', label='Expected Timestamps')
-plt.scatter(np.arange(relative_ts.shape[0]), relative_ts, s=2, c='r', label='Observed Timestamps')
-plt.xlabel('Frame #')
-plt.ylabel('Timestamp (ms)')
-plt.legend()
-plt.show()
-
-plt.title('Error in Observed Timestamps Relative to Perfect {}fps Timing'.format(framerate))
-plt.scatter(np.arange(ts.shape[0]) / framerate / 3600, ts - expected, s=2, c='r', label='Residuals')
-# Find the weird spot
-plt.legend()
-plt.xlabel('Time Since Start (hrs)')
-plt.ylabel('Timestamp Error (ms)')
-plt.show()
-
-print((ts-expected)[-1])
 
+if __name__ == '__main__':
+    command_line_demo()
@@ -0,0 +1,228 @@
+"""Helpers for reading the mic_*.h5 files written by microphone_input.mic_data_writer,
+regardless of the storage layout they were written with.
+
+SessionReader reads a window of samples from a whole session, across epoch files.
+"""
+from collections import OrderedDict
+import glob
+import json
+from os import path
+
+import numpy as np
+import tables
+
+from scripts import daq_backend, session_manifest
+
+
+class ChannelView:
+    """Read-only view of one column of the interleaved /ai_data array. Supports the
+    parts of the EArray interface used for per-channel reads: len(), shape, read() and
+    integer/slice indexing, so code written against /ai_channels/<name> keeps working.
+    """
+    def __init__(self, array, column, name):
+        self.array = array
+        self.column = column
+        self.name = name
+
+    def __len__(self):
+        return self.array.nrows
+
+    @property
+    def nrows(self):
+        return self.array.nrows
+
+    @property
+    def shape(self):
+        return (self.array.nrows,)
+
+    @property
+    def dtype(self):
+        return self.array.dtype
+
+    def read(self, start=None, stop=None, step=None):
+        return self[slice(start, stop, step)]
+
+    def __getitem__(self, key):
+        return self.array[key, self.column]
+
+
+def is_interleaved(h5file):
+    return '/ai_data' in h5file
+
+
+def channel_arrays(h5file):
+    """The per-channel arrays of a file in the 'channels' layout, in the order they were recorded.
+    Files written before that order was stored list them alphabetically
+    """
+    group = h5file.root.ai_channels
+    if 'channel_names' in group._v_attrs:
+        return [group._f_get_child(name) for name in group._v_attrs.channel_names]
+    return list(group)
+
+
+def channel_names(h5file):
+    if is_interleaved(h5file):
+        return list(h5file.root.ai_data.attrs.channel_names)
+    return [node.name for node in channel_arrays(h5file)]
+
+
+def open_channels(h5file):
+    """Returns an ordered mapping of channel name to a 1-D array-like for an open mic file"""
+    if is_interleaved(h5file):
+        array = h5file.root.ai_data
+        return OrderedDict((name, ChannelView(array, i, name)) for i, name in enumerate(array.attrs.channel_names))
+    return OrderedDict((node.name, node) for node in channel_arrays(h5file))
+
+
+def scaling_coefficients(h5file):
+    """Returns a (channels, order + 1) array of the polynomial coefficients (lowest order first)
+    converting each channel's stored samples to volts, or None if the file stores volts already
+    """
+    if is_interleaved(h5file):
+        if h5file.root.ai_data.atom.dtype != np.int16:
+            return None
+        attrs = h5file.root.ai_data.attrs
+        if 'scaling_coefficients' not in attrs:
+            return None
+        return np.asarray(attrs.scaling_coefficients, dtype=np.float64)
+    arrays = channel_arrays(h5file)
+    # Float32 arrays hold volts, whatever attributes they carry
+    if not arrays or arrays[0].atom.dtype != np.int16 or 'scaling_coefficients' not in arrays[0].attrs:
+        return None
+    return np.stack([np.asarray(a.attrs.scaling_coefficients, dtype=np.float64) for a in arrays])
+
+
+def read_channels(h5file, start=None, stop=None, channels=None, volts=False):
+    """Reads samples [start, stop) into a (channels, samples) array.
+    Parameters:
+        channels: list of channel names or column indices to read. Defaults to all of them
+        volts: convert files stored as int16 ADC codes to volts. Files stored as float32 are
+            in volts already and are returned as they are
+    """
+    names = channel_names(h5file)
+    if channels is None:
+        columns = list(range(len(names)))
+    else:
+        columns = [names.index(c) if isinstance(c, str) else c for c in channels]
+
+    if is_interleaved(h5file):
+        array = h5file.root.ai_data
+        block = array.read(start, stop)
+        block = np.ascontiguousarray(block[:, columns].T)
+    else:
+        arrays = channel_arrays(h5file)
+        block = np.stack([arrays[c].read(start, stop) for c in columns])
+
+    if volts:
+        coefficients = scaling_coefficients(h5file)
+        if coefficients is not None:
+            return daq_backend.codes_to_volts(block, coefficients[columns])
+    return block
+
+
+def load_audio(filepath, start=None, stop=None, channels=None, volts=False):
+    with tables.open_file(filepath, 'r') as h5file:
+        return read_channels(h5file, start, stop, channels, volts)
+
+
+class SessionReader:
+    """Reads arbitrary windows of microphone data from a session directory, as if the epoch
+    files were one continuous recording. The session manifest says which files cover the window,
+    so only those are opened, and only the requested rows are read from them. Each piece is read
+    straight into its slice of the output array.
+
+    Open files are kept in an LRU cache of at most max_open_files handles. Sessions recorded
+    before the manifest existed are indexed by opening each mic_*.h5 file once.
+    """
+    def __init__(self, directory, max_open_files=8):
+        self.directory = directory
+        self.max_open_files = max_open_files
+        self.open_files = OrderedDict()
+        self.manifest = session_manifest.SessionManifest(directory)
+        if 'mic' not in self.manifest.entries:
+            self.manifest.set_entries('mic', self.scan_files())
+        self.entries = self.manifest.entries['mic']
+        if not self.entries:
+            raise ValueError('No microphone files in {}'.format(directory))
+        self.sample_rate = self.entries[0].get('rate')
+
+        first = self.h5file(self.entries[0])
+        self.channel_names = channel_names(first)
+        self.dtype = (first.root.ai_data if is_interleaved(first) else channel_arrays(first)[0]).dtype
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def __len__(self):
+        return self.manifest.length('mic')
+
+    def scan_files(self):
+        entries = list()
+        start = 0
+        # The file names are timestamps, so they sort chronologically
+        for filepath in sorted(glob.glob(path.join(self.directory, 'mic_*.h5'))):
+            h5file = self.h5file({'path': path.basename(filepath)})
+            nrows = h5file.root.ai_data.nrows if is_interleaved(h5file) else channel_arrays(h5file)[0].nrows
+            config = {}
+            if '/config' in h5file:
+                config = json.loads(h5file.root.config.read().item())
+            entries.append({'path': path.basename(filepath), 'start': start, 'end': start + nrows,
+                'rate': config.get('microphone_sample_rate'), 'unit': 'sample'})
+            start += nrows
+        return entries
+
+    def h5file(self, entry):
+        filepath = path.join(self.directory, entry['path'])
+        if filepath in self.open_files:
+            self.open_files.move_to_end(filepath)
+            return self.open_files[filepath]
+        if len(self.open_files) >= self.max_open_files:
+            _, oldest = self.open_files.popitem(last=False)
+            oldest.close()
+        h5file = tables.open_file(filepath, 'r')
+        self.open_files[filepath] = h5file
+        return h5file
+
+    def read(self, start, stop, channels=None, volts=False):
+        """Reads session-wide samples [start, stop) into a (channels, samples) array.
+        Parameters:
+            channels: list of channel names or column indices. Defaults to all of them
+            volts: convert int16 files to volts, see read_channels
+        Samples past the end of the recording are not returned.
+        """
+        if channels is None:
+            columns = list(range(len(self.channel_names)))
+        else:
+            columns = [self.channel_names.index(c) if isinstance(c, str) else c for c in channels]
+        start = max(0, start)
+        stop = min(stop, len(self))
+        pieces = self.manifest.locate('mic', start, stop)
+        dtype = np.float64 if volts and self.dtype == np.int16 else self.dtype
+        out = np.empty((len(columns), max(0, stop - start)), dtype=dtype)
+
+        for entry, local_start, local_stop in pieces:
+            h5file = self.h5file(entry)
+            position = entry['start'] + local_start - start
+            destination = out[:, position:position + local_stop - local_start]
+            if volts and scaling_coefficients(h5file) is not None:
+                destination[:] = read_channels(h5file, local_start, local_stop, columns, volts=True)
+            elif is_interleaved(h5file):
+                # Rows hold every channel, so the read has to go through a (samples, channels) block
+                destination[:] = h5file.root.ai_data.read(local_start, local_stop)[:, columns].T
+            else:
+                arrays = channel_arrays(h5file)
+                for row, column in enumerate(columns):
+                    # Each row of out is contiguous, so PyTables can read into it directly
+                    arrays[column].read(local_start, local_stop, out=destination[row])
+        return out
+
+    def read_time(self, start_seconds, stop_seconds, channels=None, volts=False):
+        """read(), with the window given in seconds from the start of the session"""
+        return self.read(int(round(start_seconds * self.sample_rate)), int(round(stop_seconds * self.sample_rate)), channels, volts)
+
+    def close(self):
+        while self.open_files:
+            self.open_files.popitem()[1].close()
@@ -1,104 +1,218 @@
+"""Fisheye calibration of the cameras from videos (or directories of .png images) of a chessboard.
+
+For each camera:
+    1. Every stride-th frame of the calibration video is read, and frames that barely differ
+       from the last frame kept (compared on a small thumbnail) are skipped, since a board held
+       still adds nothing but solve time.
+    2. Chessboard corners are found in the remaining frames in a process pool.
+    3. The corners are cached next to the video in <stem>_corners.npz, so changing the
+       calibration flags or the number of views only reruns the solve.
+    4. cv2.fisheye.calibrate is run and K.npy and D.npy are written to the camera's
+       cam_<x>_calibration_path, where FLIRCamera loads them from. FLIRCamera expects K in full
+       sensor pixels, so K is rescaled if the calibration images were recorded at a smaller size.
+       Images have to show the whole sensor, e.g. recorded with camera_sensor_reduction 'none'.
+
+By default the source of camera x is calibration/cam_<x>/calibrate.avi.
+
+Example: python -m scripts.calibrate_camera --cameras a b c --stride 5
+"""
+import argparse
+import glob
+from multiprocessing import Pool
 import os
 from os import path
 
 import cv2
 import numpy as np
 
+from scripts.config import constants as config
 
-image_dir = 'calibration'
-image_paths = sorted([path.join(image_dir, filename) for filename in os.listdir(image_dir) if filename.endswith('.png')])
-
-use_vid = True
-vid_path = path.join(image_dir, 'calibrate.avi')
-
-output_dir = 'camera_params/cam_a'
-if not path.exists(output_dir):
-    os.mkdir(output_dir)
 
 # This might need to change if a different checkerboard image is used
-board_size = (7, 9)
-criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
-cal_flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC \
-            + cv2.fisheye.CALIB_FIX_SKEW
-            # + cv2.fisheye.CALIB_CHECK_COND \
-
-
-# Lists to hold the locations of checkerboard corners in the world and in the image
-world_points = list()
-image_points = list()
-
-# The origin and orientation of the world coordinates is arbitrary for our purposes
-world_frame = np.zeros((1, board_size[0] * board_size[1], 3), np.float32)
-world_frame[0, :, :2] = np.mgrid[0:board_size[0], 0:board_size[1]].T.reshape(-1, 2)
-# image_shape = None
-num_samples = 0
-
-
-def process(img):
-    # img = cv2.resize(img, (img.shape[1] // 2, img.shape[0] // 2))
-    if len(img.shape) == 3:
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    else:
-        gray = img
-
-    global image_shape
-    image_shape = gray.shape
-    # Finds the locations of chessboard corners in image space
-    ret, corners = cv2.findChessboardCorners(gray,
-            board_size,
-            cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE)
-    if ret:
-        world_points.append(world_frame)
-        corners_refined = cv2.cornerSubPix(gray,
-                corners,
-                (5, 5),
-                (-1, -1),
-                criteria)
-        image_points.append(corners_refined)
-
-
-
-if not use_vid:
-    num_samples = len(image_paths)
-    for image_path in image_paths:
-        img = cv2.imread(image_path)
-        sh = img.shape
-        img = cv2.resize(img, (img.shape[1], img.shape[0]))
-        process(img)
-else:
-    cap = cv2.VideoCapture(vid_path)
-    while cap.isOpened():
-        ret, frame = cap.read()
+BOARD_SIZE = (7, 9)
+STRIDE = 5
+# Mean absolute difference in gray levels between thumbnails below which a frame is a near duplicate
+DUPLICATE_THRESHOLD = 2.0
+THUMBNAIL_SIZE = (64, 48)
+# Views used by the solve at most, spread evenly over the detections
+MAX_VIEWS = 200
+# Full sensor resolution of the cameras, the pixel grid FLIRCamera expects K in
+SENSOR_SIZE = (1280, 1024)
+CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.001)
+CALIBRATION_FLAGS = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC + cv2.fisheye.CALIB_FIX_SKEW
+# + cv2.fisheye.CALIB_CHECK_COND
+CHESSBOARD_FLAGS = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_FAST_CHECK + cv2.CALIB_CB_NORMALIZE_IMAGE
+
+
+def default_source(camera):
+    return path.join('calibration', 'cam_{}'.format(camera), 'calibrate.avi')
+
+
+def output_directory(camera):
+    configured = config['cam_{}_calibration_path'.format(camera)]
+    return configured if configured is not None else path.join('camera_params', 'cam_{}'.format(camera))
+
+
+def cache_path(source):
+    if path.isdir(source):
+        return path.join(source, 'corners.npz')
+    return '{}_corners.npz'.format(path.splitext(source)[0])
+
+
+def read_frames(source, stride=STRIDE):
+    """Yields (index, grayscale image) for every stride-th frame of a video, or image of a directory"""
+    if path.isdir(source):
+        image_paths = sorted(glob.glob(path.join(source, '*.png')))
+        for index in range(0, len(image_paths), stride):
+            yield index, cv2.imread(image_paths[index], cv2.IMREAD_GRAYSCALE)
+        return
+    reader = cv2.VideoCapture(source)
+    index = 0
+    while reader.isOpened():
+        # Frames in between are grabbed without being converted
+        if index % stride and reader.grab():
+            index += 1
+            continue
+        ret, frame = reader.read()
         if not ret:
             break
-        num_samples += 1
-        process(frame)
-
-
-k_matrix = np.zeros((3, 3))
-d_matrix = np.zeros((4, 1))
-# Placeholders for rotation and translation vectors
-r_vecs = [np.zeros((1, 1, 3), dtype=float) for _ in range(num_samples)]
-t_vecs = [np.zeros((1, 1, 3), dtype=float) for _ in range(num_samples)]
-
-print(criteria)
-print(image_shape[::-1])
-cv2.fisheye.calibrate(
-    world_points,
-    image_points,
-    image_shape[::-1],
-    k_matrix,
-    d_matrix,
-    r_vecs,
-    t_vecs,
-    cal_flags,
-    criteria
-)
-
-
-np.save(path.join(output_dir, 'K.npy'), k_matrix)
-np.save(path.join(output_dir, 'D.npy'), d_matrix)
-
-print('K: {}'.format(str(k_matrix)))
-print('D: {}'.format(str(d_matrix)))
-
+        yield index, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+        index += 1
+    reader.release()
+
+
+def distinct_frames(frames, threshold=DUPLICATE_THRESHOLD):
+    """Drops frames whose thumbnail is within threshold of the last frame kept"""
+    last = None
+    for index, gray in frames:
+        thumbnail = cv2.resize(gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA).astype(np.float32)
+        if last is not None and cv2.norm(thumbnail, last, cv2.NORM_L1) / thumbnail.size < threshold:
+            continue
+        last = thumbnail
+        yield index, gray
+
+
+def detect_corners(args):
+    """Finds and refines the chessboard corners of a frame. Returns (index, corners or None)"""
+    index, gray, board_size = args
+    ret, corners = cv2.findChessboardCorners(gray, board_size, CHESSBOARD_FLAGS)
+    if not ret:
+        return index, None
+    return index, cv2.cornerSubPix(gray, corners, (5, 5), (-1, -1), CRITERIA)
+
+
+def find_corners(source, pool, board_size=BOARD_SIZE, stride=STRIDE, threshold=DUPLICATE_THRESHOLD, overwrite=False):
+    """Chessboard corners of the source's distinct frames, from the cache if it was made with the same settings.
+    Returns the frame indices, an (n, corners, 1, 2) array of corners and the (width, height) of the images
+    """
+    settings = np.array([board_size[0], board_size[1], stride, threshold], dtype=np.float64)
+    cache = cache_path(source)
+    if not overwrite and path.exists(cache) and path.getmtime(cache) >= path.getmtime(source):
+        with np.load(cache) as cached:
+            if np.array_equal(cached['settings'], settings):
+                print('Using the corners cached in {}'.format(cache))
+                return cached['indices'], cached['corners'], tuple(cached['image_size'])
+
+    image_size = None
+    num_frames = 0
+    indices = list()
+    corners = list()
+
+    def jobs():
+        nonlocal image_size, num_frames
+        for index, gray in distinct_frames(read_frames(source, stride), threshold):
+            image_size = gray.shape[::-1]
+            num_frames += 1
+            yield index, gray, board_size
+
+    for index, found in pool.imap(detect_corners, jobs(), chunksize=4):
+        if found is not None:
+            indices.append(index)
+            corners.append(found)
+    if image_size is None:
+        raise ValueError('No frames could be read from {}'.format(source))
+    print('{}: board found in {} of {} distinct frames'.format(source, len(corners), num_frames))
+
+    indices = np.array(indices, dtype=np.int64)
+    corners = np.array(corners, dtype=np.float32).reshape((len(indices), board_size[0] * board_size[1], 1, 2))
+    np.savez(cache, settings=settings, indices=indices, corners=corners, image_size=np.array(image_size))
+    return indices, corners, image_size
+
+
+def calibrate(corners, image_size, board_size=BOARD_SIZE, max_views=MAX_VIEWS, flags=CALIBRATION_FLAGS):
+    """Runs the fisheye calibration on at most max_views of the detections. Returns the RMS error, K and D"""
+    if len(corners) > max_views:
+        corners = corners[np.linspace(0, len(corners) - 1, max_views).astype(int)]
+    # The origin and orientation of the world coordinates is arbitrary for our purposes
+    world_frame = np.zeros((1, board_size[0] * board_size[1], 3), np.float32)
+    world_frame[0, :, :2] = np.mgrid[0:board_size[0], 0:board_size[1]].T.reshape(-1, 2)
+
+    k_matrix = np.zeros((3, 3))
+    d_matrix = np.zeros((4, 1))
+    rms, k_matrix, d_matrix, _, _ = cv2.fisheye.calibrate(
+        [world_frame] * len(corners),
+        [view.reshape((1, -1, 2)) for view in corners],
+        image_size,
+        k_matrix,
+        d_matrix,
+        flags=flags,
+        criteria=CRITERIA)
+    return rms, k_matrix, d_matrix
+
+
+def to_sensor_pixels(k_matrix, image_size, sensor_size=SENSOR_SIZE):
+    """Rescales K from the pixel grid of the calibration images to the full sensor.
+    Images with a different aspect ratio than the sensor cannot be the whole sensor scaled down, and are refused
+    """
+    scale = sensor_size[0] / image_size[0]
+    if abs(image_size[1] * scale - sensor_size[1]) > 0.5:
+        raise ValueError('Calibration images of {}x{} are not the {}x{} sensor scaled down'.format(
+            image_size[0], image_size[1], sensor_size[0], sensor_size[1]))
+    k_matrix = k_matrix.copy()
+    k_matrix[:2] *= scale
+    return k_matrix
+
+
+def command_line_demo():
+    cameras = [c for c in 'abc' if config['cam_{}_enabled'.format(c)]]
+    parser = argparse.ArgumentParser(description='Fisheye calibration of the cameras from chessboard videos')
+    parser.add_argument('--cameras', type=str, nargs='+', default=cameras, choices=['a', 'b', 'c'], help='Cameras to calibrate')
+    parser.add_argument('--sources', type=str, nargs='+', default=None,
+        help='Video or .png directory for each camera. Defaults to calibration/cam_<x>/calibrate.avi')
+    parser.add_argument('--stride', type=int, default=STRIDE, help='Only use every nth frame')
+    parser.add_argument('--duplicate-threshold', type=float, default=DUPLICATE_THRESHOLD,
+        help='Skip frames that differ from the last one used by less than this many gray levels on average')
+    parser.add_argument('--max-views', type=int, default=MAX_VIEWS, help='Detections used by the solve at most')
+    parser.add_argument('--board', type=int, nargs=2, default=BOARD_SIZE, help='Inner corners of the chessboard')
+    parser.add_argument('--sensor-size', type=int, nargs=2, default=SENSOR_SIZE, help='Full sensor resolution the saved K refers to')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes. Defaults to one per core')
+    parser.add_argument('--overwrite', action='store_true', help='Detect the corners again even if they are cached')
+    args = parser.parse_args()
+
+    sources = args.sources if args.sources is not None else [default_source(c) for c in args.cameras]
+    if len(sources) != len(args.cameras):
+        parser.error('Give one source per camera')
+    board_size = tuple(args.board)
+
+    with Pool(args.processes) as pool:
+        for camera, source in zip(args.cameras, sources):
+            try:
+                _, corners, image_size = find_corners(source, pool, board_size, args.stride, args.duplicate_threshold, args.overwrite)
+                rms, k_matrix, d_matrix = calibrate(corners, image_size, board_size, args.max_views)
+                k_matrix = to_sensor_pixels(k_matrix, image_size, tuple(args.sensor_size))
+            except (ValueError, cv2.error) as e:
+                print('Could not calibrate camera {}: {}'.format(camera, e))
+                continue
+
+            output_dir = output_directory(camera)
+            os.makedirs(output_dir, exist_ok=True)
+            np.save(path.join(output_dir, 'K.npy'), k_matrix)
+            np.save(path.join(output_dir, 'D.npy'), d_matrix)
+            print('Camera {}: RMS error {:.3f}px over {} views of {}x{} images, saved to {}'.format(
+                camera, rms, min(len(corners), args.max_views), image_size[0], image_size[1], output_dir))
+            print('K: {}'.format(str(k_matrix)))
+            print('D: {}'.format(str(d_matrix)))
+
+
+if __name__ == '__main__':
+    command_line_demo()
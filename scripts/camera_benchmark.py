@@ -0,0 +1,155 @@
+"""Benchmarks the camera frame pipeline against simulated cameras.
+
+Two measurements are made:
+    1. The per-stage cost of GetNextImage -> demosaic (and resize) -> remap -> write for a
+       single unthrottled camera
+    2. The sustained frame rate and number of dropped frames for 1-N cameras, each running
+       video_acquisition.FLIRCamera in its own process like multiprocess_run does. Frames dropped
+       by the camera and frames dropped by the video writer's queue are counted separately
+Both are repeated for every sensor reduction mode given (see video_acquisition.configure_sensor).
+
+Example: python -m scripts.camera_benchmark --cameras 4 --fps 30 60 0 --reduction none decimation
+An fps of 0 runs the cameras as fast as the pipeline allows, giving the maximum sustainable fps.
+"""
+import argparse
+from multiprocessing import Process, Queue
+import tempfile
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from scripts import simulated_camera, video_acquisition, video_writer
+from scripts.config import constants as config
+
+
+STAGES = ('grab', 'demosaic', 'remap', 'write')
+
+
+def synthetic_fisheye_maps(dimensions):
+    """Undistortion maps with plausible parameters, so remap can be timed without a calibration file"""
+    width, height = dimensions
+    K = np.array([[width / 2, 0, width / 2], [0, width / 2, height / 2], [0, 0, 1]])
+    D = np.array([[0.05], [-0.01], [0.0], [0.0]])
+    new_K = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(K, D, dimensions, np.eye(3), balance=0)
+    return cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), new_K, dimensions, cv2.CV_16SC2)
+
+
+def profile_stages(num_frames, directory, dimensions=video_acquisition.DEFAULT_DIMENSIONS, source_video=None, reduction='none', encoder=None):
+    """Times each stage of image_acquisition_loop on an unthrottled simulated camera.
+    Returns a dict of stage name to mean cost in ms
+    """
+    camera = simulated_camera.SimulatedCamera('benchmark', source_video=source_video)
+    camera.AcquisitionFrameRate.SetValue(0)
+    camera.Init()
+    video_acquisition.configure_sensor(camera, dimensions, reduction)
+    camera.BeginAcquisition()
+    converter = video_acquisition.FrameConverter(dimensions, synthetic_fisheye_maps(dimensions))
+    writer, _ = video_writer.create_encoder('{}/stage_profile'.format(directory), config['camera_framerate'], dimensions, encoder)
+
+    costs = np.zeros((num_frames, len(STAGES)))
+    for i in range(num_frames):
+        t0 = time.perf_counter()
+        image = camera.GetNextImage(34)
+        t1 = time.perf_counter()
+        cv_img = converter.demosaic(image)
+        image.Release()
+        t2 = time.perf_counter()
+        cv_img = converter.undistort(cv_img)
+        t3 = time.perf_counter()
+        writer.write(cv_img)
+        converter.pool.put(cv_img)
+        t4 = time.perf_counter()
+        costs[i] = np.diff([t0, t1, t2, t3, t4])
+    writer.release()
+    camera.EndAcquisition()
+    return dict(zip(STAGES, costs.mean(axis=0) * 1000))
+
+
+def camera_benchmark_process(index, framerate, duration, directory, source_video, reduction, encoder, results):
+    stop_event = threading.Event()
+    cam = video_acquisition.FLIRCamera(
+        root_directory=directory,
+        stop_event=stop_event,
+        camera_serial='benchmark_{}'.format(index),
+        counter_port=None,
+        port_name='cam_{}'.format(index),
+        frame_target=int(duration * 1000),  # Never roll over during the benchmark
+        epoch_target=1,
+        framerate=framerate or config['camera_framerate'],
+        camera_backend='simulated',
+        sensor_reduction=reduction,
+        encoder=encoder)
+    cam.camera.AcquisitionFrameRate.SetValue(framerate)
+    if source_video is not None:
+        cam.camera.source_video = source_video
+        cam.camera.frames = None
+        cam.camera.Init()
+    if config['cam_a_calibration_path'] is None:
+        # The converter was built with the camera, so it has to be given the maps itself
+        cam.transformation_maps = synthetic_fisheye_maps(cam.dimensions)
+        cam.converter.maps = cam.transformation_maps
+
+    cam.start_epoch()
+    start = time.perf_counter()
+    time.sleep(duration)
+    stop_event.set()
+    cam.acq_thread.join()
+    elapsed = time.perf_counter() - start
+    frames = cam.frames_acquired
+    dropped = cam.camera.frames_dropped
+    cam.release()
+    results.put((index, frames / elapsed, dropped, cam.frame_writer.total_dropped))
+
+
+def run_cameras(num_cameras, framerate, duration, directory, source_video=None, reduction='none', encoder=None):
+    results = Queue()
+    processes = [
+        Process(target=camera_benchmark_process, args=(i, framerate, duration, directory, source_video, reduction, encoder, results))
+        for i in range(num_cameras)]
+    for proc in processes:
+        proc.start()
+    stats = [results.get() for _ in processes]
+    for proc in processes:
+        proc.join()
+    return sorted(stats)
+
+
+def command_line_demo():
+    parser = argparse.ArgumentParser(description='Benchmark the camera frame pipeline with simulated cameras')
+    parser.add_argument('--cameras', type=int, default=3, help='Run with 1 up to this many cameras')
+    parser.add_argument('--fps', type=float, nargs='+', default=[config['camera_framerate'], 0],
+        help='Trigger rates to test. 0 runs unthrottled to find the maximum sustainable fps')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds to run each configuration')
+    parser.add_argument('--profile-frames', type=int, default=300, help='Frames used for the per-stage profile')
+    parser.add_argument('--video', type=str, default=None, help='Serve frames from this video instead of synthetic ones')
+    parser.add_argument('--reduction', type=str, nargs='+', default=['none', 'decimation'],
+        choices=['none', 'binning', 'decimation', 'roi'], help='Sensor reduction modes to compare')
+    parser.add_argument('--encoder', type=str, default=None, choices=['opencv', 'ffmpeg'], help='Video encoder. Defaults to the configured one')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        for reduction in dict.fromkeys(args.reduction):
+            stage_costs = profile_stages(args.profile_frames, directory, source_video=args.video, reduction=reduction, encoder=args.encoder)
+            total = sum(stage_costs.values())
+            print('Per-frame cost, single camera, sensor reduction {}:'.format(reduction))
+            for stage, cost in stage_costs.items():
+                print('    {:<8} {:6.2f}ms'.format(stage, cost))
+            print('    {:<8} {:6.2f}ms ({:.0f} fps if run serially)'.format('total', total, 1000 / total))
+            print()
+
+            for framerate in args.fps:
+                label = 'unthrottled' if not framerate else '{:g} fps'.format(framerate)
+                for num_cameras in range(1, args.cameras + 1):
+                    stats = run_cameras(num_cameras, framerate, args.duration, directory, args.video, reduction, args.encoder)
+                    achieved = ', '.join('{:.1f}'.format(fps) for _, fps, _, _ in stats)
+                    dropped = sum(d for _, _, d, _ in stats)
+                    encoder_dropped = sum(d for _, _, _, d in stats)
+                    print('{:>11}, {} camera(s): achieved fps [{}], {} frames dropped by the camera, {} by the encoder queue'.format(
+                        label, num_cameras, achieved, dropped, encoder_dropped))
+            print()
+
+
+if __name__ == '__main__':
+    command_line_demo()
@@ -1,9 +1,10 @@
 import time
 
-import nidaqmx as ni
 from nidaqmx import types
 from nidaqmx import constants
 
+from scripts import daq_backend
+
 
 class CameraTTLTask:
     def __init__(self, framerate, period_extension=0, counter_port=u'Dev1/ctr0', port_name='camera_0', duty_cycle=0.1):
@@ -16,7 +17,7 @@ class CameraTTLTask:
         self.configure_task()
 
     def configure_task(self):
-        self.counter_task = ni.Task()
+        self.counter_task = daq_backend.create_task()
         # Don't think there are any strict requirements on the duty cycle here, as the camera listens for the rising edge
         self.counter_task.co_channels.add_co_pulse_chan_time(
                 self.port,
@@ -0,0 +1,346 @@
+"""Maps camera frames to DAQ sample indices.
+
+Every camera frame is triggered by a pulse of the camera TTL. The microphone writer records
+the rising edge of each pulse as a session-wide sample index (the camera_frames array of the
+mic_*.h5 files). The camera stamps each frame with its own clock (the TimeStamp column of the
+timestamp files), and that clock drifts against the DAQ clock. synchronize() lines the two up
+for every epoch of a camera:
+
+    1. Each frame is assigned the pulse that triggered it. The camera's FrameID counts every
+       exposure, including frames the host never received, so the pulse index is the FrameID
+       counted from the session's first frame. A gap of n frame periods between timestamps
+       with a FrameID step of 1 means the camera missed n - 1 triggers. A frame with the same
+       FrameID or timestamp as the one before it is a duplicate.
+    2. A continuous piecewise-linear function from camera time to sample index is fitted to
+       the (timestamp, pulse sample) pairs of the epoch, with one piece per segment_seconds.
+       The fit is iteratively reweighted (Huber weights), so a frame assigned to the wrong pulse
+       doesn't pull it off.
+    3. Frames further than outlier_frames of a frame period from the fit are flagged.
+
+The result is saved next to the epoch's video as <stem>_sync.npz. EpochSync loads it and answers
+frame -> sample and sample -> frame lookups by indexing precomputed tables.
+
+Example: python -m scripts.clock_sync D:acquired_data/session --stream cam_a cam_b
+"""
+import argparse
+import json
+from os import path
+
+import numpy as np
+from scipy import linalg
+
+from scripts import audio_file, session_manifest
+from scripts.config import constants as config
+
+
+SEGMENT_SECONDS = config['camera_sync_segment_seconds']
+OUTLIER_FRAMES = config['camera_sync_outlier_frames']
+HUBER_K = 1.345
+NUM_ITERATIONS = 5
+# Only there to keep knots without any frames near them solvable
+SMOOTHING = 1e-6
+# Sample -> frame bins are at least this fraction of the median frame gap wide
+MIN_BIN_FRACTION = 0.25
+
+
+def sync_path(video_path):
+    return '{}_sync.npz'.format(path.splitext(video_path)[0])
+
+
+def load_camera_pulses(reader):
+    """Sample index of every camera TTL pulse in the session, from an audio_file.SessionReader"""
+    pulses = list()
+    for entry in reader.entries:
+        h5file = reader.h5file(entry)
+        if '/camera_frames' in h5file:
+            pulses.append(h5file.root.camera_frames.read())
+    if not pulses:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(pulses).astype(np.int64)
+
+
+def assign_pulses(frame_ids, timestamps, pulse_offset=0):
+    """Works out which TTL pulse triggered each frame of a session.
+    Parameters:
+        frame_ids, timestamps: every row of the session's timestamp files, in order
+        pulse_offset: index of the pulse that triggered the first frame. 0 when the cameras are
+            armed before the TTL starts, as multiprocess_run does
+    Returns the pulse index of each frame, whether it's a duplicate, and the number of pulses
+    that produced no frame between it and the previous frame
+    """
+    frame_ids = np.asarray(frame_ids, dtype=np.int64)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    id_step = np.diff(frame_ids)
+    time_step = np.diff(timestamps)
+    duplicate = np.zeros(len(frame_ids), dtype=bool)
+    duplicate[1:] = (id_step <= 0) | (time_step <= 0)
+
+    regular = (id_step == 1) & (time_step > 0)
+    period = np.median(time_step[regular]) if np.any(regular) else np.inf
+    # Whichever of the two clocks shows the bigger gap: the FrameID skips frames the host lost,
+    # the timestamps also skip triggers the camera never exposed for
+    step = np.maximum(id_step, np.rint(time_step / period).astype(np.int64))
+    step[duplicate[1:]] = 0
+
+    pulse = np.empty(len(frame_ids), dtype=np.int64)
+    if len(pulse):
+        pulse[0] = pulse_offset
+        np.cumsum(step, out=pulse[1:])
+        pulse[1:] += pulse_offset
+    missed = np.zeros(len(frame_ids), dtype=np.int64)
+    missed[1:] = np.maximum(step - 1, 0)
+    return pulse, duplicate, missed
+
+
+def evaluate(x, knots, values):
+    """Evaluates the piecewise-linear function, continuing the end pieces past the last knots"""
+    x = np.asarray(x, dtype=np.float64)
+    y = np.interp(x, knots, values)
+    before = x < knots[0]
+    y[before] = values[0] + (x[before] - knots[0]) * (values[1] - values[0]) / (knots[1] - knots[0])
+    after = x > knots[-1]
+    y[after] = values[-1] + (x[after] - knots[-1]) * (values[-1] - values[-2]) / (knots[-1] - knots[-2])
+    return y
+
+
+def fit_piecewise_linear(x, y, knots, iterations=NUM_ITERATIONS, min_scale=1.0):
+    """Robust fit of a continuous piecewise-linear function with the given knots.
+    Each iteration solves the weighted least squares problem for the values at the knots, a
+    banded system, then recomputes the Huber weights from the residuals.
+    Parameters:
+        min_scale: lower bound on the residual scale, in units of y, so an exact fit doesn't
+            give every point a weight of 0
+    Returns the values at the knots and the final weights
+    """
+    num_knots = len(knots)
+    piece = np.clip(np.searchsorted(knots, x, side='right') - 1, 0, num_knots - 2)
+    t = (x - knots[piece]) / (knots[piece + 1] - knots[piece])
+
+    # Second differences of the knot values, lightly penalised
+    rows = np.arange(num_knots - 2)
+    penalty_diagonal = (np.bincount(rows, minlength=num_knots) + 4 * np.bincount(rows + 1, minlength=num_knots)
+        + np.bincount(rows + 2, minlength=num_knots))
+    penalty_upper = -2 * (np.bincount(rows, minlength=num_knots - 1) + np.bincount(rows + 1, minlength=num_knots - 1))
+
+    weights = np.ones(len(x))
+    for _ in range(iterations):
+        diagonal = (np.bincount(piece, weights * (1 - t) ** 2, minlength=num_knots)
+            + np.bincount(piece + 1, weights * t ** 2, minlength=num_knots))
+        upper = np.bincount(piece, weights * t * (1 - t), minlength=num_knots - 1)
+        rhs = (np.bincount(piece, weights * (1 - t) * y, minlength=num_knots)
+            + np.bincount(piece + 1, weights * t * y, minlength=num_knots))
+        smoothing = SMOOTHING * weights.sum() / num_knots
+
+        # solve_banded's layout: row 2 - k holds the k-th diagonal above the main one
+        bands = np.zeros((5, num_knots))
+        bands[0, 2:] = smoothing
+        bands[1, 1:] = upper + smoothing * penalty_upper
+        bands[2] = diagonal + smoothing * penalty_diagonal
+        bands[3, :-1] = bands[1, 1:]
+        bands[4, :-2] = smoothing
+        values = linalg.solve_banded((2, 2), bands, rhs)
+
+        residuals = np.abs(y - values[piece] * (1 - t) - values[piece + 1] * t)
+        scale = max(1.4826 * np.median(residuals), min_scale)
+        weights = np.minimum(1, HUBER_K * scale / np.maximum(residuals, 1e-12))
+    return values, weights
+
+
+def fit_epoch(timestamps, pulse, duplicate, pulse_samples, segment_seconds=SEGMENT_SECONDS, outlier_frames=OUTLIER_FRAMES):
+    """Fits the camera clock of one epoch to the DAQ sample clock.
+    Parameters:
+        timestamps: camera timestamps in ns of the epoch's frames
+        pulse, duplicate: from assign_pulses, for the same frames
+        pulse_samples: from load_camera_pulses
+    Returns a dict of the arrays saved in the _sync.npz file
+    """
+    origin = int(timestamps[0])
+    x = (timestamps - origin) * 1e-9
+    valid = ~duplicate & (pulse >= 0) & (pulse < len(pulse_samples))
+    if np.count_nonzero(valid) < 2 or x[valid][-1] <= x[valid][0]:
+        raise ValueError('Not enough frames with a matching TTL pulse to fit the camera clock')
+
+    x_valid = x[valid]
+    y_valid = pulse_samples[pulse[valid]].astype(np.float64)
+    num_pieces = max(1, int(np.ceil((x_valid[-1] - x_valid[0]) / segment_seconds)))
+    knots = np.linspace(x_valid[0], x_valid[-1], num_pieces + 1)
+    knot_samples, weights = fit_piecewise_linear(x_valid, y_valid, knots)
+
+    predicted = evaluate(x, knots, knot_samples)
+    samples_per_frame = np.median(np.diff(pulse_samples)) if len(pulse_samples) > 1 else 1
+    outlier = np.zeros(len(x), dtype=bool)
+    residuals = y_valid - predicted[valid]
+    outlier[valid] = np.abs(residuals) > outlier_frames * samples_per_frame
+    return {
+        'frame_sample': np.rint(predicted).astype(np.int64),
+        'pulse_index': pulse,
+        'duplicate': duplicate,
+        'outlier': outlier,
+        'timestamp_origin': np.int64(origin),
+        'knots': knots,
+        'knot_samples': knot_samples,
+        'residual_std': np.float64(np.std(residuals[~outlier[valid]])) if np.any(~outlier[valid]) else np.float64(np.nan),
+    }
+
+
+def frames_in_video(frame_ids, encoder_stats_path):
+    """Which frames made it into the video: the encoder queue drops some when it's full"""
+    dropped = list()
+    if encoder_stats_path is not None and path.exists(encoder_stats_path):
+        with open(encoder_stats_path, 'r') as ctx:
+            dropped = [i for i in json.load(ctx).get('dropped_frame_ids', list()) if i is not None]
+    return ~np.isin(frame_ids, dropped)
+
+
+def synchronize(directory, stream, pulse_offset=0, overwrite=False, segment_seconds=SEGMENT_SECONDS, outlier_frames=OUTLIER_FRAMES):
+    """Fits and saves the sync model of every epoch of a camera stream that doesn't have one yet.
+    Pulses are assigned over the whole session, so epochs are consistent with each other.
+    Returns the paths of the _sync.npz files, one per epoch
+    """
+    manifest = session_manifest.SessionManifest(directory)
+    if stream not in manifest.entries:
+        raise ValueError('No manifest for {} in {}'.format(stream, directory))
+    entries = manifest.entries[stream]
+    paths = [sync_path(manifest.filepath(entry)) for entry in entries]
+    if not overwrite and all(path.exists(p) for p in paths):
+        return paths
+
+    rows = [np.load(manifest.filepath(entry, 'timestamps'), mmap_mode='r') for entry in entries]
+    timestamps = np.concatenate(rows) if rows else np.zeros((0, 2), dtype=np.int64)
+    pulse, duplicate, missed = assign_pulses(timestamps[:, 0] - timestamps[0, 0], timestamps[:, 1], pulse_offset)
+    with audio_file.SessionReader(directory) as reader:
+        pulse_samples = load_camera_pulses(reader)
+    if len(pulse) and pulse[-1] + 1 != len(pulse_samples):
+        print('{}: frames account for {} TTL pulses, but {} were recorded'.format(stream, pulse[-1] + 1, len(pulse_samples)))
+
+    bounds = np.cumsum([0] + [len(r) for r in rows])
+    for entry, epoch_rows, start, stop, sync_filepath in zip(entries, rows, bounds[:-1], bounds[1:], paths):
+        if path.exists(sync_filepath) and not overwrite:
+            continue
+        epoch = slice(start, stop)
+        try:
+            model = fit_epoch(timestamps[epoch, 1], pulse[epoch], duplicate[epoch], pulse_samples, segment_seconds, outlier_frames)
+        except ValueError as e:
+            print('{}: {}'.format(entry['path'], e))
+            continue
+        encoder_stats = manifest.filepath(entry, 'encoder_stats') if 'encoder_stats' in entry else None
+        model['missed_pulses'] = missed[epoch]
+        model['in_video'] = frames_in_video(epoch_rows[:, 0], encoder_stats)
+        model['first_frame'] = np.int64(entry['start'])
+        np.savez(sync_filepath, **model)
+        print('{}: {} frames, {} duplicated, {} pulses without a frame, {} outliers, residual {:.2f} samples'.format(
+            entry['path'], stop - start, np.count_nonzero(model['duplicate']), model['missed_pulses'].sum(),
+            np.count_nonzero(model['outlier']), model['residual_std']))
+    return paths
+
+
+class EpochSync:
+    """A saved sync model. Frame indices are rows of the epoch's timestamp file"""
+    def __init__(self, filepath):
+        with np.load(filepath) as model:
+            for key in model.files:
+                setattr(self, key, model[key])
+        self.video_rows = np.flatnonzero(self.in_video)
+
+        # Sample -> frame table: each bin points at the first frame starting in or after it, so a
+        # lookup is one index into the table and a scan over the few frames that share a bin.
+        # Bins are as narrow as the shortest gap between frames, but no narrower than a fraction
+        # of the median gap, so one odd timestamp can't blow the table up
+        self.lookup_rows = np.flatnonzero(~self.duplicate)
+        self.lookup_samples = self.frame_sample[self.lookup_rows]
+        self.first_sample = int(self.lookup_samples[0])
+        self.last_sample = int(self.lookup_samples[-1])
+        gaps = np.diff(self.lookup_samples)
+        gaps = gaps[gaps > 0]
+        self.median_gap = int(np.median(gaps)) if len(gaps) else 1
+        self.bin_width = max(1, int(gaps.min()), int(self.median_gap * MIN_BIN_FRACTION)) if len(gaps) else 1
+        frame_bins = (self.lookup_samples - self.first_sample) // self.bin_width
+        self.bin_table = np.searchsorted(self.lookup_samples, self.first_sample + np.arange(frame_bins[-1] + 1) * self.bin_width, side='left')
+        self.max_frames_per_bin = int(np.bincount(frame_bins).max())
+
+    def __len__(self):
+        return len(self.frame_sample)
+
+    def sample_of_frame(self, rows):
+        return self.frame_sample[rows]
+
+    def sample_of_video_frame(self, video_frames):
+        """Sample index of frames counted in the video file, which lacks the frames the encoder dropped"""
+        return self.frame_sample[self.video_rows[video_frames]]
+
+    def sample_of_timestamp(self, timestamps):
+        return evaluate((np.asarray(timestamps, dtype=np.int64) - self.timestamp_origin) * 1e-9, self.knots, self.knot_samples)
+
+    def frame_at_sample(self, samples):
+        """Row of the frame on display at each sample: the last frame triggered at or before it.
+        -1 for samples before the epoch's first frame
+        """
+        samples = np.asarray(samples, dtype=np.int64)
+        num_frames = len(self.lookup_samples)
+        bins = np.clip((samples - self.first_sample) // self.bin_width, 0, len(self.bin_table) - 1)
+        index = self.bin_table[bins]
+        # Step past the frames of the bin that start at or before the sample
+        for _ in range(self.max_frames_per_bin):
+            index = index + ((index < num_frames) & (self.lookup_samples[np.minimum(index, num_frames - 1)] <= samples))
+        index = index - 1
+        rows = self.lookup_rows[np.maximum(index, 0)]
+        return np.where(index >= 0, rows, -1)
+
+
+class SessionSync:
+    """Frame <-> sample lookups for a whole camera stream, across epochs. Fits any missing
+    epoch models when opened
+    """
+    def __init__(self, directory, stream, pulse_offset=0):
+        self.manifest = session_manifest.SessionManifest(directory)
+        self.stream = stream
+        paths = synchronize(directory, stream, pulse_offset)
+        self.epochs = [EpochSync(p) if path.exists(p) else None for p in paths]
+        self.entries = self.manifest.entries[stream]
+        # Epochs that failed to fit are left out of the search, fitted_epochs maps back to the manifest's order
+        self.fitted_epochs = np.array([i for i, e in enumerate(self.epochs) if e is not None], dtype=np.int64)
+        self.first_samples = np.array([self.epochs[i].first_sample for i in self.fitted_epochs], dtype=np.int64)
+
+    def sample_of_frame(self, frame):
+        """Sample index of a session-wide frame index, as counted by the manifest"""
+        for entry, local_start, _ in self.manifest.locate(self.stream, frame, frame + 1):
+            epoch = self.epochs[self.entries.index(entry)]
+            if epoch is not None:
+                return int(epoch.frame_sample[local_start])
+        return None
+
+    def frame_at_sample(self, sample):
+        """Session-wide index of the frame on display at a sample. None before the first frame,
+        or if the sample falls in an epoch without a fitted model
+        """
+        position = int(np.searchsorted(self.first_samples, sample, side='right')) - 1
+        if position < 0:
+            return None
+        index = self.fitted_epochs[position]
+        epoch = self.epochs[index]
+        if sample > epoch.last_sample + epoch.median_gap:
+            # Past the end of this epoch, in one that couldn't be fitted
+            return None
+        return self.entries[index]['start'] + int(epoch.frame_at_sample(sample))
+
+
+def command_line_demo():
+    parser = argparse.ArgumentParser(description='Fit the camera clock to the DAQ clock for every epoch of a session')
+    parser.add_argument('directory', type=str, help='Session directory, holding the manifest_*.jsonl files')
+    parser.add_argument('--stream', type=str, nargs='+', default=None, help='Camera streams to sync. Defaults to all of them')
+    parser.add_argument('--pulse-offset', type=int, default=0, help='Index of the TTL pulse that triggered the first frame')
+    parser.add_argument('--overwrite', action='store_true', help='Refit epochs that already have a _sync.npz file')
+    args = parser.parse_args()
+
+    streams = args.stream
+    if streams is None:
+        streams = [s for s in session_manifest.SessionManifest(args.directory).streams if s != 'mic']
+    for stream in streams:
+        try:
+            synchronize(args.directory, stream, args.pulse_offset, args.overwrite)
+        except ValueError as e:
+            print(e)
+
+
+if __name__ == '__main__':
+    command_line_demo()
@@ -3,6 +3,8 @@ import numpy as np
 
 constants = {
     'device_name': 'Dev1',  # Name of the NI card
+    'daq_backend': 'nidaqmx',  # 'nidaqmx' for the NI card, 'simulated' for load testing without hardware
+    'simulated_daq_speed': 1,  # Simulated clock speed relative to real time. 0 runs as fast as the callback allows
 
     'num_microphones': 4,
     'data_directory': 'D:acquired_data',
@@ -12,6 +14,21 @@ constants = {
     'camera_c_serial': '21259816',
     'camera_ctr_port': '{device_name}/ctr1',
     'camera_framerate': 30,  # Hz/fps
+    'camera_backend': 'pyspin',  # 'pyspin' for the FLIR cameras, 'simulated' for benchmarking without hardware
+    'camera_sensor_reduction': 'none',  # How the sensor delivers frames at the recorded size: 'none' (resize on the host), or opt in to 'decimation', 'binning' or 'roi' (crop) once checked on the rig's sensors
+    'camera_frame_pool_size': 4,  # Preallocated BGR frames per camera
+    'camera_timestamp_batch_size': 300,  # Timestamps buffered in memory before being appended to disk (10s at 30fps)
+    'camera_writer_queue_size': 60,  # Frames allowed to wait for the video encoder (2s at 30fps)
+    'camera_writer_drop_policy': 'drop',  # When the encoder queue is full: 'drop' the new frame, or 'block' the acquisition thread
+    'camera_encoder': 'opencv',  # 'opencv' for DIVX through cv2.VideoWriter, 'ffmpeg' to pipe raw frames to an ffmpeg process
+    'camera_ffmpeg_path': 'ffmpeg',
+    'camera_ffmpeg_codec': 'libx264',  # e.g. 'libx264', 'ffv1' (lossless)
+    'camera_ffmpeg_preset': 'ultrafast',  # None for codecs without presets, such as ffv1
+    'camera_ffmpeg_crf': 23,  # Constant rate factor, lower is better quality. None for lossless codecs
+    'camera_ffmpeg_pixel_format': 'yuv420p',  # Pixel format of the encoded video, 'gray' for grayscale
+    'camera_ffmpeg_container': 'mkv',
+    'camera_sync_segment_seconds': 60,  # Length of each linear piece of the camera clock to DAQ sample mapping
+    'camera_sync_outlier_frames': 0.25,  # Frames further than this fraction of a frame period from the fitted clock are flagged
     'cam_a_enabled': True,
     'cam_b_enabled': True,
     'cam_c_enabled': False,
@@ -28,7 +45,16 @@ constants = {
 
     'microphone_sample_rate': 125000,  # Hz
     'microphone_data_retrieval_interval': 0.25,  # n seconds between each read from DAQ buffer; keep < 2 seconds and > .1 seconds
+    'microphone_storage_layout': 'channels',  # 'channels' for one dataset per channel, 'interleaved' for a single (samples, channels) dataset
+    'microphone_compression': None,  # HDF5 compression library for audio, e.g. 'blosc:lz4'. None disables compression
+    'microphone_compression_level': 1,
+    'microphone_writer_pool_size': 20,  # Blocks buffered between the DAQ callback and the HDF5 writer thread (20 * 0.25s = 5s)
+    'microphone_read_raw': False,  # Read unscaled int16 samples from the DAQ and scale them to volts on the writer thread
+    'microphone_storage_dtype': 'float32',  # 'float32' for volts, 'int16' for the raw ADC codes with their scaling stored as attributes
     'spectrogram_display_enabled': True,
+    'spectrogram_colored': False,  # Stereo color display of the first two microphones instead of grayscale
+    'spectrogram_display_fps': 10,  # Upper limit on how often the spectrogram worker publishes a new image
+    'spectrogram_decimation': 1,  # Integer factor to downsample the audio by before the STFT
     'spectrogram_rmic_correction_factor': 1 / 1.85,  # Normalize the input from the louder microphone
     'spectrogram_red_color': np.array([87, 66, 206]).reshape((1, 1, 3)),  # BGR order
     'spectrogram_blue_color': np.array([218, 214, 109]).reshape((1, 1, 3)),  # BGR order
@@ -46,6 +72,10 @@ constants = {
     'wm_sync_signal_port': '{device_name}/ctr0',
     'wm_trig_ai_port': '{device_name}/ai7',
     'audio_ttl_ai_port': '{device_name}/ai5',
+    # (low, high) Schmitt trigger thresholds in volts. A TTL channel has to drop below low before it can rise above high again
+    'audio_ttl_thresholds': (1.5, 2.5),
+    'cam_ttl_thresholds': (0.5, 1.5),
+    'hsw_ttl_thresholds': (2.5, 3.5),
 }
 
 # In the case of device_name, some of the dictionary values are dependend on other values in the dict
@@ -0,0 +1,92 @@
+"""Start/stop coordination between the acquisition processes.
+
+Every process sleeps instead of spinning on a Manager value: the workers block on a
+barrier until they have all finished setting up, then sleep until a shared start
+timestamp chosen by the main process, and finally block on a stop event.
+"""
+from ctypes import c_double
+import multiprocessing
+import threading
+import time
+
+
+SPIN_MARGIN = 0.002  # Seconds before a deadline at which wait_until stops sleeping and starts spinning
+MIN_START_DELAY = 0.5  # Seconds between releasing the barrier and the start time, if setup ran late
+
+
+def wait_until(deadline):
+    """Sleeps until time.time() reaches deadline. Sleeps coarsely, then spins for the last
+    couple of milliseconds so processes waking for the same deadline start within a fraction
+    of a millisecond of each other
+    """
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= SPIN_MARGIN:
+            break
+        time.sleep(remaining - SPIN_MARGIN)
+    while time.time() < deadline:
+        pass
+
+
+class AcquisitionCoordinator:
+    """Shared between the main process and num_workers worker processes. Pass it to each
+    worker as a Process argument.
+
+    Workers call wait_for_start() once they are ready to acquire, then check is_running() or
+    block in wait_for_stop(). The main process calls release() to start everyone and stop()
+    to end the acquisition.
+    """
+    def __init__(self, num_workers, start_time):
+        # +1 for the main process, which decides the start time once everybody is ready
+        self.barrier = multiprocessing.Barrier(num_workers + 1)
+        self.go_event = multiprocessing.Event()
+        self.stop_event = multiprocessing.Event()
+        self.start_time = multiprocessing.Value(c_double, start_time)
+
+    def wait_for_start(self, timeout=None):
+        """Blocks until the start time. Returns the start time, or None if the acquisition was
+        stopped before it began.
+        """
+        try:
+            self.barrier.wait(timeout)
+        except threading.BrokenBarrierError:
+            pass  # Somebody failed to set up in time, the main process decides whether to go on without them
+        self.go_event.wait()
+        if self.stop_event.is_set():
+            return None
+        start_time = self.start_time.value
+        wait_until(start_time)
+        return start_time
+
+    def release(self, timeout=None):
+        """Called by the main process. Waits for every worker to be ready, pushes the start time
+        back if setup overran it, and lets everybody go. Returns the start time.
+        """
+        try:
+            self.barrier.wait(timeout)
+        except threading.BrokenBarrierError:
+            print('Not every process finished setting up in time, starting without them')
+            self.barrier.abort()
+        with self.start_time.get_lock():
+            if self.start_time.value < time.time() + MIN_START_DELAY:
+                print('Setup ran past the scheduled start time, postponing the start')
+                self.start_time.value = time.time() + MIN_START_DELAY
+            start_time = self.start_time.value
+        self.go_event.set()
+        return start_time
+
+    def is_running(self):
+        try:
+            return self.go_event.is_set() and not self.stop_event.is_set()
+        except Exception:
+            return False  # The event was torn down with the main process
+
+    def wait_for_stop(self, timeout=None):
+        """Returns True if stop() was called, False if the timeout ran out first"""
+        return self.stop_event.wait(timeout)
+
+    def stop(self):
+        self.stop_event.set()
+        # Wake anybody still waiting to start
+        self.go_event.set()
+        self.barrier.abort()
@@ -0,0 +1,61 @@
+import numpy as np
+
+from scripts.config import constants
+
+
+def create_task(backend=None, **kwargs):
+    """Creates a task on the configured DAQ backend.
+    Parameters:
+        backend: 'nidaqmx' for the NI card or 'simulated' for the software stand-in
+            in scripts.simulated_daq. Defaults to constants['daq_backend']
+    """
+    if backend is None:
+        backend = constants['daq_backend']
+    if backend == 'simulated':
+        from scripts import simulated_daq
+        return simulated_daq.SimulatedTask(**kwargs)
+    if backend == 'nidaqmx':
+        import nidaqmx
+        return nidaqmx.Task(**kwargs)
+    raise ValueError('Unknown DAQ backend: {}'.format(backend))
+
+
+def create_reader(task, raw=False):
+    """Creates a stream reader for a task's AI channels that fills preallocated, C-contiguous
+    (channels, samples) numpy arrays instead of returning lists.
+    Parameters:
+        raw: read unscaled int16 samples with read_int16() instead of float64 volts with
+            read_many_sample(). Use scaling_coefficients() to convert them to volts
+    """
+    from scripts import simulated_daq
+    if isinstance(task, simulated_daq.SimulatedTask):
+        return simulated_daq.SimulatedReader(task.in_stream)
+    from nidaqmx import stream_readers
+    if raw:
+        return stream_readers.AnalogUnscaledReader(task.in_stream)
+    return stream_readers.AnalogMultiChannelReader(task.in_stream)
+
+
+def scaling_coefficients(task):
+    """Returns a (channels, order + 1) array of the polynomial coefficients, lowest order first,
+    converting each AI channel's raw samples to volts
+    """
+    coefficients = [list(channel.ai_dev_scaling_coeff) for channel in task.ai_channels]
+    order = max(len(c) for c in coefficients)
+    return np.array([c + [0.0] * (order - len(c)) for c in coefficients], dtype=np.float64)
+
+
+def codes_to_volts(codes, coefficients, out=None):
+    """Converts a (channels, samples) block of ADC codes to volts.
+    Parameters:
+        coefficients: (channels, order + 1) polynomial coefficients, lowest order first, as
+            returned by scaling_coefficients()
+    """
+    if out is None:
+        out = np.empty(codes.shape, dtype=np.float64)
+    # Horner's method, highest order coefficient first
+    out[:] = coefficients[:, -1:]
+    for k in range(coefficients.shape[1] - 2, -1, -1):
+        out *= codes
+        out += coefficients[:, k:k + 1]
+    return out
@@ -0,0 +1,108 @@
+"""Runs the real microphone recording path (read_callback -> record_data -> mic_data_writer)
+against the simulated DAQ backend and reports how well it keeps up.
+
+Example: python -m scripts.daq_load_test 8 16 32 --duration 30 --speed 1
+"""
+import argparse
+from functools import partial
+import tempfile
+import time
+
+import numpy as np
+
+from scripts import microphone_input, shared_buffers, simulated_daq
+from scripts.config import constants
+
+
+def synchronous_callback(block_reader, data_writer, display_ring, *args):
+    # The old path, with all of the HDF5 work done inside the callback
+    microphone_input.record_data(block_reader, data_writer, display_ring)
+    return 0
+
+
+def run_trial(num_microphones, duration, speed, directory, synchronous=False, sample_rate=microphone_input.SAMPLE_RATE, raw=microphone_input.READ_RAW,
+        storage_dtype=microphone_input.STORAGE_DTYPE):
+    task = simulated_daq.SimulatedTask(speed=speed)
+    labels = ['ai{}'.format(i) for i in range(num_microphones)]
+    for label in labels:
+        task.ai_channels.add_ai_voltage_chan(label, name_to_assign_to_channel=label)
+    task.ai_channels.add_ai_voltage_chan('audio_ttl', 'audio_ttl_port')
+    task.ai_channels.add_ai_voltage_chan('cam_ttl', 'cam_ttl_port')
+    task.ai_channels.add_ai_voltage_chan('hsw_ttl', 'hsw_ttl_port')
+    task.timing.cfg_samp_clk_timing(rate=sample_rate, samps_per_chan=sample_rate * 5)
+
+    # Same ring buffer the recording process uses to feed the spectrogram display
+    display_ring = shared_buffers.SharedRingBuffer(num_microphones, 2 * sample_rate)
+    # int16 storage keeps the ADC codes, so it needs raw reads
+    block_reader = microphone_input.BlockReader(task, num_microphones + microphone_input.NUM_TTL_CHANNELS, raw=raw or storage_dtype == 'int16')
+    # mic_data_writer takes its lengths in minutes
+    data_writer = microphone_input.mic_data_writer(duration / 60, duration / 60, num_microphones, directory, labels,
+        storage_dtype=storage_dtype,
+        scaling_coefficients=block_reader.coefficients[:num_microphones] if storage_dtype == 'int16' else None)
+    if synchronous:
+        block_writer = None
+        callback = partial(synchronous_callback, block_reader, data_writer, display_ring)
+    else:
+        block_writer = microphone_input.BackgroundWriter(data_writer, display_ring, block_reader)
+        callback = partial(microphone_input.read_callback, block_writer)
+    task.register_every_n_samples_acquired_into_buffer_event(
+        sample_interval=microphone_input.SAMPLE_INTERVAL,
+        callback_method=callback)
+
+    start = time.perf_counter()
+    task.start()
+    try:
+        while task.samples_read < duration * sample_rate and not task.overflowed:
+            time.sleep(0.1)
+    finally:
+        task.stop()
+        if block_writer is not None:
+            block_writer.close()
+        elapsed = time.perf_counter() - start
+        data_writer.close()
+        display_ring.close()
+        display_ring.unlink()
+
+    durations = np.array(task.callback_durations) * 1000
+    return {
+        'channels': num_microphones,
+        'callbacks': len(durations),
+        'callback_mean_ms': float(np.mean(durations)) if len(durations) else 0.0,
+        'callback_p99_ms': float(np.percentile(durations, 99)) if len(durations) else 0.0,
+        'callback_max_ms': float(np.max(durations)) if len(durations) else 0.0,
+        'max_backlog_fraction': task.max_backlog / task.buffer_size,
+        'realtime_factor': task.samples_read / sample_rate / elapsed,
+        'overflowed': task.overflowed,
+        'writer_high_water_mark': block_writer.high_water_mark if block_writer is not None else 0,
+        'writer_pool_misses': block_writer.pool_misses if block_writer is not None else 0,
+    }
+
+
+def command_line_demo():
+    parser = argparse.ArgumentParser(description='Load test the microphone recording path with a simulated DAQ')
+    parser.add_argument('channels', type=int, nargs='+', help='Microphone channel counts to test')
+    parser.add_argument('--duration', type=float, default=30, help='Length of each trial, in simulated seconds')
+    parser.add_argument('--speed', type=float, default=1, help='Simulated clock speed relative to real time. 0 runs as fast as possible')
+    parser.add_argument('--synchronous', action='store_true', help='Write to disk inside the callback instead of on the writer thread')
+    parser.add_argument('--raw', action='store_true', help='Read unscaled int16 samples instead of float64 volts')
+    parser.add_argument('--int16', action='store_true', help='Store the raw int16 ADC codes instead of float32 volts')
+    parser.add_argument('--directory', type=str, default=None, help='Where to write the HDF5 files. Defaults to a temporary directory')
+    args = parser.parse_args()
+
+    read_period_ms = constants['microphone_data_retrieval_interval'] * 1000
+    print('Read cycle period: {:.0f}ms'.format(read_period_ms))
+    for num_channels in args.channels:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            result = run_trial(num_channels, args.duration, args.speed, args.directory or tmp_dir, args.synchronous, raw=args.raw,
+                storage_dtype='int16' if args.int16 else 'float32')
+        print('{channels:>3} channels: {callbacks} callbacks, mean {callback_mean_ms:.1f}ms, '
+              'p99 {callback_p99_ms:.1f}ms, max {callback_max_ms:.1f}ms, '
+              'peak buffer use {max_backlog_fraction:.0%}, {realtime_factor:.2f}x real time'.format(**result))
+        if not args.synchronous:
+            print('    writer backlog peak {writer_high_water_mark} blocks, {writer_pool_misses} pool misses'.format(**result))
+        if result['overflowed']:
+            print('    DAQ buffer overflowed')
+
+
+if __name__ == '__main__':
+    command_line_demo()
@@ -0,0 +1,113 @@
+"""Schmitt-trigger edge detection for the TTL channels recorded alongside the microphones.
+
+Every TTL channel is run through the same detector: a channel only goes high once it rises
+above its high threshold and only goes low once it drops below its low threshold, so noise
+around a single threshold can't produce extra edges. The state of each channel is carried
+from one block to the next, so an edge is reported exactly once no matter where the block
+boundaries fall, and a pulse that spans several blocks is paired up once it ends.
+
+Edges are reported as absolute sample indices: the index of the first sample past the threshold,
+counted from the first sample the detector was given.
+"""
+import numpy as np
+
+
+class PulseBuffer:
+    """Preallocated (n, 2) int64 array of (rising, falling) pairs, grown only when a block
+    holds more pulses than ever before
+    """
+    def __init__(self, capacity=64):
+        self.array = np.empty((capacity, 2), dtype=np.int64)
+
+    def fill(self, rising, falling):
+        """Returns a view of the buffer holding the pairs. Only valid until the next call"""
+        count = len(rising)
+        if count > len(self.array):
+            self.array = np.empty((max(count, 2 * len(self.array)), 2), dtype=np.int64)
+        pulses = self.array[:count]
+        pulses[:, 0] = rising
+        pulses[:, 1] = falling
+        return pulses
+
+
+class EdgeDetector:
+    """Finds the rising and falling edges of several TTL channels in one vectorised pass.
+
+    Parameters:
+        thresholds: list of (low, high) voltage pairs, one per channel
+        initial_state: list of booleans, whether each channel is considered high before the
+            first sample. Defaults to low for every channel
+    """
+    def __init__(self, thresholds, initial_state=None):
+        thresholds = np.asarray(thresholds, dtype=np.float64).reshape((-1, 2))
+        if np.any(thresholds[:, 0] > thresholds[:, 1]):
+            raise ValueError('TTL low thresholds must not exceed the high thresholds')
+        self.num_channels = len(thresholds)
+        self.low = thresholds[:, :1]
+        self.high = thresholds[:, 1:]
+        if initial_state is None:
+            self.state = np.zeros(self.num_channels, dtype=bool)
+        else:
+            self.state = np.array(initial_state, dtype=bool)
+        # Rising edge of the pulse still in progress on each channel, -1 if there is none
+        self.pending_rising = np.full(self.num_channels, -1, dtype=np.int64)
+        self.sample_offset = 0
+        self.pulse_buffers = [PulseBuffer() for _ in range(self.num_channels)]
+
+    def process(self, block):
+        """Finds the edges in a (channels, samples) block that directly follows the previous one.
+        Returns a list with a (rising, falling) pair of int64 index arrays for each channel
+        """
+        block = np.asarray(block)
+        above = block > self.high
+        decided = above | (block < self.low)
+        # Between the thresholds a channel keeps its previous state, so only samples outside
+        # them can change it. np.nonzero walks the block row by row
+        channel, sample = np.nonzero(decided)
+        value = above[channel, sample]
+
+        # The value each decided sample is compared to: the previous decided sample in the same
+        # row, or the state carried over from the last block for the first one in a row
+        previous = np.empty_like(value)
+        previous[1:] = value[:-1]
+        row_start = np.ones(len(channel), dtype=bool)
+        row_start[1:] = channel[1:] != channel[:-1]
+        previous[row_start] = self.state[channel[row_start]]
+        changed = value != previous
+
+        edge_channel = channel[changed]
+        edge_sample = sample[changed].astype(np.int64) + self.sample_offset
+        edge_rising = value[changed]
+
+        # Rows are contiguous in the output of np.nonzero
+        bounds = np.searchsorted(edge_channel, np.arange(self.num_channels + 1))
+        edges = list()
+        for c in range(self.num_channels):
+            rows = slice(bounds[c], bounds[c + 1])
+            edges.append((edge_sample[rows][edge_rising[rows]], edge_sample[rows][~edge_rising[rows]]))
+
+        # The state of a row is the value of its last decided sample
+        row_end = np.ones(len(channel), dtype=bool)
+        row_end[:-1] = channel[1:] != channel[:-1]
+        self.state[channel[row_end]] = value[row_end]
+        self.sample_offset += block.shape[1]
+        return edges
+
+    def pulses(self, c, rising, falling):
+        """Pairs the edges found on channel c by process() into complete pulses.
+        A pulse still high at the end of the block is held until its falling edge arrives.
+        Returns a view of an (n, 2) int64 array of (rising, falling) sample indices
+        """
+        # The hysteresis guarantees edges alternate, so pairing is just a matter of lining them up
+        if len(falling) and (not len(rising) or falling[0] < rising[0]):
+            # This block finishes a pulse that started earlier
+            if self.pending_rising[c] >= 0:
+                rising = np.concatenate(([self.pending_rising[c]], rising))
+            else:
+                falling = falling[1:]  # The channel was already high when recording started
+            self.pending_rising[c] = -1
+        if len(rising) > len(falling):
+            # The last pulse is still going
+            self.pending_rising[c] = rising[-1]
+            rising = rising[:-1]
+        return self.pulse_buffers[c].fill(rising, falling)
@@ -6,14 +6,14 @@ import os
 from os import path
 from multiprocessing import Process
 import queue
+import threading
 import time
 
-import nidaqmx as nidaq
-from nidaqmx.constants import READ_ALL_AVAILABLE
 from nidaqmx.constants import AcquisitionType
 import numpy as np
 import tables
 
+from scripts import audio_file, daq_backend, edge_detection, session_manifest
 from scripts.config import constants
 
 
@@ -21,16 +21,42 @@ from scripts.config import constants
 SAMPLE_RATE = constants['microphone_sample_rate']  # Hz
 READ_CYCLE_PERIOD = constants['microphone_data_retrieval_interval']  # Amount of time (sec) between each read from the buffer
 SAMPLE_INTERVAL = int(SAMPLE_RATE * READ_CYCLE_PERIOD)
+STORAGE_LAYOUT = constants['microphone_storage_layout']
+COMPRESSION = constants['microphone_compression']
+COMPRESSION_LEVEL = constants['microphone_compression_level']
+TARGET_CHUNK_BYTES = 1 << 20  # Keeps a chunk within the default HDF5 chunk cache
+WRITER_POOL_SIZE = constants['microphone_writer_pool_size']
+READ_RAW = constants['microphone_read_raw']
+STORAGE_DTYPE = constants['microphone_storage_dtype']
+PARTIAL_SUFFIX = '.partial'  # Added to the name of the next epoch's file until it's in use
+# (low, high) Schmitt trigger thresholds, in the order the TTL channels are added to the task
+TTL_THRESHOLDS = [constants['audio_ttl_thresholds'], constants['cam_ttl_thresholds'], constants['hsw_ttl_thresholds']]
+NUM_TTL_CHANNELS = len(TTL_THRESHOLDS)
 
 
 class mic_data_writer():
-    def __init__(self, total_length, epoch_length, num_microphones, directory, identity_list, infinite=False, sample_rate=SAMPLE_RATE, enforced_filename=None):
+    def __init__(self, total_length, epoch_length, num_microphones, directory, identity_list, infinite=False, sample_rate=SAMPLE_RATE, enforced_filename=None,
+            storage_layout=STORAGE_LAYOUT, compression=COMPRESSION, compression_level=COMPRESSION_LEVEL, ttl_thresholds=TTL_THRESHOLDS,
+            storage_dtype=STORAGE_DTYPE, scaling_coefficients=None):
         """Parameters:
             length: the length of each file, in minutes
             filename_format: a string used to determine the filename, with {} in
                 place of the file's index (for long recordings)
             directory: the directory in which the files should be created
+            storage_layout: 'channels' for one EArray per channel under /ai_channels,
+                'interleaved' for a single (samples, channels) EArray at /ai_data
+            compression: an HDF5 compression library name (e.g. 'blosc:lz4'), or None
+            ttl_thresholds: (low, high) voltage thresholds for the audio, camera and ephys TTL channels
+            storage_dtype: 'float32' to store volts, 'int16' to store the raw ADC codes passed to write()
+            scaling_coefficients: (channels, order + 1) polynomial coefficients converting each microphone's
+                ADC codes to volts, lowest order first. Required for int16 storage and ignored otherwise
         """
+        if storage_layout not in ('channels', 'interleaved'):
+            raise ValueError('Unknown microphone storage layout: {}'.format(storage_layout))
+        if storage_dtype not in ('float32', 'int16'):
+            raise ValueError('Unknown microphone storage dtype: {}'.format(storage_dtype))
+        if storage_dtype == 'int16' and scaling_coefficients is None:
+            raise ValueError('int16 microphone storage needs the scaling coefficients of each channel')
         # TODO: Change filename format, re-add filename format function
         self.target_num_samples = int(epoch_length * 60 * sample_rate)
         self.total_num_samples = int(total_length * 60 * sample_rate)
@@ -40,21 +66,36 @@ class mic_data_writer():
         self.directory = directory
         self.enforced_filename = enforced_filename
         self.array_labels = identity_list
+        self.storage_layout = storage_layout
+        self.storage_dtype = storage_dtype
+        # Only int16 files hold codes. Float32 files hold volts already, so they get no scaling attributes
+        self.scaling_coefficients = None
+        if storage_dtype == 'int16':
+            self.scaling_coefficients = np.asarray(scaling_coefficients, dtype=np.float64)
+        self.filters = None
+        if compression is not None:
+            self.filters = tables.Filters(complevel=compression_level, complib=compression, shuffle=True)
         
         self.infinite = infinite
+        self.sample_rate = sample_rate
         self.file_counter = 0
         self.present_num_samples = 0
         self.no_epoch_num_samples = 0
+
+        # Global sample index of the next sample and of the first sample in the current file, for the session manifest
+        self.samples_written = 0
+        self.file_start_sample = 0
+        self.file_pulse_counts = None
+        self.manifest = session_manifest.ManifestWriter(directory, 'mic')
         
-        self.ephys_rising_edge = 0
-        self.saved_rising = False
-        self.ephys_falling_edge = 0
-        self.saved_falling = False
-        
-        self.cam_accumulator = 0
-        self.temp_rising = None
-        
+        # Edge state for the TTL channels, carried across blocks and files
+        self.ttl_detector = edge_detection.EdgeDetector(ttl_thresholds)
+
         self.current_file = None
+        # Path of the next epoch's file, created ahead of time under a temporary name, and full files
+        # waiting to be closed. See idle()
+        self.next_file = None
+        self.files_to_close = list()
         self.generate_new_file()
 
     def __enter__(self):
@@ -63,48 +104,40 @@ class mic_data_writer():
     def __exit__(self, type, value, traceback):
         self.close()
 
-    def increment_ephys_trigger(self, n, rising=True):
-        if rising:
-            self.ephys_rising_edge += n
-        else:
-            self.ephys_falling_edge += n
-
-    def increment_cam_accumulator(self, n):
-        self.cam_accumulator += n
-
-    def save_ephys_trigger_sample(self, rising=True):
-        if rising:
-            if self.saved_rising:
-                return
-            self.saved_rising = True
-            self.trig_array.append(np.array([self.ephys_rising_edge], dtype=int))
-            # self.tables_array.attrs.ephys_trigger_rising_edge = self.ephys_rising_edge
-        else:
-            if self.saved_falling:
-                return
-            self.saved_falling = True
-            # self.tables_array.attrs.ephys_trigger_falling_edge = self.ephys_falling_edge
-
     def close(self):
         if self.current_file is not None:
-            self.current_file.close()
+            self.files_to_close.append((self.current_file, self.manifest_entry()))
+            self.current_file = None
+        self.close_finished_files()
+        if self.next_file is not None:
+            # Prepared for an epoch that is not going to happen
+            if path.exists(self.next_file + PARTIAL_SUFFIX):
+                os.remove(self.next_file + PARTIAL_SUFFIX)
+            self.next_file = None
+
+    def append_block(self, data):
+        self.samples_written += data.shape[1]
+        if self.storage_layout == 'interleaved':
+            # One append (and one set of chunk writes) for every channel at once
+            self.data_array.append(data.T)
+        else:
+            for i in range(data.shape[0]):
+                self.arrays[i].append(data[i])
 
     def write(self, data):
-        if self.arrays is None:
+        if self.current_file is None:
             return
 
         remainder = None
         if self.present_num_samples + data.shape[1] > self.target_num_samples:
             to_add = self.target_num_samples - self.present_num_samples
-            for i in range(data.shape[0]):
-                self.arrays[i].append(data[i, :to_add])
+            self.append_block(data[:, :to_add])
             remainder = data[:, to_add:]
             if not self.infinite:
                 self.present_num_samples = self.target_num_samples
                 self.no_epoch_num_samples += to_add
         else:
-            for i in range(data.shape[0]):
-                self.arrays[i].append(data[i])
+            self.append_block(data)
             if not self.infinite:
                 self.present_num_samples += data.shape[1]
                 self.no_epoch_num_samples += data.shape[1]
@@ -119,165 +152,410 @@ class mic_data_writer():
     def write_pulses(self, data):
         if self.cam_array is not None:
             self.cam_array.append(data)
+            self.file_pulse_counts['camera_pulses'] += len(data)
+
+    def write_ephys_edges(self, rising, falling):
+        if self.trig_array is not None:
+            self.trig_array.append(rising)
+            self.trig_falling_array.append(falling)
+            self.file_pulse_counts['ephys_triggers'] += len(rising)
 
     def write_audio_pulses(self, data):
         if self.audio_array is not None:
             self.audio_array.append(data)
+            self.file_pulse_counts['audio_pulses'] += len(data)
         print(data)
 
+    def set_scaling_attrs(self, array, coefficients):
+        """Records how to convert the stored codes to volts: volts = offset + scale * code, plus
+        the full device polynomial (lowest order first) in case it has higher order terms.
+        Per-channel arrays get scalars, the interleaved array gets one value per column
+        """
+        array.attrs.offset = coefficients[..., 0]
+        array.attrs.scale = coefficients[..., 1]
+        array.attrs.scaling_coefficients = coefficients
+
+    def file_path(self, start_time):
+        if self.enforced_filename is None:
+            return path.join(self.directory, 'mic_{}.h5'.format(start_time.strftime('%Y_%m_%d_%H_%M_%S_%f')))
+        filepath = path.join(self.directory, 'mic_{}.h5'.format(self.enforced_filename))
+        self.enforced_filename = None
+        return filepath
+
+    def needs_another_file(self):
+        """Whether another file will be started once the current one is full"""
+        remaining_in_file = self.target_num_samples - self.present_num_samples
+        return not self.infinite and self.no_epoch_num_samples + remaining_in_file < self.total_num_samples
+
+    def prepare_next_file(self):
+        """Creates the next epoch's file ahead of time, named after the time it is expected to start.
+        Until the epoch starts it is closed and has PARTIAL_SUFFIX on its name, so a recording that
+        dies before then doesn't leave an empty mic_*.h5 file behind
+        """
+        if self.next_file is not None or self.current_file is None or not self.needs_another_file():
+            return
+        remaining = (self.target_num_samples - self.present_num_samples) / self.sample_rate
+        expected_start = datetime.datetime.now() + datetime.timedelta(seconds=remaining)
+        filepath = self.file_path(expected_start)
+        self.create_file(filepath + PARTIAL_SUFFIX).h5file.close()
+        self.next_file = filepath
+
+    def idle(self):
+        """Housekeeping that would otherwise happen at the epoch boundary. PyTables is not
+        thread-safe, so this has to run on the thread that writes, while no blocks are waiting
+        """
+        self.close_finished_files()
+        self.prepare_next_file()
+
+    def close_finished_files(self):
+        while self.files_to_close:
+            h5file, entry = self.files_to_close.pop(0)
+            h5file.close()
+            # Only listed in the manifest once everything is on disk
+            self.manifest.add_epoch(**entry)
+
+    def manifest_entry(self):
+        entry = dict(path=self.current_file.filename, start=self.file_start_sample, end=self.samples_written, unit='sample', rate=self.sample_rate)
+        entry.update(self.file_pulse_counts)
+        return entry
+
     def generate_new_file(self):
         # None check to prevent errors on creation of the very first file
         if self.current_file is not None:
-            self.current_file.close()
+            # Flushed and closed later by idle(), or by close()
+            self.files_to_close.append((self.current_file, self.manifest_entry()))
 
         if self.no_epoch_num_samples >= self.total_num_samples:
-            self.current_file = None
-            self.arrays = None
-            self.cam_array = None
+            self.use_file(None)
             return
 
-        if not path.exists(self.directory):
-        	os.mkdir(self.directory)
-
-        if self.enforced_filename is None:
-            filepath = path.join(self.directory, 'mic_{}.h5'.format(datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f')))
+        if self.next_file is not None:
+            # Normally prepared during the previous epoch, so the boundary only renames and opens it.
+            # Windows can't rename an open file, hence closing and reopening it
+            os.replace(self.next_file + PARTIAL_SUFFIX, self.next_file)
+            self.use_file(MicFile.open(self.next_file))
+            self.next_file = None
         else:
-            filepath = path.join(self.directory, 'mic_{}.h5'.format(self.enforced_filename))
-            self.enforced_filename = None
+            self.use_file(self.create_file(self.file_path(datetime.datetime.now())))
+
+        # Update necessary values
+        self.file_counter += 1
+        self.present_num_samples = 0
+        self.file_start_sample = self.samples_written
+        self.file_pulse_counts = {'camera_pulses': 0, 'audio_pulses': 0, 'ephys_triggers': 0}
+
+    def use_file(self, mic_file):
+        """Sends all subsequent writes to mic_file (a MicFile), or nowhere if it is None"""
+        self.current_file = None if mic_file is None else mic_file.h5file
+        for name in MicFile.ARRAY_NAMES:
+            setattr(self, name, None if mic_file is None else getattr(mic_file, name))
 
-        self.current_file = tables.open_file(filepath, 'w')
+    def create_file(self, filepath):
+        if not path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+
+        mic_file = MicFile(tables.open_file(filepath, 'w'))
+        h5file = mic_file.h5file
 
-        # Create the analog_channels group to keep everything organized
-        ai_group = self.current_file.create_group(self.current_file.root, 'ai_channels')
         # NEW (2021-09-21): dump the config dictionary into an attribute of the table
-        self.current_file.create_array(
+        h5file.create_array(
             '/',
             'config',
             np.array(json.dumps({k: v for k, v in constants.items() if 'color' not in k})))
 
         # Create an expandable array for analog input
-        float_atom = tables.Float32Atom()
-        self.arrays = list()
-        for channel_name in self.array_labels:
-            # Arrays are added here in the order in which they appear in port_list, which is also the order in which they are created,
-            # Which means the data received will also be in this order
-            self.arrays.append(
-                self.current_file.create_earray(
-                    ai_group,
-                    channel_name,
-                    float_atom,
-                    (0,),
-                    expectedrows=self.target_num_samples))
-
-
-        int_atom = tables.Int32Atom()
-        self.cam_array = self.current_file.create_earray(
-            self.current_file.root,
+        sample_atom = tables.Int16Atom() if self.storage_dtype == 'int16' else tables.Float32Atom()
+        if self.storage_layout == 'interleaved':
+            num_channels = len(self.array_labels)
+            mic_file.data_array = h5file.create_earray(
+                h5file.root,
+                'ai_data',
+                sample_atom,
+                (0, num_channels),
+                expectedrows=self.target_num_samples,
+                chunkshape=(interleaved_chunk_length(num_channels, sample_atom.itemsize), num_channels),
+                filters=self.filters)
+            # Column i holds the channel named channel_names[i]
+            mic_file.data_array.attrs.channel_names = list(self.array_labels)
+            if self.scaling_coefficients is not None:
+                self.set_scaling_attrs(mic_file.data_array, self.scaling_coefficients)
+        else:
+            # Create the analog_channels group to keep everything organized
+            ai_group = h5file.create_group(h5file.root, 'ai_channels')
+            # Nodes of a group list alphabetically, so keep the order the channels were recorded in
+            ai_group._v_attrs.channel_names = list(self.array_labels)
+            for i, channel_name in enumerate(self.array_labels):
+                # Arrays are added here in the order in which they appear in port_list, which is also the order in which they are created,
+                # Which means the data received will also be in this order
+                mic_file.arrays.append(
+                    h5file.create_earray(
+                        ai_group,
+                        channel_name,
+                        sample_atom,
+                        (0,),
+                        expectedrows=self.target_num_samples,
+                        filters=self.filters))
+                if self.scaling_coefficients is not None:
+                    self.set_scaling_attrs(mic_file.arrays[-1], self.scaling_coefficients[i])
+
+
+        # Sample indices count from the start of the session, which overflows 32 bits after 4.7 hours at 125kHz
+        int_atom = tables.Int64Atom()
+        mic_file.cam_array = h5file.create_earray(
+            h5file.root,
             'camera_frames',
             int_atom,
             (0,),
             expectedrows=self.target_num_samples // 125000 * 30)
 
-        self.trig_array = self.current_file.create_earray(
-            self.current_file.root,
+        mic_file.trig_array = h5file.create_earray(
+            h5file.root,
             'ephys_trigger',
             int_atom,
             (0,),
             expectedrows=2
         )
 
-        self.audio_array = self.current_file.create_earray(
-            self.current_file.root,
+        mic_file.trig_falling_array = h5file.create_earray(
+            h5file.root,
+            'ephys_trigger_falling',
+            int_atom,
+            (0,),
+            expectedrows=2
+        )
+
+        mic_file.audio_array = h5file.create_earray(
+            h5file.root,
             'audio_onset',
             int_atom,
             (0, 2),  # Saves the falling edge and the length of the pulse in ms
             expectedrows=30
         )
+        return mic_file
 
-        # Update necessary values
-        self.file_counter += 1
-        self.present_num_samples = 0
 
+class MicFile:
+    """An open mic_*.h5 file along with the arrays mic_data_writer writes to"""
+    ARRAY_NAMES = ('arrays', 'data_array', 'cam_array', 'trig_array', 'trig_falling_array', 'audio_array')
 
-
-def record_data(task_obj, data_writer, fft_queue):
-    data = np.array(task_obj.read(
-        number_of_samples_per_channel=READ_ALL_AVAILABLE,
-        timeout=0)).reshape((data_writer.num_microphones + 3, -1))  # +3 for all of the ttl-reading channels
-    trigger_location = 0
-    if np.max(data[-1]) > 3 and not data_writer.saved_rising:
-        # The ttl trigger was hit
-        trigger_location = np.argmax(np.diff(data[-1]))
-        # The falling edge must lie beyond the rising edge
-        data_writer.increment_ephys_trigger(data_writer.ephys_rising_edge, rising=False)
-        data_writer.increment_ephys_trigger(trigger_location, rising=True)
-        data_writer.save_ephys_trigger_sample(rising=True)
-        # See if the falling edge occured in the same block of data
-        if np.min(data[-1, trigger_location:]) < 3:
-            loc = np.argmin(np.diff(data[-1]))
-            data_writer.increment_ephys_trigger(loc, rising=False)
-            data_writer.save_ephys_trigger_sample(rising=False)
+    def __init__(self, h5file):
+        self.h5file = h5file
+        self.arrays = list()
+        self.data_array = None
+        self.cam_array = None
+        self.trig_array = None
+        self.trig_falling_array = None
+        self.audio_array = None
+
+    @classmethod
+    def open(cls, filepath):
+        """Opens a file made by mic_data_writer.create_file to append to it"""
+        mic_file = cls(tables.open_file(filepath, 'a'))
+        root = mic_file.h5file.root
+        if '/ai_data' in mic_file.h5file:
+            mic_file.data_array = root.ai_data
         else:
-            data_writer.increment_ephys_trigger(data.shape[1], rising=False)
-    else:
-        data_writer.increment_ephys_trigger(data.shape[1], rising=True)
-    # See if the falling edge occured in a different block
-    if data_writer.saved_rising and not data_writer.saved_falling:
-        if np.min(data[-1]) < 3:
-            loc =  np.argmin(np.diff(data[-1]))
-            data_writer.increment_ephys_trigger(loc, rising=False)
-            data_writer.save_ephys_trigger_sample(rising=False)
+            mic_file.arrays = audio_file.channel_arrays(mic_file.h5file)
+        mic_file.cam_array = root.camera_frames
+        mic_file.trig_array = root.ephys_trigger
+        mic_file.trig_falling_array = root.ephys_trigger_falling
+        mic_file.audio_array = root.audio_onset
+        return mic_file
+
+
+def interleaved_chunk_length(num_channels, itemsize, block_length=SAMPLE_INTERVAL):
+    """Number of rows per chunk for the interleaved layout. Each read cycle's block is split
+    into a whole number of chunks no larger than TARGET_CHUNK_BYTES, so one append fills
+    complete chunks instead of leaving a partial chunk to be rewritten by the next block
+    """
+    block_bytes = block_length * num_channels * itemsize
+    chunks_per_block = max(1, -(-block_bytes // TARGET_CHUNK_BYTES))
+    return max(1, -(-block_length // chunks_per_block))
+
+
+
+class BlockReader:
+    """Reads everything available in the DAQ buffer straight into a preallocated, C-contiguous
+    numpy array through an nidaqmx stream reader, instead of building a list of Python floats
+    for every sample.
+
+    Parameters:
+        raw: read unscaled int16 samples, which halves the size of every read compared to
+            float64 volts. to_volts() applies the device scaling polynomial afterwards
+    """
+    def __init__(self, task_obj, num_channels, raw=READ_RAW):
+        self.task_obj = task_obj
+        self.num_channels = num_channels
+        self.raw = raw
+        self.dtype = np.dtype(np.int16 if raw else np.float64)
+        self.stream_reader = daq_backend.create_reader(task_obj, raw=raw)
+        self.coefficients = None
+        if raw:
+            self.coefficients = daq_backend.scaling_coefficients(task_obj)
+
+    def allocate(self, num_samples):
+        return np.empty(self.num_channels * num_samples, dtype=self.dtype)
+
+    def available(self):
+        return self.task_obj.in_stream.avail_samp_per_chan
+
+    def read_into(self, storage, num_samples):
+        """Reads num_samples per channel into the flat array storage and returns them as a
+        (channels, samples) view of it. The view is contiguous, as the stream readers require
+        """
+        block = storage[:self.num_channels * num_samples].reshape((self.num_channels, num_samples))
+        if self.raw:
+            num_read = self.stream_reader.read_int16(block, number_of_samples_per_channel=num_samples, timeout=0)
         else:
-            data_writer.increment_ephys_trigger(data.shape[1], rising=False)
-
-    # Camera rising edge stuff
-    cam_rising = np.flatnonzero((data[-2,1:] > 1) & (data[-2,:-1] < 1)) + 1 + data_writer.cam_accumulator
-    if len(cam_rising) > 0:
-        data_writer.write_pulses(cam_rising)
+            num_read = self.stream_reader.read_many_sample(block, number_of_samples_per_channel=num_samples, timeout=0)
+        return block[:, :num_read]
+
+    def to_volts(self, block, out=None):
+        """Scales a block of samples to volts. Blocks that are already in volts are returned as they are"""
+        if not self.raw:
+            return block
+        if out is None:
+            out = np.empty(block.shape, dtype=np.float64)
+        return daq_backend.codes_to_volts(block, self.coefficients, out)
+
+
+class BackgroundWriter:
+    """Moves all of the HDF5 work out of the DAQ callback. The callback only reads each block
+    straight into a buffer from a preallocated pool and queues it; a dedicated thread runs
+    process_data on the queued blocks (including epoch rollover) and returns the buffers to the pool.
+    Whenever the queue empties, the data writer gets to create its next file and close old
+    ones, so the epoch boundary itself only swaps files.
+
+    occupancy is the number of blocks waiting to be written and high_water_mark the largest
+    occupancy seen so far. If the pool runs dry a new buffer is allocated rather than
+    dropping data, and pool_misses is incremented.
+    """
+    def __init__(self, data_writer, display_ring, block_reader, pool_size=WRITER_POOL_SIZE, block_capacity=2 * SAMPLE_INTERVAL):
+        self.data_writer = data_writer
+        self.display_ring = display_ring
+        self.block_reader = block_reader
+        self.num_channels = block_reader.num_channels
+        self.block_capacity = block_capacity
+        self.pool_size = pool_size
+
+        self.free_buffers = queue.Queue()
+        for _ in range(pool_size):
+            self.free_buffers.put(block_reader.allocate(block_capacity))
+        self.pending = queue.Queue()
+        # Raw blocks are scaled into this on the writer thread
+        self.volts = np.empty((self.num_channels, block_capacity), dtype=np.float64)
+
+        # Only the callback thread writes high_water_mark
+        self.high_water_mark = 0
+        self.pool_misses = 0
+        self.blocks_written = 0
+        self.blocks_failed = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def read_available(self):
+        num_samples = self.block_reader.available()
+        if num_samples == 0:
+            return
+        try:
+            buffer = self.free_buffers.get_nowait()
+        except queue.Empty:
+            buffer = None
+        if buffer is None or len(buffer) < self.num_channels * num_samples:
+            if buffer is None:
+                self.pool_misses += 1
+            buffer = self.block_reader.allocate(max(num_samples, self.block_capacity))
+        block = self.block_reader.read_into(buffer, num_samples)
+        self.pending.put((buffer, block))
+        self.high_water_mark = max(self.high_water_mark, self.pending.qsize())
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            buffer, block = item
+            try:
+                if block.shape[1] > self.volts.shape[1]:
+                    self.volts = np.empty(block.shape, dtype=np.float64)
+                data = self.block_reader.to_volts(block, self.volts[:, :block.shape[1]])
+                process_data(data, self.data_writer, self.display_ring, block if self.block_reader.raw else None)
+                if self.pending.empty():
+                    # Nothing else is waiting, so this is the time to open or close files
+                    self.data_writer.idle()
+            except Exception as e:
+                # Keep draining the queue so the callback never blocks, but remember what went wrong
+                print('Microphone writer error: {}'.format(e))
+                self.error = e
+                self.blocks_failed += 1
+            else:
+                self.blocks_written += 1
+            self.free_buffers.put(buffer)
+
+    def stats(self):
+        return {
+            'occupancy': self.pending.qsize(),
+            'high_water_mark': self.high_water_mark,
+            'high_water_seconds': self.high_water_mark * READ_CYCLE_PERIOD,
+            'pool_size': self.pool_size,
+            'pool_misses': self.pool_misses,
+            'blocks_written': self.blocks_written,
+            'blocks_failed': self.blocks_failed,
+        }
 
-    
-    # Audio rising and falling edge stuff
-    audio_rising = np.flatnonzero((data[-3, :-1] < 2) & (data[-3, 1:] > 2)) + data_writer.cam_accumulator
-    audio_falling = np.flatnonzero((data[-3, :-1] > 2) & (data[-3, 1:] < 2)) + data_writer.cam_accumulator
-
-    if data_writer.temp_rising is not None:
-        audio_rising = np.insert(audio_rising, 0, data_writer.temp_rising)
-        data_writer.temp_rising = None
-
-    # Check for edge cases
-    # Case 1: the rising edge is cut off and there is no temp rising, so n_falling > n_rising
-    if len(audio_falling) > len(audio_rising):
-        audio_falling = audio_falling[1:]
-    # Case 2: the falling edge is cut off, so it appears in the next frame and  n_rising > n_falling
-    elif len(audio_rising) > len(audio_falling):
-        data_writer.temp_rising = audio_rising[-1]
-        audio_rising = audio_rising[:-1]
+    def close(self):
+        """Writes any blocks still in the queue and stops the thread"""
+        self.pending.put(None)
+        self.thread.join()
+
+
+def record_data(block_reader, data_writer, display_ring):
+    # Reads everything available into a newly allocated block
+    num_samples = block_reader.available()
+    block = block_reader.read_into(block_reader.allocate(num_samples), num_samples)
+    process_data(block_reader.to_volts(block), data_writer, display_ring, block if block_reader.raw else None)
+    data_writer.idle()
+
+
+def process_data(data, data_writer, display_ring, raw=None):
+    """Parameters:
+        data: (channels, samples) block in volts, microphones first and the TTL channels last
+        raw: the same block as int16 ADC codes if it was read raw, otherwise None
+    """
+    # All of the TTL channels go through the detector in a single pass
+    audio_edges, cam_edges, ephys_edges = data_writer.ttl_detector.process(data[-NUM_TTL_CHANNELS:])
+
+    # Every ephys trigger, both edges
+    if len(ephys_edges[0]) or len(ephys_edges[1]):
+        data_writer.write_ephys_edges(*ephys_edges)
+
+    # Camera frames are marked by their rising edge
+    if len(cam_edges[0]) > 0:
+        data_writer.write_pulses(cam_edges[0])
+
+    # Audio pulses are saved as their falling edge and their length in ms
+    audio_pulses = data_writer.ttl_detector.pulses(0, *audio_edges)
+    if len(audio_pulses) > 0:
+        audio_pulses[:, 0] = (audio_pulses[:, 1] - audio_pulses[:, 0]) * 1000 // SAMPLE_RATE
+        data_writer.write_audio_pulses(audio_pulses[:, ::-1])
+
+    if data_writer.storage_dtype == 'int16':
+        # Store the codes exactly as the ADC produced them, volts are only needed for the TTLs and the display
+        data_writer.write(raw[:data_writer.num_microphones])
     else:
-    # Case 3: the wave is fully contained in this block, wipe the rising edge
-        data_writer.temp_rising = None
-    
-    if len(audio_rising) == len(audio_falling) and len(audio_rising) > 0:
-        np_pulses = np.array([[falling, (falling - rising) * 1000 // SAMPLE_RATE] for rising, falling in zip(audio_rising, audio_falling)], dtype=int)
-        data_writer.write_audio_pulses(np_pulses)
-    
-    data_writer.increment_cam_accumulator(data.shape[1])
-    data_writer.write(data[:data_writer.num_microphones])
-    if fft_queue is not None:
-        try:
-            # Ensure the input has more than one dimension so the output doesn't end up scalar
-            fft_queue.put(np.reshape(data[:data_writer.num_microphones], (data_writer.num_microphones, -1)), False)
-        except Exception:
-            pass
+        data_writer.write(data[:data_writer.num_microphones])
+    if display_ring is not None:
+        display_ring.write(data[:data_writer.num_microphones])
 
 
-def read_callback(task_obj,
-        data_writer,
-        fft_queue,
+def read_callback(block_writer,
         task_handle,
         every_n_samples_event_type,
         number_of_samples,
         callback_data):
-    record_data(task_obj, data_writer, fft_queue)
+    block_writer.read_available()
     return 0
 
 
@@ -291,7 +569,7 @@ class MicrophoneRecorder:
         self.init_task()
 
     def init_task(self):
-        self.microphone_task = nidaq.Task()
+        self.microphone_task = daq_backend.create_task()
 
     def __enter__(self):
         return self.microphone_task
@@ -300,8 +578,12 @@ class MicrophoneRecorder:
         self.microphone_task.close()
 
 
-def record(directory, filename, acq_started, acq_start_time, port_list, name_list, duration, epoch_len, fft_queue, audio_ttl_port, cam_ttl_port, hsw_ttl_port):
-    task = nidaq.Task()
+def record(directory, filename, coordinator, port_list, name_list, duration, epoch_len, display_ring, audio_ttl_port, cam_ttl_port, hsw_ttl_port):
+    """Parameters:
+        coordinator: the coordination.AcquisitionCoordinator shared with the other acquisition processes
+        display_ring: a shared_buffers.SharedRingBuffer to copy microphone data into for the live display, or None
+    """
+    task = daq_backend.create_task()
     # The following line allows each file in the sequence to have its own start time in its name
     # fname_generator = lambda : 'mic_{}.h5'.format(datetime.datetime.now().strftime('%Y_%m_%d_%H_%M_%S_%f'))
     # fname_generator = lambda : 'mic_{}.h5'.format(filename)
@@ -327,45 +609,42 @@ def record(directory, filename, acq_started, acq_start_time, port_list, name_lis
         sample_mode=AcquisitionType.CONTINUOUS,
         samps_per_chan=SAMPLE_RATE*5)
 
-    """So there is this really strange bug in nidaqmx where if you have a callback function bound to a task (like read_callback) and you attempt
-    to use this callback function to append to a multiprocessing queue (standand thread-safe queues are exempt), the process will never join 
-    and there will not be any sort of error message to indicate that the process is unresponsive."""
-    # Getting around this by maintaining a separate queue within the process that is copied into the mp queue as it receives data
-    non_mp_queue = None
-    if fft_queue is not None:
-        non_mp_queue = queue.Queue()
-
-
+    # Display data goes through shared memory, written from the writer thread. The old route (a multiprocessing queue fed by the
+    # callback) had to be relayed through a second queue in this process because of an nidaqmx bug that prevents the process from joining
     # The *5 grants some extra space to the buffer to avoid a crash if the timing of the retrieval from the buffer is a bit off
     channel_labels = [a.split('/')[1] for a in port_list]  # Should return something like ['ai0', 'ai1', 'ai2', ...]
-    data_writer = mic_data_writer(duration // 60, epoch_len // 60, len(port_list), directory, channel_labels, enforced_filename=filename)
+    # int16 storage keeps the ADC codes, so it needs raw reads
+    block_reader = BlockReader(task, len(port_list) + NUM_TTL_CHANNELS, raw=READ_RAW or STORAGE_DTYPE == 'int16')
+    data_writer = mic_data_writer(duration // 60, epoch_len // 60, len(port_list), directory, channel_labels, enforced_filename=filename,
+        scaling_coefficients=block_reader.coefficients[:len(port_list)] if STORAGE_DTYPE == 'int16' else None)
+    block_writer = BackgroundWriter(data_writer, display_ring, block_reader)
     task.register_every_n_samples_acquired_into_buffer_event(
         sample_interval=SAMPLE_INTERVAL,
-        callback_method=partial(read_callback, task, data_writer, non_mp_queue))
-
-    try:
-        while time.time() < acq_start_time.value or not acq_started.value:
-            pass  # Wait for everything else to be ready
-    except Exception:
-        return  # The program was closed before the value changed
+        callback_method=partial(read_callback, block_writer))
+
+    if coordinator.wait_for_start() is None:
+        # The program was closed before acquisition began
+        block_writer.close()
+        data_writer.close()
+        task.close()
+        if display_ring is not None:
+            display_ring.close()
+        return
     task.start()
 
-    start_time = time.time()
     try:
-        while acq_started.value and time.time() - start_time < duration:
-            try:
-                if non_mp_queue is not None and fft_queue is not None:
-                    data = non_mp_queue.get(timeout=0)
-                    fft_queue.put(data)
-            except queue.Empty:
-                continue
-
-
+        # All of the work happens on the DAQ callback and writer threads
+        coordinator.wait_for_stop(timeout=duration)
     except KeyboardInterrupt:
         print('Microphone_input: attempting to close task')
     
     time.sleep(1)
 
     task.stop()
+    block_writer.close()
+    print('Microphone writer: peak backlog {high_water_mark} blocks ({high_water_seconds:.2f}s), '
+          '{pool_misses} pool misses, {blocks_failed} blocks failed to write'.format(**block_writer.stats()))
     data_writer.close()
-    task.close()
\ No newline at end of file
+    task.close()
+    if display_ring is not None:
+        display_ring.close()
\ No newline at end of file
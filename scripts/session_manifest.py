@@ -0,0 +1,104 @@
+"""Session manifest: which file holds which part of each stream.
+
+Every acquisition stream (the microphones, each camera) appends one JSON line per finished
+epoch to manifest_<stream>.jsonl in the session directory. Each stream has its own file so
+the acquisition processes never write to the same file. An entry holds the epoch's files,
+relative to the session directory, and the global int64 range of samples or frames it
+covers, [start, end), counted from the start of the session:
+    {"stream": "mic", "epoch": 0, "path": "mic_....h5", "unit": "sample", "rate": 125000,
+     "start": 0, "end": 225000000, "camera_pulses": 54000, "audio_pulses": 1800, "ephys_triggers": 180}
+    {"stream": "cam_a", "epoch": 0, "path": "..._cam_a.avi", "timestamps": "..._cam_a.npy",
+     "encoder_stats": "..._cam_a_encoder.json", "unit": "frame", "rate": 30, "start": 0, "end": 54000}
+
+SessionManifest reads them back and finds the epochs covering a range with a binary search,
+without opening any of the data files.
+"""
+import glob
+import json
+import os
+from os import path
+
+import numpy as np
+
+
+MANIFEST_PATTERN = 'manifest_{}.jsonl'
+
+
+class ManifestWriter:
+    def __init__(self, directory, stream):
+        self.directory = directory
+        self.stream = stream
+        self.filepath = path.join(directory, MANIFEST_PATTERN.format(stream))
+        self.num_epochs = 0
+
+    def add_epoch(self, start, end, unit, rate, **fields):
+        """Appends an entry for a finished epoch. File paths in fields are stored relative to the session directory"""
+        entry = {'stream': self.stream, 'epoch': self.num_epochs}
+        for key, value in fields.items():
+            if isinstance(value, str) and path.isabs(value):
+                value = path.relpath(value, self.directory)
+            entry[key] = value
+        entry.update({'unit': unit, 'rate': rate, 'start': int(start), 'end': int(end)})
+        if not path.exists(self.directory):
+            os.makedirs(self.directory, exist_ok=True)
+        with open(self.filepath, 'a') as ctx:
+            ctx.write(json.dumps(entry) + '\n')
+        self.num_epochs += 1
+
+
+class SessionManifest:
+    """All of the manifest entries in a session directory, by stream"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries = dict()
+        self.starts = dict()
+        by_stream = dict()
+        for filepath in sorted(glob.glob(path.join(directory, MANIFEST_PATTERN.format('*')))):
+            with open(filepath, 'r') as ctx:
+                for line in ctx:
+                    if line.strip():
+                        entry = json.loads(line)
+                        by_stream.setdefault(entry['stream'], list()).append(entry)
+        for stream, entries in by_stream.items():
+            self.set_entries(stream, entries)
+
+    def set_entries(self, stream, entries):
+        """Replaces a stream's entries, e.g. with ones reconstructed for a session recorded without a manifest"""
+        self.entries[stream] = sorted(entries, key=lambda e: e['start'])
+        self.starts[stream] = np.array([e['start'] for e in self.entries[stream]], dtype=np.int64)
+
+    @property
+    def streams(self):
+        return list(self.entries)
+
+    def filepath(self, entry, key='path'):
+        return path.join(self.directory, entry[key])
+
+    def length(self, stream):
+        """Total number of samples or frames recorded for a stream"""
+        entries = self.entries[stream]
+        return entries[-1]['end'] if entries else 0
+
+    def locate(self, stream, start, stop):
+        """Finds the epochs holding the global index range [start, stop) of a stream.
+        Returns a list of (entry, local_start, local_stop), local indices being relative to the
+        start of the epoch's file
+        """
+        entries = self.entries[stream]
+        first = max(0, int(np.searchsorted(self.starts[stream], start, side='right')) - 1)
+        last = int(np.searchsorted(self.starts[stream], stop, side='left'))
+        pieces = list()
+        for entry in entries[first:last]:
+            local_start = max(start, entry['start']) - entry['start']
+            local_stop = min(stop, entry['end']) - entry['start']
+            if local_stop > local_start:
+                pieces.append((entry, local_start, local_stop))
+        return pieces
+
+    def locate_time(self, stream, start_seconds, stop_seconds):
+        """locate(), with the range given in seconds from the start of the stream"""
+        entries = self.entries[stream]
+        if not entries:
+            return list()
+        rate = entries[0]['rate']
+        return self.locate(stream, int(start_seconds * rate), int(np.ceil(stop_seconds * rate)))
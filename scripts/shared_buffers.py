@@ -0,0 +1,184 @@
+"""Buffers in multiprocessing.shared_memory for passing live data between processes
+without pickling it through a Manager.
+"""
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+HEADER_BYTES = 64  # Keeps the data aligned to a cache line
+
+# Layout of the SharedRingBuffer header
+_WRITE_INDEX = 0  # Samples written and complete
+_PENDING_INDEX = 1  # Samples written once the write in progress completes
+
+
+class SharedRingBuffer:
+    """Single-producer ring buffer of multichannel samples in shared memory.
+
+    The producer appends (channels, samples) blocks with write(). Readers address data by
+    absolute sample index: samples [write_index - capacity, write_index) are available.
+    No locks are used, seqlock-style: before touching the data the producer publishes the
+    index it is about to write up to (pending_index), and only after copying the data in does
+    it publish the new write index. Samples below pending_index - capacity may be mid-overwrite.
+    Readers check against pending_index again after copying, so a reader the producer lapped
+    while it was copying sees an IndexError rather than torn data.
+
+    Instances can be passed to a Process as an argument; the child attaches to the same
+    block of shared memory. Only the creator should call unlink().
+    """
+    def __init__(self, num_channels, capacity, dtype=np.float32, name=None):
+        self.num_channels = num_channels
+        self.capacity = capacity
+        self.dtype = np.dtype(dtype)
+        self.is_owner = name is None
+        size = HEADER_BYTES + num_channels * capacity * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.is_owner, size=size)
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=self.shm.buf)
+        self.data = np.ndarray((num_channels, capacity), dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_BYTES)
+        if self.is_owner:
+            self.header[:] = (0, 0)
+
+    def __reduce__(self):
+        return (self.__class__, (self.num_channels, self.capacity, self.dtype.str, self.shm.name))
+
+    @property
+    def write_index(self):
+        """Total number of samples written since the buffer was created"""
+        return int(self.header[_WRITE_INDEX])
+
+    @property
+    def pending_index(self):
+        """write_index once the write in progress, if any, is done"""
+        return int(self.header[_PENDING_INDEX])
+
+    @property
+    def oldest_index(self):
+        """Oldest sample that is not being overwritten"""
+        return max(0, self.pending_index - self.capacity)
+
+    def write(self, block):
+        num_samples = block.shape[1]
+        start = self.write_index
+        if num_samples > self.capacity:
+            # Only the newest capacity samples would survive anyway
+            block = block[:, -self.capacity:]
+            start += num_samples - self.capacity
+        end = self.write_index + num_samples
+        # Readers treat the samples about to be overwritten as gone before any of them change
+        self.header[_PENDING_INDEX] = end
+        pos = start % self.capacity
+        first = min(block.shape[1], self.capacity - pos)
+        self.data[:, pos:pos + first] = block[:, :first]
+        self.data[:, :block.shape[1] - first] = block[:, first:]
+        # Publish only after the samples are in place
+        self.header[_WRITE_INDEX] = end
+
+    def read(self, start, count, out=None):
+        """Copies samples [start, start + count) into out (allocated if None).
+        Raises IndexError if the samples have not been written yet or have been overwritten.
+        """
+        if out is None:
+            out = np.empty((self.num_channels, count), dtype=self.dtype)
+        if start + count > self.write_index or start < self.oldest_index:
+            raise IndexError('Samples {}-{} are not in the ring buffer'.format(start, start + count))
+        pos = start % self.capacity
+        first = min(count, self.capacity - pos)
+        out[:, :first] = self.data[:, pos:pos + first]
+        out[:, first:count] = self.data[:, :count - first]
+        if start < self.oldest_index:
+            raise IndexError('Samples {}-{} were overwritten while being read'.format(start, start + count))
+        return out
+
+    def close(self):
+        # The numpy views have to go before the shared memory can be closed
+        del self.header
+        del self.data
+        self.shm.close()
+
+    def unlink(self):
+        if self.is_owner:
+            self.shm.unlink()
+
+
+# Layout of the LatestFrameSlot header
+_SEQUENCE = 0  # Sequence number of the newest published frame, 0 before the first frame
+_FRONT = 1  # Index of the slot holding the newest frame
+_SLOT_SEQUENCE = 2  # Sequence number held by each slot, -1 while it is being written
+
+
+class LatestFrameSlot:
+    """Double-buffered shared-memory slot holding only the newest frame from a single producer.
+
+    The producer writes into the back slot and then flips the front index, so publishing a
+    frame never allocates and never waits for the reader. Readers copy the front slot and
+    check its sequence number afterwards to make sure it was not overwritten mid-copy.
+    Frames the reader never got around to are simply skipped.
+
+    Like SharedRingBuffer, instances can be passed to a Process and only the creator should
+    call unlink().
+    """
+    def __init__(self, shape, dtype=np.uint8, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.is_owner = name is None
+        frame_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.shm = shared_memory.SharedMemory(name=name, create=self.is_owner, size=HEADER_BYTES + 2 * frame_bytes)
+        self.header = np.ndarray((4,), dtype=np.int64, buffer=self.shm.buf)
+        self.frames = np.ndarray((2,) + self.shape, dtype=self.dtype, buffer=self.shm.buf, offset=HEADER_BYTES)
+        if self.is_owner:
+            self.header[:] = (0, 0, 0, 0)
+
+    def __reduce__(self):
+        return (self.__class__, (self.shape, self.dtype.str, self.shm.name))
+
+    @property
+    def sequence(self):
+        return int(self.header[_SEQUENCE])
+
+    def back_buffer(self):
+        """Marks the back slot as being written and returns it, so a frame can be rendered
+        straight into shared memory (e.g. with the dst argument of an OpenCV function).
+        Call publish() once it is filled.
+        """
+        back = 1 - int(self.header[_FRONT])
+        self.header[_SLOT_SEQUENCE + back] = -1
+        return self.frames[back]
+
+    def publish(self):
+        back = 1 - int(self.header[_FRONT])
+        sequence = self.sequence + 1
+        self.header[_SLOT_SEQUENCE + back] = sequence
+        self.header[_FRONT] = back
+        self.header[_SEQUENCE] = sequence
+
+    def write(self, frame):
+        np.copyto(self.back_buffer(), frame)
+        self.publish()
+
+    def read(self, last_sequence=0, out=None, attempts=3):
+        """Returns (sequence, frame) for the newest frame, or (last_sequence, None) if nothing newer
+        than last_sequence has been published. The frame is copied into out if given.
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        for _ in range(attempts):
+            if self.sequence == last_sequence:
+                return last_sequence, None
+            front = int(self.header[_FRONT])
+            sequence = int(self.header[_SLOT_SEQUENCE + front])
+            if sequence < 0:
+                continue  # The producer lapped us and is rewriting this slot
+            np.copyto(out, self.frames[front])
+            if int(self.header[_SLOT_SEQUENCE + front]) == sequence:
+                return sequence, out
+        return last_sequence, None
+
+    def close(self):
+        del self.header
+        del self.frames
+        self.shm.close()
+
+    def unlink(self):
+        if self.is_owner:
+            self.shm.unlink()
@@ -0,0 +1,255 @@
+"""Software stand-in for the parts of PySpin used by video_acquisition.FLIRCamera.
+
+The module mirrors the PySpin namespace (System, PixelFormat_*, *_Off enums) so it
+can be swapped in for PySpin by setting 'camera_backend' to 'simulated' in the config.
+Frames are served as raw BayerRG8 mosaics at the configured frame rate and at the size
+left after binning, decimation and the readout window, so converting them costs about as
+much as it does on the real camera.
+"""
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from scripts.config import constants
+
+
+# Enum values only need to be distinct, PySpin never exposes their meaning to us
+PixelFormat_BayerRG8 = 0
+PixelFormat_BGR8 = 1
+PixelFormat_Mono8 = 2
+ExposureAuto_Off = 0
+GainAuto_Off = 0
+BalanceWhiteAuto_Off = 0
+AutoExposureTargetGreyValueAuto_Off = 0
+
+SENSOR_WIDTH = 1280
+SENSOR_HEIGHT = 1024
+BUFFER_COUNT = 10  # Spinnaker's default stream buffer count
+NUM_SYNTHETIC_FRAMES = 16
+
+# OpenCV names Bayer patterns by the second row, so an RGGB sensor is 'BG' to OpenCV
+_BAYER_RG_TO_BGR = cv2.COLOR_BayerBG2BGR
+
+
+class SpinnakerException(Exception):
+    pass
+
+
+class _LibraryVersion:
+    major = 0
+    minor = 0
+    type = 0
+    build = 0
+
+
+class _Node:
+    """Stand-in for a GenICam node such as camera.ExposureAuto"""
+    def __init__(self, value=None):
+        self.value = value
+
+    def SetValue(self, value):
+        self.value = value
+
+    def GetValue(self):
+        return self.value
+
+
+class System:
+    _instance = None
+
+    @classmethod
+    def GetInstance(cls):
+        if cls._instance is None:
+            cls._instance = cls()
+        return cls._instance
+
+    def GetLibraryVersion(self):
+        return _LibraryVersion()
+
+    def GetCameras(self):
+        return CameraList()
+
+    def ReleaseInstance(self):
+        pass
+
+
+class CameraList:
+    def GetBySerial(self, serial):
+        return SimulatedCamera(serial)
+
+    def Clear(self):
+        pass
+
+
+class SimulatedImage:
+    def __init__(self, data, frame_id, timestamp, pixel_format):
+        self.data = data
+        self.frame_id = frame_id
+        self.timestamp = timestamp
+        self.pixel_format = pixel_format
+
+    def GetFrameID(self):
+        return self.frame_id
+
+    def GetTimeStamp(self):
+        return self.timestamp
+
+    def GetWidth(self):
+        return self.data.shape[1]
+
+    def GetHeight(self):
+        return self.data.shape[0]
+
+    def GetNDArray(self):
+        return self.data
+
+    def GetData(self):
+        return self.data.reshape(-1)
+
+    def IsIncomplete(self):
+        return False
+
+    def Convert(self, pixel_format, *args):
+        if pixel_format == self.pixel_format:
+            converted = self.data.copy()
+        elif pixel_format == PixelFormat_BGR8:
+            converted = cv2.cvtColor(self.data, _BAYER_RG_TO_BGR)
+        elif pixel_format == PixelFormat_Mono8:
+            converted = cv2.cvtColor(cv2.cvtColor(self.data, _BAYER_RG_TO_BGR), cv2.COLOR_BGR2GRAY)
+        else:
+            raise SpinnakerException('Unsupported pixel format conversion')
+        return SimulatedImage(converted, self.frame_id, self.timestamp, pixel_format)
+
+    def Release(self):
+        pass
+
+
+class SimulatedCamera:
+    """Serves frames as if the camera were being triggered at AcquisitionFrameRate.
+    Frames that are not retrieved before BUFFER_COUNT newer frames arrive are dropped,
+    which shows up as a gap in the frame IDs just like it does on the real camera.
+    An AcquisitionFrameRate of 0 serves a new frame on every call to GetNextImage.
+    """
+    def __init__(self, serial, source_video=None):
+        self.serial = serial
+        self.ExposureAuto = _Node()
+        self.GainAuto = _Node()
+        self.BalanceWhiteAuto = _Node()
+        self.AutoExposureTargetGreyValueAuto = _Node()
+        self.AcquisitionFrameRate = _Node(constants['camera_framerate'])
+        self.PixelFormat = _Node(PixelFormat_BayerRG8)
+        self.SensorWidth = _Node(SENSOR_WIDTH)
+        self.SensorHeight = _Node(SENSOR_HEIGHT)
+        self.BinningHorizontal = _Node(1)
+        self.BinningVertical = _Node(1)
+        self.DecimationHorizontal = _Node(1)
+        self.DecimationVertical = _Node(1)
+        self.Width = _Node(SENSOR_WIDTH)
+        self.Height = _Node(SENSOR_HEIGHT)
+        self.OffsetX = _Node(0)
+        self.OffsetY = _Node(0)
+        # Parts per million the camera clock runs fast relative to the trigger
+        self.clock_drift_ppm = 0
+
+        self.source_video = source_video
+        self.frames = None
+        self.is_acquiring = False
+        self.lock = threading.Lock()
+
+        self.frames_dropped = 0
+        self.next_frame_id = 0
+        self.start_time = None
+
+    def Init(self):
+        self.load_frames()
+
+    def load_frames(self):
+        # The readout size can change between Init and BeginAcquisition
+        size = (self.Width.GetValue(), self.Height.GetValue())
+        if self.frames is None or self.frames[0].shape[::-1] != size:
+            self.frames = load_source_frames(self.source_video, size)
+
+    def DeInit(self):
+        pass
+
+    def IsInitialized(self):
+        return self.frames is not None
+
+    def BeginAcquisition(self):
+        self.load_frames()
+        self.start_time = time.perf_counter()
+        self.next_frame_id = 0
+        self.frames_dropped = 0
+        self.is_acquiring = True
+
+    def EndAcquisition(self):
+        self.is_acquiring = False
+
+    def GetNextImage(self, timeout=None):
+        if not self.is_acquiring:
+            raise SpinnakerException('Camera is not acquiring')
+        framerate = self.AcquisitionFrameRate.GetValue()
+        with self.lock:
+            now = time.perf_counter()
+            if framerate:
+                newest = int((now - self.start_time) * framerate)
+                oldest_kept = newest - BUFFER_COUNT + 1
+                if self.next_frame_id < oldest_kept:
+                    self.frames_dropped += oldest_kept - self.next_frame_id
+                    self.next_frame_id = oldest_kept
+                frame_time = self.start_time + self.next_frame_id / framerate
+                wait = frame_time - now
+                if timeout is not None and wait > timeout / 1000:
+                    time.sleep(timeout / 1000)
+                    raise SpinnakerException('Timed out waiting for image')
+                if wait > 0:
+                    time.sleep(wait)
+            else:
+                frame_time = now
+            frame_id = self.next_frame_id
+            self.next_frame_id += 1
+
+        timestamp = int((frame_time - self.start_time) * 1e9 * (1 + self.clock_drift_ppm * 1e-6))
+        return SimulatedImage(self.frames[frame_id % len(self.frames)], frame_id, timestamp, self.PixelFormat.GetValue())
+
+
+def mosaic(bgr_frame):
+    """Samples a BGR frame into a single-channel RGGB mosaic"""
+    raw = np.empty(bgr_frame.shape[:2], dtype=np.uint8)
+    raw[0::2, 0::2] = bgr_frame[0::2, 0::2, 2]
+    raw[0::2, 1::2] = bgr_frame[0::2, 1::2, 1]
+    raw[1::2, 0::2] = bgr_frame[1::2, 0::2, 1]
+    raw[1::2, 1::2] = bgr_frame[1::2, 1::2, 0]
+    return raw
+
+
+def load_source_frames(source_video, size):
+    """Returns a list of raw frames to serve. Frames come from source_video if given,
+    otherwise a short loop of a bright square moving over a gradient is generated.
+    """
+    width, height = size
+    frames = list()
+    if source_video is not None:
+        reader = cv2.VideoCapture(source_video)
+        while reader.isOpened() and len(frames) < NUM_SYNTHETIC_FRAMES * 4:
+            ret, frame = reader.read()
+            if not ret:
+                break
+            frames.append(mosaic(cv2.resize(frame, (width, height))))
+        reader.release()
+        if frames:
+            return frames
+        print('Failed to read frames from {}, using synthetic frames instead'.format(source_video))
+
+    gradient = np.linspace(40, 120, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    background = np.broadcast_to(gradient, (height, width, 3)).copy()
+    square = min(width, height) // 8
+    for i in range(NUM_SYNTHETIC_FRAMES):
+        frame = background.copy()
+        x = (width - square) * i // NUM_SYNTHETIC_FRAMES
+        y = (height - square) // 2
+        frame[y:y + square, x:x + square] = (60, 200, 230)
+        frames.append(mosaic(frame))
+    return frames
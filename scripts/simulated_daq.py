@@ -0,0 +1,323 @@
+"""Software stand-in for the parts of nidaqmx.Task used by the acquisition scripts.
+
+Generates synthetic microphone signals along with the audio, camera and ephys TTL
+channels so the recording path can be load-tested on machines without an NI card.
+"""
+from collections import deque
+import threading
+import time
+
+import numpy as np
+
+from scripts.config import constants
+
+
+READ_ALL_AVAILABLE = -1  # Same value as nidaqmx.constants.READ_ALL_AVAILABLE
+
+# Channels are matched to a synthetic TTL signal by the name they were given in
+# microphone_input.record. Anything else is treated as a microphone
+TTL_CHANNEL_SIGNALS = {
+    'audio_ttl_port': 'audio',
+    'cam_ttl_port': 'camera',
+    'hsw_ttl_port': 'ephys',
+}
+
+TTL_HIGH_VOLTAGE = 5.0
+MIC_NOISE_AMPLITUDE = 0.01  # Volts
+MIC_CALL_AMPLITUDE = 0.5  # Volts
+MIC_CALL_INTERVAL = 0.7  # Seconds between synthetic vocalizations
+MIC_CALL_LENGTH = 0.05  # Seconds
+AUDIO_TTL_INTERVAL = 1.0  # Seconds between audio ttl pulses
+EPHYS_TTL_INTERVAL = 10.0  # Seconds between ephys trigger pulses
+EPHYS_TTL_LENGTH = 0.001  # Seconds
+RAW_VOLTS_PER_COUNT = 10.0 / 32768  # A +-10V input range digitised to 16 bits
+
+
+class DaqOverflowError(RuntimeError):
+    pass
+
+
+class _Channel:
+    def __init__(self, name):
+        self.name = name
+        # Polynomial (lowest order first) converting raw samples to volts
+        self.ai_dev_scaling_coeff = [0.0, RAW_VOLTS_PER_COUNT]
+
+
+class _ChannelCollection(list):
+    """Records the channels added to a task. Only the bits of the nidaqmx channel
+    collections used in this repo are implemented.
+    """
+    def add_ai_voltage_chan(self, physical_channel, name_to_assign_to_channel='', **kwargs):
+        self.append(_Channel(name_to_assign_to_channel or physical_channel))
+
+    def add_co_pulse_chan_freq(self, counter, name_to_assign_to_channel='', **kwargs):
+        self.append(_Channel(name_to_assign_to_channel or counter))
+
+    def add_co_pulse_chan_time(self, counter, name_to_assign_to_channel='', **kwargs):
+        self.append(_Channel(name_to_assign_to_channel or counter))
+
+    def add_di_chan(self, lines, name_to_assign_to_lines='', **kwargs):
+        self.append(_Channel(name_to_assign_to_lines or lines))
+
+    def add_do_chan(self, lines, name_to_assign_to_lines='', **kwargs):
+        self.append(_Channel(name_to_assign_to_lines or lines))
+
+    @property
+    def channel_names(self):
+        return [channel.name for channel in self]
+
+
+class _Timing:
+    def __init__(self):
+        self.samp_clk_rate = constants['microphone_sample_rate']
+        self.samp_quant_samp_per_chan = None
+
+    def cfg_samp_clk_timing(self, rate, source='', active_edge=None, sample_mode=None, samps_per_chan=1000):
+        self.samp_clk_rate = rate
+        self.samp_quant_samp_per_chan = int(samps_per_chan)
+
+    def cfg_implicit_timing(self, sample_mode=None, samps_per_chan=1000):
+        pass
+
+
+class _InStream:
+    def __init__(self, task):
+        self.task = task
+
+    @property
+    def avail_samp_per_chan(self):
+        return self.task.num_buffered
+
+
+class SimulatedReader:
+    """Stand-in for nidaqmx.stream_readers.AnalogMultiChannelReader (raw=False) and
+    AnalogUnscaledReader (raw=True). Both fill a caller-provided (channels, samples) array
+    """
+    def __init__(self, in_stream):
+        self.task = in_stream.task
+
+    def read_many_sample(self, data, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0):
+        return self.task.read_into(data, number_of_samples_per_channel)
+
+    def read_int16(self, data, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0):
+        return self.task.read_into(data, number_of_samples_per_channel, raw=True)
+
+
+class SimulatedTask:
+    def __init__(self, new_task_name='', speed=None):
+        """Parameters:
+            speed: how fast the simulated clock runs relative to the wall clock.
+                1 is real time, 2 is twice as fast, etc. None or 0 generates a
+                new block as soon as the previous callback returns, which gives
+                the maximum throughput of whatever is attached to the callback
+        """
+        self.name = new_task_name
+        self.speed = constants['simulated_daq_speed'] if speed is None else speed
+        self.ai_channels = _ChannelCollection()
+        self.co_channels = _ChannelCollection()
+        self.di_channels = _ChannelCollection()
+        self.do_channels = _ChannelCollection()
+        self.timing = _Timing()
+        self.in_stream = _InStream(self)
+
+        self.sample_interval = None
+        self.callback = None
+
+        self.is_running = False
+        self.thread = None
+        self.lock = threading.Lock()
+        self.blocks = deque()
+        self.num_buffered = 0
+
+        # Statistics for whoever is load testing the callback
+        self.samples_generated = 0
+        self.samples_read = 0
+        self.max_backlog = 0
+        self.overflowed = False
+        self.callback_durations = list()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    @property
+    def buffer_size(self):
+        if self.timing.samp_quant_samp_per_chan is None:
+            return int(self.timing.samp_clk_rate * 5)
+        return self.timing.samp_quant_samp_per_chan
+
+    def register_every_n_samples_acquired_into_buffer_event(self, sample_interval, callback_method):
+        self.sample_interval = int(sample_interval)
+        self.callback = callback_method
+
+    def start(self):
+        if self.is_running:
+            return
+        self.is_running = True
+        if not self.ai_channels:
+            # Output tasks (counters, digital lines) don't produce anything worth simulating
+            return
+        self.generator = SignalGenerator(self.ai_channels.channel_names, self.timing.samp_clk_rate)
+        self.thread = threading.Thread(target=self._acquisition_loop, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.is_running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stop()
+
+    def write(self, data, auto_start=False, timeout=10.0):
+        return 1
+
+    def _acquisition_loop(self):
+        rate = self.timing.samp_clk_rate
+        interval = self.sample_interval or int(rate * constants['microphone_data_retrieval_interval'])
+        start_time = time.perf_counter()
+        while self.is_running:
+            if self.speed:
+                # Sleep until the simulated clock has produced another block
+                due = start_time + (self.samples_generated + interval) / (rate * self.speed)
+                delay = due - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                if not self.is_running:
+                    return
+            block = self.generator.generate(self.samples_generated, interval)
+            with self.lock:
+                self.blocks.append(block)
+                self.num_buffered += interval
+                self.samples_generated += interval
+                self.max_backlog = max(self.max_backlog, self.num_buffered)
+                if self.num_buffered > self.buffer_size:
+                    self.overflowed = True
+
+            if self.callback is None:
+                continue
+            # Like NI-DAQmx, the callback runs on the thread that moves the data into the buffer,
+            # so a slow callback delays every callback after it while the clock keeps going
+            callback_start = time.perf_counter()
+            self.callback(0, 1, interval, None)
+            self.callback_durations.append(time.perf_counter() - callback_start)
+
+    def _check_overflow(self):
+        if self.overflowed:
+            raise DaqOverflowError(
+                'Simulated DAQ buffer overflow: {} samples waiting in a buffer of {}'.format(
+                    self.num_buffered, self.buffer_size))
+
+    def read(self, number_of_samples_per_channel=READ_ALL_AVAILABLE, timeout=10.0):
+        with self.lock:
+            self._check_overflow()
+            if number_of_samples_per_channel == READ_ALL_AVAILABLE:
+                n = self.num_buffered
+            else:
+                n = min(number_of_samples_per_channel, self.num_buffered)
+            data = self._pop(n)
+        if data.shape[0] == 1:
+            return data[0].tolist()
+        return data.tolist()
+
+    def read_into(self, data, number_of_samples_per_channel=READ_ALL_AVAILABLE, raw=False):
+        """Copies samples into data, a (channels, samples) array, without building any
+        intermediate lists. raw=True stores them as int16 counts of RAW_VOLTS_PER_COUNT.
+        Returns the number of samples read per channel
+        """
+        with self.lock:
+            self._check_overflow()
+            if number_of_samples_per_channel == READ_ALL_AVAILABLE:
+                n = min(self.num_buffered, data.shape[1])
+            else:
+                n = min(number_of_samples_per_channel, self.num_buffered)
+            pos = 0
+            for piece in self._pop_pieces(n):
+                if raw:
+                    piece = np.clip(np.rint(piece / RAW_VOLTS_PER_COUNT), -32768, 32767)
+                data[:, pos:pos + piece.shape[1]] = piece
+                pos += piece.shape[1]
+        return n
+
+    def _pop(self, n):
+        pieces = self._pop_pieces(n)
+        if not pieces:
+            return np.zeros((len(self.ai_channels), 0))
+        return np.concatenate(pieces, axis=1)
+
+    def _pop_pieces(self, n):
+        pieces = list()
+        remaining = n
+        while remaining > 0:
+            block = self.blocks[0]
+            if block.shape[1] <= remaining:
+                pieces.append(self.blocks.popleft())
+                remaining -= block.shape[1]
+            else:
+                pieces.append(block[:, :remaining])
+                self.blocks[0] = block[:, remaining:]
+                remaining = 0
+        self.num_buffered -= n
+        self.samples_read += n
+        return pieces
+
+
+class SignalGenerator:
+    """Produces blocks of synthetic data for a list of channel names. Every signal is
+    a function of the absolute sample index, so blocks can be generated independently
+    """
+    def __init__(self, channel_names, sample_rate):
+        self.channel_names = list(channel_names)
+        self.sample_rate = int(sample_rate)
+        self.signals = [TTL_CHANNEL_SIGNALS.get(name, 'microphone') for name in self.channel_names]
+        self.mic_rows = [i for i, s in enumerate(self.signals) if s == 'microphone']
+
+        rng = np.random.default_rng(0)
+        # One second of noise per channel, reused cyclically. Drawing fresh gaussian noise for
+        # 32 channels at 125kHz would make the generator a large part of the load being measured
+        self.noise = (rng.standard_normal((len(self.mic_rows), self.sample_rate)) * MIC_NOISE_AMPLITUDE).astype(np.float64)
+        # Each microphone hears the synthetic calls at a different level so the stereo display has something to show
+        self.call_gains = rng.uniform(0.2, 1.0, size=(len(self.mic_rows), 1))
+        call_t = np.arange(int(MIC_CALL_LENGTH * self.sample_rate)) / self.sample_rate
+        # Upward sweep from 30kHz to 60kHz (clipped to Nyquist)
+        f0 = min(30e3, self.sample_rate / 4)
+        f1 = min(60e3, self.sample_rate / 2.2)
+        self.call = MIC_CALL_AMPLITUDE * np.sin(2 * np.pi * (f0 * call_t + (f1 - f0) / (2 * MIC_CALL_LENGTH) * call_t ** 2))
+
+        self.camera_framerate = constants['camera_framerate']
+        self.audio_interval = int(AUDIO_TTL_INTERVAL * self.sample_rate)
+        self.call_interval = int(MIC_CALL_INTERVAL * self.sample_rate)
+        self.ephys_interval = int(EPHYS_TTL_INTERVAL * self.sample_rate)
+        self.ephys_length = max(1, int(EPHYS_TTL_LENGTH * self.sample_rate))
+
+    def generate(self, start, n):
+        idx = np.arange(start, start + n, dtype=np.int64)
+        block = np.empty((len(self.channel_names), n), dtype=np.float64)
+
+        if self.mic_rows:
+            noise_idx = idx % self.sample_rate
+            mic = self.noise[:, noise_idx]
+            call_phase = idx % self.call_interval
+            in_call = call_phase < self.call.shape[0]
+            if np.any(in_call):
+                mic[:, in_call] += self.call_gains * self.call[call_phase[in_call]]
+            block[self.mic_rows] = mic
+
+        for row, signal in enumerate(self.signals):
+            if signal == 'camera':
+                # 10% duty cycle, matching camera_ttl.CameraTTLTask
+                high = (idx * self.camera_framerate) % self.sample_rate < self.sample_rate // 10
+            elif signal == 'audio':
+                # Pulse lengths cycle between 10 and 100ms so the onset/length pairing gets exercised
+                pulse_len = (10 + 10 * ((idx // self.audio_interval) % 10)) * self.sample_rate // 1000
+                high = idx % self.audio_interval < pulse_len
+            elif signal == 'ephys':
+                high = (idx % self.ephys_interval < self.ephys_length) & (idx >= self.ephys_interval)
+            else:
+                continue
+            block[row] = high * TTL_HIGH_VOLTAGE
+        return block
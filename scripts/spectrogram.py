@@ -0,0 +1,293 @@
+"""Live spectrogram display.
+
+RollingSpectrogram keeps a preallocated, circular uint8 image and only computes STFT
+columns for newly arrived samples, carrying the samples that did not fill a whole
+segment over to the next update.
+"""
+import time
+
+import numpy as np
+import scipy.signal
+
+from scripts.config import constants as config
+
+
+READ_CYCLE_PERIOD = config['microphone_data_retrieval_interval']
+# Largest chunk of audio handed to the STFT at once, to bound the size of its temporaries
+MAX_UPDATE_SAMPLES = int(config['microphone_sample_rate'] * READ_CYCLE_PERIOD)
+
+
+def render_mono(power, out):
+    """Maps a (1, freq, time) power array onto a (freq, time) uint8 grayscale image"""
+    minavg, maxavg = config['spectrogram_lower_cutoff'], config['spectrogram_upper_cutoff']
+
+    spec = np.clip(power[0], minavg, maxavg)
+    spec = (spec - minavg) * 255 / (maxavg - minavg)
+    out[...] = spec[::-1]
+
+
+def stereo_colors(avg, diff, diff_scaling_factor):
+    """Maps the average power of the two microphones and their scaled difference
+    ((right - left) * diff_scaling_factor) onto float BGR colors with shape avg.shape + (3,)
+    """
+    black_color = config['spectrogram_black_color']
+    white_color = config['spectrogram_white_color']
+    red_color = config['spectrogram_red_color']
+    blue_color = config['spectrogram_blue_color']
+
+    # Add a new axis to both to allow them to be broadcast with the color vectors effeciently
+    # Here, subtracting left from right means positive value of diff -> more power on the right side -> more blue color
+    avg = np.array(avg, dtype=np.float64).reshape(avg.shape[:2] + (1,))
+    diff = np.array(diff, dtype=np.float64).reshape(diff.shape[:2] + (1,))
+
+    minavg, maxavg = config['spectrogram_lower_cutoff'], config['spectrogram_upper_cutoff']
+    # This is more arbitrary: the minimum power difference between the two mics for the signals to be differentiated between the two
+    diff_inner_thresh = config['spectrogram_mic_difference_thresh']
+    
+    # Truncate the average and diff arrays with these value to prevent the final image from underflowing or overflowing
+    avg[avg > maxavg] = maxavg
+    avg[avg < minavg] = minavg
+
+    # minavg doesn't work in the same way for diff because it spans the negative numbers. avg is originally non-negative
+    diff[diff < -maxavg] = -maxavg
+    diff[diff > maxavg] = maxavg
+    diff[(diff < diff_inner_thresh) & (diff > -diff_inner_thresh)] = 0
+    diff[avg < minavg] = 0
+
+
+    # Interpolate avg between black and white
+    # Original range: minavg, maxavg
+    # New range: black_color, white_color
+    # While it is redundant to subtract and add black_color here, it's useful to keep it, just in case the color changes in the future
+    avg_img = (avg - minavg) * (white_color - black_color) / (maxavg - minavg) + black_color
+    del avg
+
+    # Next in interpolating the locations with positive diff between their present color and blue_color
+    # The strength of the diff at that point will be used as the point of evaluation for the linear transform
+
+    # First scale diff to -1,1 for convenience
+    diff /= (maxavg * diff_scaling_factor)
+
+    # Remove the new axis on the mask so it can be applied to avg_img
+    # I thought it would be fine to just not add the new axis to diff in the first place but doing that broke something
+    positive_mask = (diff > 0).reshape(diff.shape[:2])
+
+    # Blue first
+    # Original range: scaled_inner_thresh, 1
+    # New range: present color, blue_color
+    # Note: while the true range of diff is -1, 1, this operation is only performed on the positive values of diff, so it is effectively ", 1
+    avg_img[positive_mask] = diff[positive_mask] * (blue_color - avg_img[positive_mask]) + avg_img[positive_mask]
+
+    # Now red
+    # Original range: -1, -scaled_inner_thresh
+    # New range: present color, red_color
+    # Note: I'm not exactly sure why the negative is needed in on diff here, maybe the new range should be reversed? In any case, it makes it work properly
+    avg_img[~positive_mask] = -diff[~positive_mask] * (red_color - avg_img[~positive_mask]) + avg_img[~positive_mask]
+    return avg_img
+
+
+class StereoColorRenderer:
+    """Maps (2, freq, time) power arrays from the left and right microphones onto a
+    (freq, time, 3) uint8 BGR image through a precomputed lookup table.
+
+    The average power and the scaled power difference are each quantised onto a grid
+    (avg_levels by diff_levels) and the colors for every grid point are computed once
+    with stereo_colors, so rendering is a single gather from the table into the output.
+    """
+    def __init__(self, diff_scaling_factor=2, avg_levels=256, diff_levels=511):
+        self.diff_scaling_factor = diff_scaling_factor
+        self.avg_levels = avg_levels
+        self.diff_levels = diff_levels
+        self.minavg, self.maxavg = config['spectrogram_lower_cutoff'], config['spectrogram_upper_cutoff']
+        # TEMPORARY: Account for the inflated readings from the right microphone
+        self.rmic_correction = config['spectrogram_rmic_correction_factor']
+
+        # Grid levels per unit of power. The diff grid spans [-maxavg, maxavg], where stereo_colors clips it
+        self.avg_scale = (avg_levels - 1) / (self.maxavg - self.minavg)
+        self.diff_scale = (diff_levels - 1) / (2 * self.maxavg)
+        avg_grid = self.minavg + np.arange(avg_levels) / self.avg_scale
+        diff_grid = -self.maxavg + np.arange(diff_levels) / self.diff_scale
+        avg, diff = np.meshgrid(avg_grid, diff_grid, indexing='ij')
+        colors = stereo_colors(avg, diff, diff_scaling_factor)
+        self.table = colors.reshape(-1, 3).astype(np.uint8)
+
+    def __call__(self, power, out):
+        lspec = power[0]
+        rspec = power[1] * self.rmic_correction
+        # Flip the frequency axis because in opencv, image[0] corresponds to the top row of the image
+        lspec, rspec = lspec[::-1], rspec[::-1]
+        avg_index = (lspec + rspec) * (0.5 * self.avg_scale) + (0.5 - self.minavg * self.avg_scale)
+        np.clip(avg_index, 0, self.avg_levels - 1, out=avg_index)
+        diff_index = (rspec - lspec) * (self.diff_scaling_factor * self.diff_scale) + (0.5 + self.maxavg * self.diff_scale)
+        np.clip(diff_index, 0, self.diff_levels - 1, out=diff_index)
+        index = avg_index.astype(np.intp)
+        index *= self.diff_levels
+        index += diff_index.astype(np.intp)
+        np.take(self.table, index, axis=0, out=out, mode='clip')
+
+
+class RollingSpectrogram:
+    """Parameters:
+        num_channels: number of audio channels passed to update(), 1 for mono or 2 for color
+        num_columns: width of the image in STFT columns
+        render: function mapping a (num_channels, freq, time) power array onto the uint8 image
+            columns passed as its second argument, e.g. render_mono or a StereoColorRenderer
+        color: whether render produces BGR columns rather than grayscale ones
+    The STFT matches scipy.signal.spectrogram with its default window, detrending and
+    density scaling, so the cutoffs in the config mean the same thing they used to.
+    """
+    def __init__(self, num_channels, num_columns, render, color=False, sample_rate=None, nfft=None, noverlap=None):
+        self.num_channels = num_channels
+        self.num_columns = num_columns
+        self.render = render
+        self.sample_rate = config['microphone_sample_rate'] if sample_rate is None else sample_rate
+        self.nfft = config['spectrogram_nfft'] if nfft is None else nfft
+        self.noverlap = config['spectrogram_noverlap'] if noverlap is None else noverlap
+        self.step = self.nfft - self.noverlap
+
+        self.window = scipy.signal.get_window(('tukey', 0.25), self.nfft)
+        self.scale = 1 / (self.sample_rate * np.sum(self.window ** 2))
+        self.num_freqs = self.nfft // 2 + 1
+
+        shape = (self.num_freqs, num_columns, 3) if color else (self.num_freqs, num_columns)
+        self.image = np.zeros(shape, dtype=np.uint8)
+        self.write_column = 0  # Column the next STFT column goes into, i.e. the oldest column
+        # Samples carried over between updates: the start of the next segment, including the overlap
+        self.remainder = np.zeros((num_channels, 0), dtype=np.float64)
+
+    def power(self, samples):
+        """Returns the (channels, freq, time) power of every complete segment in samples, and
+        the index of the first sample not consumed by a segment's hop"""
+        num_segments = (samples.shape[1] - self.noverlap) // self.step
+        if samples.shape[1] < self.nfft or num_segments <= 0:
+            return None, 0
+        segments = np.lib.stride_tricks.sliding_window_view(samples, self.nfft, axis=1)[:, ::self.step][:, :num_segments]
+        segments = segments - segments.mean(axis=-1, keepdims=True)
+        spec = np.fft.rfft(segments * self.window, axis=-1)
+        power = (spec.real ** 2 + spec.imag ** 2) * self.scale
+        # One-sided density: double everything but DC (and Nyquist, for an even nfft)
+        if self.nfft % 2:
+            power[..., 1:] *= 2
+        else:
+            power[..., 1:-1] *= 2
+        return power.transpose(0, 2, 1), num_segments * self.step
+
+    def update(self, samples):
+        """Adds (num_channels, n) new samples. Returns the number of new columns"""
+        samples = np.concatenate((self.remainder, samples), axis=1)
+        power, consumed = self.power(samples)
+        self.remainder = samples[:, consumed:].copy()
+        if power is None:
+            return 0
+
+        # Only the newest num_columns columns would survive the write anyway
+        power = power[:, :, -self.num_columns:]
+        num_new = power.shape[2]
+        first = min(num_new, self.num_columns - self.write_column)
+        self.render(power[:, :, :first], self.image[:, self.write_column:self.write_column + first])
+        if first < num_new:
+            self.render(power[:, :, first:], self.image[:, :num_new - first])
+        self.write_column = (self.write_column + num_new) % self.num_columns
+        return num_new
+
+    def unwrapped(self, out=None):
+        """Copies the circular image into out in time order, oldest column on the left"""
+        if out is None:
+            out = np.empty_like(self.image)
+        tail = self.num_columns - self.write_column
+        out[:, :tail] = self.image[:, self.write_column:]
+        out[:, tail:] = self.image[:, :self.write_column]
+        return out
+
+
+def columns_for_duration(seconds, sample_rate=None, nfft=None, noverlap=None):
+    sample_rate = config['microphone_sample_rate'] if sample_rate is None else sample_rate
+    nfft = config['spectrogram_nfft'] if nfft is None else nfft
+    noverlap = config['spectrogram_noverlap'] if noverlap is None else noverlap
+    return int(seconds * sample_rate) // (nfft - noverlap)
+
+
+def display_shape(colored=None, decimation=None):
+    """Shape of the image produced by the spectrogram worker, so the main process can
+    allocate the shared frame slot before the worker starts
+    """
+    colored = config['spectrogram_colored'] if colored is None else colored
+    decimation = config['spectrogram_decimation'] if decimation is None else decimation
+    num_columns = columns_for_duration(
+        config['spectrogram_deque_size'] * READ_CYCLE_PERIOD,
+        sample_rate=config['microphone_sample_rate'] / decimation)
+    num_freqs = config['spectrogram_nfft'] // 2 + 1
+    return (num_freqs, num_columns, 3) if colored else (num_freqs, num_columns)
+
+
+class StreamingDecimator:
+    """Low-pass filters and downsamples (channels, samples) blocks by an integer factor,
+    carrying the filter state and the sampling phase across blocks so consecutive blocks
+    decimate the same as one long signal would
+    """
+    def __init__(self, num_channels, factor, order=8):
+        self.factor = factor
+        if factor > 1:
+            # Cut off a little below the new Nyquist frequency
+            self.sos = scipy.signal.butter(order, 0.8 / factor, output='sos')
+            self.zi = np.zeros((self.sos.shape[0], num_channels, 2))
+        self.phase = 0
+
+    def __call__(self, samples):
+        if self.factor <= 1:
+            return samples
+        filtered, self.zi = scipy.signal.sosfilt(self.sos, samples, axis=1, zi=self.zi)
+        decimated = filtered[:, self.phase::self.factor]
+        self.phase = (self.phase - samples.shape[1]) % self.factor
+        return decimated
+
+
+def spectrogram_process(mic_ring, frame_slot, coordinator, colored=None, display_fps=None, decimation=None):
+    """Reads audio from mic_ring (a shared_buffers.SharedRingBuffer), computes the rolling
+    spectrogram and publishes the unwrapped image into frame_slot (a shared_buffers.LatestFrameSlot
+    with shape display_shape()) at most display_fps times per second, until the coordinator stops.
+    """
+    colored = config['spectrogram_colored'] if colored is None else colored
+    display_fps = config['spectrogram_display_fps'] if display_fps is None else display_fps
+    decimation = config['spectrogram_decimation'] if decimation is None else decimation
+
+    num_channels = 2 if colored else 1
+    shape = display_shape(colored, decimation)
+    renderer = StereoColorRenderer() if colored else render_mono
+    rolling = RollingSpectrogram(
+        num_channels, shape[1], renderer, color=colored, sample_rate=config['microphone_sample_rate'] / decimation)
+    decimate = StreamingDecimator(num_channels, decimation)
+    audio = np.empty((mic_ring.num_channels, MAX_UPDATE_SAMPLES), dtype=mic_ring.dtype)
+
+    frame_period = 1 / display_fps
+    read_index = 0
+    new_columns = 0
+    next_frame_time = time.time()
+    try:
+        while not coordinator.wait_for_stop(max(0, next_frame_time - time.time())):
+            # Bring the spectrogram up to date with everything that has arrived since the last frame
+            if read_index < mic_ring.oldest_index:
+                # Fell behind by more than the ring holds, skip ahead rather than falling further behind
+                read_index = mic_ring.write_index
+            while mic_ring.write_index > read_index:
+                count = min(mic_ring.write_index - read_index, MAX_UPDATE_SAMPLES)
+                try:
+                    block = mic_ring.read(read_index, count, out=audio[:, :count])
+                except IndexError:
+                    read_index = mic_ring.write_index
+                    break
+                read_index += count
+                if colored:
+                    block = block[:2]
+                else:
+                    block = np.mean(block, axis=0, keepdims=True)
+                new_columns += rolling.update(decimate(block))
+
+            if new_columns:
+                rolling.unwrapped(out=frame_slot.back_buffer())
+                frame_slot.publish()
+                new_columns = 0
+            next_frame_time = max(next_frame_time + frame_period, time.time())
+    finally:
+        mic_ring.close()
+        frame_slot.close()
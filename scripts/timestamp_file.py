@@ -0,0 +1,75 @@
+"""Append-only camera timestamp files.
+
+Each file is a regular (n, 2) int64 .npy file of (FrameID, TimeStamp) rows, so np.load and
+np.load(mmap_mode='r') read it as before. Rows are buffered in a preallocated batch and
+appended to the file whenever the batch fills up. The .npy header is always padded to
+HEADER_BYTES, so after each batch it can be rewritten in place with the new row count.
+A crash therefore loses at most one batch, and every file on disk loads, however short it is.
+"""
+import os
+
+import numpy as np
+
+from scripts.config import constants as config
+
+
+BATCH_SIZE = config['camera_timestamp_batch_size']
+HEADER_BYTES = 128
+NUM_COLUMNS = 2
+_MAGIC = b'\x93NUMPY\x01\x00'
+
+
+def npy_header(num_rows):
+    """A version 1.0 .npy header for an (num_rows, 2) int64 array, padded to HEADER_BYTES"""
+    description = "{{'descr': '<i8', 'fortran_order': False, 'shape': ({}, {}), }}".format(num_rows, NUM_COLUMNS)
+    # magic + version, 2 bytes of header length, then the description padded with spaces and ending in a newline
+    padded_length = HEADER_BYTES - len(_MAGIC) - 2
+    if len(description) + 1 > padded_length:
+        raise ValueError('Too many rows for a {} byte header'.format(HEADER_BYTES))
+    description = description.ljust(padded_length - 1) + '\n'
+    return _MAGIC + padded_length.to_bytes(2, 'little') + description.encode('latin1')
+
+
+class TimestampFile:
+    def __init__(self, filepath, batch_size=BATCH_SIZE):
+        self.filepath = filepath
+        self.batch = np.empty((batch_size, NUM_COLUMNS), dtype='<i8')
+        self.num_batched = 0
+        self.num_written = 0
+        self.file = open(filepath, 'wb')
+        self.file.write(npy_header(0))
+        self.file.flush()
+
+    def __len__(self):
+        return self.num_written + self.num_batched
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def append(self, frame_id, timestamp):
+        self.batch[self.num_batched] = (frame_id, timestamp)
+        self.num_batched += 1
+        if self.num_batched == len(self.batch):
+            self.flush()
+
+    def flush(self):
+        if self.file is None or self.num_batched == 0:
+            return
+        # Rows first, then the header that makes them visible, so the file is valid at every point
+        self.file.write(self.batch[:self.num_batched].tobytes())
+        self.num_written += self.num_batched
+        self.num_batched = 0
+        self.file.seek(0)
+        self.file.write(npy_header(self.num_written))
+        self.file.seek(0, os.SEEK_END)
+        self.file.flush()
+
+    def close(self):
+        if self.file is None:
+            return
+        self.flush()
+        self.file.close()
+        self.file = None
@@ -1,19 +1,178 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import os
 from os import path
-from queue import Queue
+import queue
 from threading import Thread
 import time
 
 import cv2
 import numpy as np
-import PySpin as spin
 
-from scripts import camera_ttl
+from scripts import camera_ttl, session_manifest, timestamp_file, video_writer
 from scripts.config import constants as config
-    
 
-def image_acquisition_loop(camera_obj, timestamp_arr, dimensions, write_frame, still_active, maps, image_queue, counter):
+
+DEFAULT_DIMENSIONS = (640, 512)
+SENSOR_REDUCTION = config['camera_sensor_reduction']
+FRAME_POOL_SIZE = config['camera_frame_pool_size']
+# The cameras deliver RGGB mosaics, which OpenCV names by their second row
+BAYER_RG_TO_BGR = cv2.COLOR_BayerBG2BGR
+# Spinnaker's 8 bit Bayer formats and the OpenCV conversion for each
+BAYER_CONVERSIONS = {
+    'PixelFormat_BayerRG8': cv2.COLOR_BayerBG2BGR,
+    'PixelFormat_BayerBG8': cv2.COLOR_BayerRG2BGR,
+    'PixelFormat_BayerGR8': cv2.COLOR_BayerGB2BGR,
+    'PixelFormat_BayerGB8': cv2.COLOR_BayerGR2BGR,
+}
+
+def get_spin_module(backend=None):
+    """Returns PySpin, or the simulated stand-in from scripts.simulated_camera when
+    backend (defaults to config['camera_backend']) is 'simulated'
+    """
+    if backend is None:
+        backend = config['camera_backend']
+    if backend == 'simulated':
+        from scripts import simulated_camera
+        return simulated_camera
+    if backend == 'pyspin':
+        import PySpin
+        return PySpin
+    raise ValueError('Unknown camera backend: {}'.format(backend))
+
+
+def bayer_conversion(spin, pixel_format):
+    """The cv2.cvtColor code demosaicing frames of the given pixel format, or None if it is not an 8 bit Bayer format"""
+    for name, code in BAYER_CONVERSIONS.items():
+        if hasattr(spin, name) and getattr(spin, name) == pixel_format:
+            return code
+    return None
+
+
+def reset_node(node, value):
+    # Only written if it differs, so a camera that is already set up is left alone
+    if node.GetValue() != value:
+        node.SetValue(value)
+
+
+def configure_sensor(camera, dimensions, reduction=SENSOR_REDUCTION):
+    """Makes the camera deliver frames of the target dimensions, so less data leaves the sensor.
+    Parameters:
+        reduction: 'binning' or 'decimation' to combine or skip sensor pixels, 'roi' to read out
+            only a centered dimensions-sized window, or 'none' to read out the full sensor
+    Returns the (scale, offset_x, offset_y) mapping full-sensor pixel coordinates to frame coordinates:
+        frame = (sensor - offset) / scale
+    """
+    sensor_width = camera.SensorWidth.GetValue()
+    sensor_height = camera.SensorHeight.GetValue()
+    factor = max(1, min(sensor_width // dimensions[0], sensor_height // dimensions[1]))
+    if reduction not in ('none', 'binning', 'decimation', 'roi'):
+        raise ValueError('Unknown camera sensor reduction: {}'.format(reduction))
+    # Undo whatever an earlier run in another mode left on the camera, these settings persist across sessions
+    for node in (camera.BinningHorizontal, camera.BinningVertical, camera.DecimationHorizontal, camera.DecimationVertical):
+        reset_node(node, 1)
+    if reduction == 'none':
+        reset_node(camera.OffsetX, 0)
+        reset_node(camera.OffsetY, 0)
+        reset_node(camera.Width, sensor_width)
+        reset_node(camera.Height, sensor_height)
+        return sensor_width / dimensions[0], 0, 0
+    if reduction in ('binning', 'decimation'):
+        if reduction == 'binning':
+            camera.BinningHorizontal.SetValue(factor)
+            camera.BinningVertical.SetValue(factor)
+        else:
+            camera.DecimationHorizontal.SetValue(factor)
+            camera.DecimationVertical.SetValue(factor)
+        scale = factor
+    else:
+        scale = 1
+    # The offsets have to be cleared before the size can grow, and set after it has shrunk
+    camera.OffsetX.SetValue(0)
+    camera.OffsetY.SetValue(0)
+    camera.Width.SetValue(dimensions[0])
+    camera.Height.SetValue(dimensions[1])
+    # Center the readout window on whatever is left of the sensor. Offsets are kept even to preserve the Bayer pattern
+    offset_x = (sensor_width // scale - dimensions[0]) // 4 * 2
+    offset_y = (sensor_height // scale - dimensions[1]) // 4 * 2
+    camera.OffsetX.SetValue(offset_x)
+    camera.OffsetY.SetValue(offset_y)
+    return scale, offset_x * scale, offset_y * scale
+
+
+class FramePool:
+    """Preallocated BGR frames. A frame is taken from the pool for every stage of the pipeline
+    that produces a new image and is returned once nothing needs it anymore. If the pool runs
+    dry a new frame is allocated rather than dropping the image, and misses is incremented.
+    """
+    def __init__(self, shape, size=FRAME_POOL_SIZE):
+        self.shape = shape
+        self.misses = 0
+        self.free_frames = queue.Queue()
+        for _ in range(size):
+            self.free_frames.put(np.empty(shape, dtype=np.uint8))
+
+    def get(self):
+        try:
+            return self.free_frames.get_nowait()
+        except queue.Empty:
+            self.misses += 1
+            return np.empty(self.shape, dtype=np.uint8)
+
+    def put(self, frame):
+        self.free_frames.put(frame)
+
+
+class FrameConverter:
+    """Turns raw Bayer images into BGR frames of the target dimensions, undistorted if
+    transformation maps are given. Every output is written into a frame from the pool.
+    Parameters:
+        bayer_code: cv2.cvtColor code demosaicing the camera's images. If None, images are
+            converted to bgr_format by Spinnaker instead
+    """
+    def __init__(self, dimensions, maps=None, pool_size=FRAME_POOL_SIZE, bayer_code=BAYER_RG_TO_BGR, bgr_format=None):
+        self.dimensions = dimensions
+        self.maps = maps
+        self.bayer_code = bayer_code
+        self.bgr_format = bgr_format
+        self.pool = FramePool((dimensions[1], dimensions[0], 3), pool_size)
+        # Only used if the camera delivers frames larger than dimensions
+        self.full_frame = None
+
+    def demosaic(self, image):
+        """Converts a camera image to BGR. The image can be released as soon as this returns"""
+        frame = self.pool.get()
+        if self.bayer_code is None:
+            bgr = image.Convert(self.bgr_format).GetNDArray()
+            if bgr.shape[:2] == frame.shape[:2]:
+                np.copyto(frame, bgr)
+            else:
+                cv2.resize(bgr, self.dimensions, dst=frame)
+            return frame
+        raw = image.GetNDArray()
+        if raw.shape[:2] == frame.shape[:2]:
+            cv2.cvtColor(raw, self.bayer_code, dst=frame)
+        else:
+            if self.full_frame is None or self.full_frame.shape[:2] != raw.shape[:2]:
+                self.full_frame = np.empty(raw.shape[:2] + (3,), dtype=np.uint8)
+            cv2.cvtColor(raw, self.bayer_code, dst=self.full_frame)
+            cv2.resize(self.full_frame, self.dimensions, dst=frame)
+        return frame
+
+    def undistort(self, frame):
+        """Returns the undistorted frame, handing the input back to the pool"""
+        if self.maps is None:
+            return frame
+        undistorted = self.pool.get()
+        cv2.remap(frame, *self.maps, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, dst=undistorted)
+        self.pool.put(frame)
+        return undistorted
+
+
+def image_acquisition_loop(camera_obj, write_timestamp, converter, write_frame, still_active, preview_slot, counter):
+    """write_frame(frame, frame_id) takes ownership of the frame and returns it to converter.pool when done with it.
+    counter() is called once the frame and its timestamp are written, so an epoch rollover never splits them
+    """
     while still_active():
         try:
             # Remove timeout to prevent thread from hanging after acquisition is stopped.
@@ -22,71 +181,83 @@ def image_acquisition_loop(camera_obj, timestamp_arr, dimensions, write_frame, s
             continue  # Likely hung on GetNextImage. Close thread.
         if not still_active():
             return
-        timestamp_arr.append((image.GetFrameID(), image.GetTimeStamp()))
+        frame_id = image.GetFrameID()
+        write_timestamp(frame_id, image.GetTimeStamp())
         #print((image.GetFrameID(), image.GetTimeStamp()))
-        image_bgr = image.Convert(spin.PixelFormat_BGR8)
-        cv_img_big = image_bgr.GetData().reshape((2 * dimensions[1], 2 * dimensions[0], 3))
-        cv_img = cv2.resize(cv_img_big, dimensions)
-        counter()
-        if maps is not None:
-            cv_img = cv2.remap(cv_img, *maps, interpolation=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
-            # Here 0.5 is the alpha parameter, which determines how many of the original pixels should be kept in the image
-        if image_queue is not None:
-            image_queue.put(cv_img)
-        write_frame(cv_img)
-        # del cv_img
-        del cv_img_big
+        cv_img = converter.demosaic(image)
         try:
+            # Hand the buffer back to the camera as soon as possible
             image.Release()
-            image_bgr.Release()
         except Exception:
             # If this thread is in the middle of a loop when still_active changes, the call to image.release will fail
             pass
+        cv_img = converter.undistort(cv_img)
+        if preview_slot is not None:
+            # Overwrites the previous frame in place, whether or not the display got to it
+            preview_slot.write(cv_img)
+        write_frame(cv_img, frame_id)
+        counter()
+
+
+class EpochFiles:
+    """The video writer and timestamp file of one epoch, along with the path its encoder stats are saved to"""
+    def __init__(self, base_dir, start_time_str, camera_name, framerate, dimensions, encoder=None):
+        if not path.exists(base_dir):
+            os.makedirs(base_dir, exist_ok=True)
+        stem = path.join(base_dir, '{}_{}'.format(start_time_str, camera_name))
+        self.timestamp_path = '{}.npy'.format(stem)
+        self.encoder_stats_path = '{}_encoder.json'.format(stem)
+        self.video_writer, self.video_path = video_writer.create_encoder(stem, framerate, dimensions, encoder)
+        self.timestamp_file = timestamp_file.TimestampFile(self.timestamp_path)
+
+    def discard(self):
+        """Closes and deletes the files of an epoch that never started"""
+        try:
+            self.video_writer.release()
+            self.timestamp_file.close()
+            for filepath in (self.video_path, self.timestamp_path):
+                if path.exists(filepath):
+                    os.remove(filepath)
+        except Exception as e:
+            print(e)
 
 
 class FLIRCamera:
-    def __init__(self, root_directory, acq_enabled, camera_serial, counter_port, port_name, frame_target, epoch_target, framerate=config['camera_framerate'], period_extension=0, dimensions=(640,512), calibration_param_path=None, use_queue=None, enforce_filename=None):
+    def __init__(self, root_directory, stop_event, camera_serial, counter_port, port_name, frame_target, epoch_target, framerate=config['camera_framerate'], period_extension=0, dimensions=DEFAULT_DIMENSIONS, calibration_param_path=None, preview_slot=None, enforce_filename=None, camera_backend=None, sensor_reduction=SENSOR_REDUCTION, encoder=None):
+        self.spin = get_spin_module(camera_backend)
         self.framerate = framerate
         self.serial = camera_serial
         self.dimensions = dimensions
         self.base_dir = root_directory
-        self.acq_enabled = acq_enabled
+        self.stop_event = stop_event
         self.is_capturing = False
 
         self.port = counter_port
         self.name = port_name
         self.period_extension = period_extension
 
-        self.transformation_maps = None
-
         self.frame_target = frame_target
         self.frames_acquired = 0
 
         self.epoch_target = epoch_target
         self.epochs_acquired = 0
+        self.timestamp_file = None
 
-        self.queue = use_queue
-        self.enforced_filename = enforce_filename
+        # Opens the next epoch's files ahead of time and closes the last epoch's, off the acquisition thread
+        self.epoch_worker = ThreadPoolExecutor(max_workers=1)
+        self.next_epoch_files = None
+        self.epoch_files = None
 
-        if calibration_param_path:
-            # Load calibration parameters
-            print('Loading calibration parameters for {} from {}'.format(self.name, calibration_param_path))
-            try:
-                K_path = path.join(calibration_param_path, 'K.npy')
-                D_path = path.join(calibration_param_path, 'D.npy')
-                # Normalize the K matrix since it was designed for 1280x1024 images but we are using 640x512
-                K = np.load(K_path) / 2
-                K[2, 2] = 1
-                D = np.load(D_path)
-                new_K = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(K, D, dimensions, np.eye(3), balance=0)
-                self.transformation_maps = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), new_K, dimensions, cv2.CV_16SC2)
-            except Exception as e:
-                print(e)
-                print('Failed to load calibration parameters for {}'.format(self.name))
+        # Global index of the first frame of the current epoch, for the session manifest
+        self.epoch_start_frame = 0
+        self.manifest = session_manifest.ManifestWriter(root_directory, port_name)
 
+        self.preview_slot = preview_slot
+        self.enforced_filename = enforce_filename
+        self.encoder = encoder
 
         # For documentation/debugging purposes:
-        flir_system = spin.System.GetInstance()
+        flir_system = self.spin.System.GetInstance()
         flir_version = flir_system.GetLibraryVersion()
         print('Flir PySpin library version: {}.{}.{}.{}'.format(
             flir_version.major,
@@ -105,11 +276,41 @@ class FLIRCamera:
             return
         self.camera.Init()
 
+        # The pixel format is left as configured on the camera. Bayer mosaics are demosaiced on the host
+        # with the matching pattern, anything else is converted by Spinnaker, see FrameConverter
+        bayer_code = bayer_conversion(self.spin, self.camera.PixelFormat.GetValue())
+        scale, offset_x, offset_y = configure_sensor(self.camera, self.dimensions, sensor_reduction)
+
+        self.transformation_maps = None
+        if calibration_param_path:
+            # Load calibration parameters
+            print('Loading calibration parameters for {} from {}'.format(self.name, calibration_param_path))
+            try:
+                K_path = path.join(calibration_param_path, 'K.npy')
+                D_path = path.join(calibration_param_path, 'D.npy')
+                # The K matrix was calibrated on full 1280x1024 sensor images, move it to the frame's pixel grid
+                K = np.load(K_path).astype(np.float64)
+                K[0, 2] -= offset_x
+                K[1, 2] -= offset_y
+                K[:2] /= scale
+                D = np.load(D_path)
+                new_K = cv2.fisheye.estimateNewCameraMatrixForUndistortRectify(K, D, dimensions, np.eye(3), balance=0)
+                self.transformation_maps = cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), new_K, dimensions, cv2.CV_16SC2)
+            except Exception as e:
+                print(e)
+                print('Failed to load calibration parameters for {}'.format(self.name))
+
+        # Frames wait for the encoder in pool buffers, so the pool has to cover the writer's queue as well
+        self.converter = FrameConverter(
+            self.dimensions, self.transformation_maps, pool_size=video_writer.QUEUE_SIZE + FRAME_POOL_SIZE,
+            bayer_code=bayer_code, bgr_format=self.spin.PixelFormat_BGR8)
+        self.frame_writer = video_writer.AsyncVideoWriter(release_frame=self.converter.pool.put)
+
         # Disable automatic exposure, gain, etc... Copied from previous script
-        self.camera.ExposureAuto.SetValue(spin.ExposureAuto_Off)
-        self.camera.GainAuto.SetValue(spin.GainAuto_Off)
-        self.camera.BalanceWhiteAuto.SetValue(spin.BalanceWhiteAuto_Off)
-        self.camera.AutoExposureTargetGreyValueAuto.SetValue(spin.AutoExposureTargetGreyValueAuto_Off)
+        self.camera.ExposureAuto.SetValue(self.spin.ExposureAuto_Off)
+        self.camera.GainAuto.SetValue(self.spin.GainAuto_Off)
+        self.camera.BalanceWhiteAuto.SetValue(self.spin.BalanceWhiteAuto_Off)
+        self.camera.AutoExposureTargetGreyValueAuto.SetValue(self.spin.AutoExposureTargetGreyValueAuto_Off)
 
         if self.port is not None:
             self.camera_task = camera_ttl.CameraTTLTask(self.framerate,
@@ -126,38 +327,46 @@ class FLIRCamera:
             self.end_epoch()
             self.start_epoch()
 
-    def create_video_file(self):
-        start_time = datetime.datetime.now()
+    def open_epoch_files(self, start_time):
         if self.enforced_filename is None:
             start_time_str = start_time.strftime('%Y_%m_%d_%H_%M_%S_%f')
         else:
             start_time_str = self.enforced_filename
-        if not path.exists(self.base_dir):
-            os.mkdir(self.base_dir)
-        self.timestamp_path = path.join(self.base_dir, '{}_{}.npy'.format(start_time_str, self.name))
-        # video_directory = path.join(base_directory, start_time_str)
-        # if not path.exists(video_directory):
-            # os.mkdir(video_directory)
-        video_path = path.join(self.base_dir, '{}_{}.avi'.format(start_time_str, self.name))
-        writer = cv2.VideoWriter(video_path, cv2.VideoWriter_fourcc(*'DIVX'), self.framerate, self.dimensions, isColor=True)
-
-        # Reset the enforced filename field so future epochs calculate their own time
-        self.enforced_filename = None
-        return writer
-
-    def save_ts_array(self):
-        # The length here is arbitrary. Just to make sure we don't overwrite an existing npy file
-        # with nearly empty data
-        if len(self.timestamps) < 30 * 50:
+            # Reset the enforced filename field so future epochs calculate their own time
+            self.enforced_filename = None
+        return EpochFiles(self.base_dir, start_time_str, self.name, self.framerate, self.dimensions, self.encoder)
+
+    def prepare_next_epoch(self):
+        """Starts opening the next epoch's files in the background, named after the time the epoch is expected to start"""
+        self.next_epoch_files = None
+        if self.epochs_acquired + 1 >= self.epoch_target:
             return
-        np.save(self.timestamp_path, np.array(self.timestamps))
-        self.timestamps.clear()
+        remaining = (self.frame_target - self.frames_acquired) / self.framerate
+        expected_start = datetime.datetime.now() + datetime.timedelta(seconds=remaining)
+        self.next_epoch_files = self.epoch_worker.submit(
+            EpochFiles, self.base_dir, expected_start.strftime('%Y_%m_%d_%H_%M_%S_%f'), self.name, self.framerate, self.dimensions, self.encoder)
 
     def start_epoch(self):
         if self.epochs_acquired >= self.epoch_target:
             return
 
-        self.video_writer = self.create_video_file()
+        files = None
+        if self.next_epoch_files is not None:
+            try:
+                # Normally finished long ago, so this only swaps the files in
+                files = self.next_epoch_files.result()
+            except Exception as e:
+                # Runs on the acquisition thread at rollover, so try again here rather than let it die
+                print('Failed to prepare the next epoch for {}: {}'.format(self.name, e))
+        if files is None:
+            files = self.open_epoch_files(datetime.datetime.now())
+        self.epoch_files = files
+        self.timestamp_path = files.timestamp_path
+        self.video_path = files.video_path
+        self.frame_writer.start_epoch(files.video_writer, files.encoder_stats_path)
+        # Timestamps go to disk in batches as they arrive
+        self.timestamp_file = files.timestamp_file
+        self.prepare_next_epoch()
 
         if self.is_capturing:
             # Testing out the effect of leaving everything active for the entire runtime
@@ -170,34 +379,48 @@ class FLIRCamera:
             self.camera_task.start()
 
         # Create a function to access is_capturing, creates the effect of passing the bool by reference
-        enabled = lambda: self.is_capturing and safe_access_mp_bool(self.acq_enabled)
+        enabled = lambda: self.is_capturing and not safe_event_is_set(self.stop_event)
 
         # Begin separate thread for continued image acquisition:
         # 2021-12-03: replacing video writer object in args with function to write frame
         # this allows us to keep one thread alive for the whole 
-        self.timestamps = list()
         self.acq_thread = Thread(
             target=image_acquisition_loop,
             args=(
                 self.camera,
-                self.timestamps,
-                self.dimensions,
+                self.write_timestamp,
+                self.converter,
                 self.write_frame,
                 enabled,
-                self.transformation_maps,
-                self.queue,
+                self.preview_slot,
                 self.inc_frame_count))
         self.acq_thread.start()
 
-    def write_frame(self, frame):
-        self.video_writer.write(frame)
+    def write_timestamp(self, frame_id, timestamp):
+        if self.timestamp_file is not None:
+            self.timestamp_file.append(frame_id, timestamp)
+
+    def write_frame(self, frame, frame_id=None):
+        # Only queues the frame, encoding happens on the frame writer's thread
+        self.frame_writer.write(frame, frame_id)
+
+    def finish_epoch_files(self, files, start_frame, num_frames):
+        files.timestamp_file.close()
+        self.manifest.add_epoch(
+            start_frame, start_frame + num_frames, 'frame', self.framerate,
+            path=files.video_path, timestamps=files.timestamp_path, encoder_stats=files.encoder_stats_path)
 
     def end_epoch(self):
         try:
-            self.save_ts_array()
+            if self.timestamp_file is not None:
+                num_frames = len(self.timestamp_file)
+                self.epoch_worker.submit(self.finish_epoch_files, self.epoch_files, self.epoch_start_frame, num_frames)
+                self.epoch_start_frame += num_frames
+                self.timestamp_file = None
             self.epochs_acquired += 1
             self.frames_acquired = 0
-            self.video_writer.release()
+            # The video is closed once the frames queued before this point are encoded
+            self.frame_writer.end_epoch()
         except Exception as e:
             print('something wrong in end epoch')
             # Things most likely released out of order
@@ -205,16 +428,31 @@ class FLIRCamera:
             pass
 
     def release(self):
-        self.end_epoch()
         if self.is_capturing:
-            self.camera.EndAcquisition()
             self.is_capturing = False
+            # Let the acquisition thread finish its current frame before the epoch's files are closed
+            self.acq_thread.join()
+            self.camera.EndAcquisition()
+        self.end_epoch()
+        if self.next_epoch_files is not None:
+            try:
+                # Prepared for an epoch that is not going to happen
+                self.next_epoch_files.result().discard()
+            except Exception as e:
+                # Preparing it failed, so there is nothing to discard. The camera still has to be released
+                print(e)
+            self.next_epoch_files = None
+        self.epoch_worker.shutdown(wait=True)
+        # Wait for the queued frames to be encoded
+        self.frame_writer.close()
         if self.camera_task is not None:
                 self.camera_task.stop()
         del self.camera
         self.spin_system.ReleaseInstance()
         if self.camera_task is not None:
             self.camera_task.close()
+        if self.preview_slot is not None:
+            self.preview_slot.close()
 
     def __enter__(self):
         return self
@@ -228,11 +466,11 @@ class FLIRCamera:
             print(e)
 
 
-def safe_access_mp_bool(mp_bool):
-    """ Safely accesses a shared variable by catching the exception that
-    occurs when the variable ceases to exist
+def safe_event_is_set(event):
+    """ Safely checks a shared event by catching the exception that
+    occurs when the event ceases to exist, which is treated as the event being set
     """
     try:
-        return mp_bool.value
+        return event.is_set()
     except Exception:
-        return False
\ No newline at end of file
+        return True
\ No newline at end of file
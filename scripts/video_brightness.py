@@ -1,29 +1,157 @@
+"""Per-frame brightness of camera videos, e.g. to check the light cycle of a recording.
+
+Each video is split into ranges of frames, and the ranges of every video given are spread over
+a process pool. A worker seeks straight to the start of its range and decodes only that range.
+For every frame it computes the mean of the HSV value channel, which is the per-pixel max of
+B, G and R, so no color conversion is needed, along with the mean of each color channel.
+Frames can be downsampled first by taking every nth pixel.
+
+Results are written by the workers straight into <video stem>_brightness.npy, an (n, 4) float32
+array of (value, blue, green, red) means per frame, in 0-255.
+
+Example: python -m scripts.video_brightness D:acquired_data/session --downsample 4 --plot
+"""
+import argparse
+import glob
+from multiprocessing import Pool
+import os
+from os import path
+
 import cv2
-import matplotlib.pyplot as plt
 import numpy as np
 
 
-vid_path = 'video.avi'
-reader = cv2.VideoCapture(vid_path)
-
-means = list()
-frame_count = 0
-while reader.isOpened():
-    ret, frame = reader.read()
-    
-    if not ret:
-        break
-    hsv_image = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-    mean_value = np.mean(hsv_image, axis=(0, 1))[2]
-    means.append(mean_value)
-    frame_count += 1
-    if frame_count % 30 * 5 == 0:
-        print('Progress: {}s'.format(frame_count // 30))
-
-plt.scatter(np.arange(len(means))/30, means, s=1, c='b', label='Average brightness of pixels across entire frame')
-plt.xlabel('Time (sec)')
-plt.ylabel('Value (in HSV)')
-plt.title('Fluctuations of Average Frame Brightness under Red Light')
-plt.legend()
-plt.savefig('fluctuation_graph.png')
-plt.show()
\ No newline at end of file
+CHUNK_FRAMES = 1800
+COLUMNS = ('value', 'blue', 'green', 'red')
+VIDEO_EXTENSIONS = ('avi', 'mkv', 'mp4')
+
+
+def output_path(video_path):
+    return '{}_brightness.npy'.format(path.splitext(video_path)[0])
+
+
+def frame_brightness(frame, downsample=1):
+    """Mean of the HSV value channel and of each color channel of a BGR frame"""
+    if downsample > 1:
+        frame = frame[::downsample, ::downsample]
+    value = np.maximum(np.maximum(frame[..., 0], frame[..., 1]), frame[..., 2])
+    blue, green, red, _ = cv2.mean(frame)
+    return cv2.mean(value)[0], blue, green, red
+
+
+def process_range(args):
+    """Computes the brightness of frames [start, stop) of a video into its output file.
+    Returns the video, start and number of frames read, which is less than asked for if the
+    video turns out to be shorter than its header said
+    """
+    video_path, start, stop, downsample = args
+    results = np.lib.format.open_memmap(output_path(video_path), mode='r+')
+    reader = cv2.VideoCapture(video_path)
+    if start:
+        reader.set(cv2.CAP_PROP_POS_FRAMES, start)
+    num_read = 0
+    while start + num_read < stop:
+        ret, frame = reader.read()
+        if not ret:
+            break
+        results[start + num_read] = frame_brightness(frame, downsample)
+        num_read += 1
+    reader.release()
+    results.flush()
+    del results
+    return video_path, start, num_read
+
+
+def find_videos(targets):
+    videos = list()
+    for target in targets:
+        if path.isdir(target):
+            for extension in VIDEO_EXTENSIONS:
+                videos += sorted(glob.glob(path.join(target, '*.{}'.format(extension))))
+        else:
+            videos.append(target)
+    return videos
+
+
+def analyze(videos, downsample=1, chunk_frames=CHUNK_FRAMES, processes=None):
+    """Computes the brightness of every frame of every video in a process pool.
+    Returns a dict of video path to (brightness array, framerate)
+    """
+    jobs = list()
+    lengths = dict()
+    framerates = dict()
+    for video_path in videos:
+        reader = cv2.VideoCapture(video_path)
+        num_frames = int(reader.get(cv2.CAP_PROP_FRAME_COUNT))
+        framerates[video_path] = reader.get(cv2.CAP_PROP_FPS)
+        reader.release()
+        if num_frames <= 0:
+            print('Could not read the length of {}, skipping it'.format(video_path))
+            continue
+        lengths[video_path] = num_frames
+        results = np.lib.format.open_memmap(output_path(video_path), mode='w+', dtype=np.float32, shape=(num_frames, len(COLUMNS)))
+        results[:] = np.nan
+        del results
+        jobs += [(video_path, start, min(start + chunk_frames, num_frames), downsample) for start in range(0, num_frames, chunk_frames)]
+
+    total = sum(lengths.values())
+    done = 0
+    # The last frame read of each video, in case a header overstates its length
+    frames_read = dict.fromkeys(lengths, 0)
+    with Pool(processes) as pool:
+        for video_path, start, num_read in pool.imap_unordered(process_range, jobs):
+            done += num_read
+            if num_read:
+                frames_read[video_path] = max(frames_read[video_path], start + num_read)
+            print('Progress: {}/{} frames'.format(done, total))
+
+    brightness = dict()
+    for video_path, num_frames in lengths.items():
+        results = np.load(output_path(video_path))
+        if frames_read[video_path] < num_frames:
+            results = results[:frames_read[video_path]]
+            np.save(output_path(video_path), results)
+        brightness[video_path] = (results, framerates[video_path])
+    return brightness
+
+
+def save_plot(video_path, brightness, framerate):
+    # Imported here so the analysis runs without matplotlib, and never opens a window
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
+    figure, ax = plt.subplots(figsize=(10, 4))
+    times = np.arange(len(brightness)) / (framerate or 1)
+    ax.scatter(times, brightness[:, 0], s=1, c='k', label='Value')
+    ax.scatter(times, brightness[:, 3], s=1, c='r', label='Red')
+    ax.set_xlabel('Time (sec)' if framerate else 'Frame')
+    ax.set_ylabel('Mean over the frame (0-255)')
+    ax.set_title('Average frame brightness of {}'.format(path.basename(video_path)))
+    ax.legend()
+    figure.tight_layout()
+    plot_path = '{}_brightness.png'.format(path.splitext(video_path)[0])
+    figure.savefig(plot_path, dpi=100)
+    plt.close(figure)
+    return plot_path
+
+
+def command_line_demo():
+    parser = argparse.ArgumentParser(description='Computes the average brightness of every frame of camera videos')
+    parser.add_argument('targets', type=str, nargs='+', help='Videos, or directories to process every video of')
+    parser.add_argument('--downsample', type=int, default=1, help='Only use every nth pixel in both directions')
+    parser.add_argument('--chunk-frames', type=int, default=CHUNK_FRAMES, help='Frames given to a worker at a time')
+    parser.add_argument('--processes', type=int, default=None, help='Worker processes. Defaults to one per core')
+    parser.add_argument('--plot', action='store_true', help='Save a plot next to each video')
+    args = parser.parse_args()
+
+    brightness = analyze(find_videos(args.targets), args.downsample, args.chunk_frames, args.processes)
+    for video_path, (results, framerate) in brightness.items():
+        print('{}: {} frames, mean value {:.1f} (min {:.1f}, max {:.1f}), saved to {}'.format(
+            video_path, len(results), np.nanmean(results[:, 0]), np.nanmin(results[:, 0]), np.nanmax(results[:, 0]), output_path(video_path)))
+        if args.plot:
+            save_plot(video_path, results, framerate)
+
+
+if __name__ == '__main__':
+    command_line_demo()
@@ -0,0 +1,224 @@
+"""Encodes camera frames on a worker thread so a slow encoder can't stall frame capture.
+
+The acquisition thread hands frames to AsyncVideoWriter.write(), which only queues them.
+At most queue_size frames wait for the encoder at any time. When the queue is full the
+drop policy decides what happens to a new frame: 'drop' discards it (and records its frame
+ID), 'block' makes the acquisition thread wait, leaving the camera to buffer (or drop) frames.
+
+Each epoch's queue depth, encode time and dropped frames are written to a JSON file when
+the epoch's video is closed, so an encoder bottleneck shows up separately from camera drops.
+
+Videos are encoded either by cv2.VideoWriter or by an ffmpeg process fed raw frames over a
+pipe (see create_encoder). ffmpeg runs on its own cores, so the writer thread only spends
+its time copying frames into the pipe.
+"""
+import json
+import queue
+import shutil
+import subprocess
+import threading
+import time
+
+import cv2
+import numpy as np
+
+from scripts.config import constants as config
+
+
+QUEUE_SIZE = config['camera_writer_queue_size']
+DROP_POLICY = config['camera_writer_drop_policy']
+ENCODER = config['camera_encoder']
+
+
+class FFmpegWriter:
+    """Streams BGR frames to an ffmpeg process over its stdin. Has the write()/release()
+    interface of cv2.VideoWriter.
+
+    Parameters:
+        codec: any ffmpeg video encoder, e.g. 'libx264' or 'ffv1' for lossless video
+        preset: encoder speed/size tradeoff, e.g. 'ultrafast'. None for codecs without presets
+        crf: constant rate factor (lower is better quality). None for the codec's default or lossless codecs
+        pixel_format: pixel format of the encoded video, e.g. 'yuv420p', or 'gray' to drop the color
+    """
+    def __init__(self, filepath, framerate, dimensions, codec=config['camera_ffmpeg_codec'], preset=config['camera_ffmpeg_preset'],
+            crf=config['camera_ffmpeg_crf'], pixel_format=config['camera_ffmpeg_pixel_format'], ffmpeg_path=config['camera_ffmpeg_path']):
+        self.filepath = filepath
+        command = [
+            ffmpeg_path, '-hide_banner', '-loglevel', 'error', '-y',
+            '-f', 'rawvideo',
+            '-pix_fmt', 'bgr24',
+            '-s', '{}x{}'.format(*dimensions),
+            '-framerate', str(framerate),
+            '-i', 'pipe:0',
+            '-c:v', codec]
+        if preset is not None:
+            command += ['-preset', preset]
+        if crf is not None:
+            command += ['-crf', str(crf)]
+        command += ['-pix_fmt', pixel_format, filepath]
+        # ffmpeg's errors go straight to the console
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+
+    def write(self, frame):
+        # Hands the frame's memory to the pipe without copying it into a bytes object
+        self.process.stdin.write(np.ascontiguousarray(frame).data)
+
+    def release(self):
+        if self.process.stdin.closed:
+            return
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            print('ffmpeg exited with code {} while writing {}'.format(self.process.returncode, self.filepath))
+
+
+def create_encoder(filepath_stem, framerate, dimensions, backend=None):
+    """Opens a video for writing, with the extension appropriate to the encoder.
+    Parameters:
+        backend: 'ffmpeg' or 'opencv'. Defaults to config['camera_encoder']. Falls back to
+            opencv if the ffmpeg executable can't be found
+    Returns the writer and the path of the video
+    """
+    if backend is None:
+        backend = ENCODER
+    if backend == 'ffmpeg':
+        if shutil.which(config['camera_ffmpeg_path']) is not None:
+            filepath = '{}.{}'.format(filepath_stem, config['camera_ffmpeg_container'])
+            return FFmpegWriter(filepath, framerate, dimensions), filepath
+        print('Could not find {}, writing video with OpenCV instead'.format(config['camera_ffmpeg_path']))
+    elif backend != 'opencv':
+        raise ValueError('Unknown video encoder: {}'.format(backend))
+    filepath = '{}.avi'.format(filepath_stem)
+    return cv2.VideoWriter(filepath, cv2.VideoWriter_fourcc(*'DIVX'), framerate, dimensions, isColor=True), filepath
+
+
+class EpochStats:
+    """Counters for the frames of one video file. The acquisition thread updates the queue
+    and drop counters, the encoder thread the encode times
+    """
+    def __init__(self, video_writer, stats_path):
+        self.video_writer = video_writer
+        self.stats_path = stats_path
+        self.frames_queued = 0
+        self.frames_written = 0
+        self.dropped_frame_ids = list()
+        self.max_queue_depth = 0
+        self.queue_depth_total = 0
+        self.encode_times = list()
+        self.latencies = list()
+
+    def summary(self):
+        encode_ms = np.array(self.encode_times) * 1000
+        latency_ms = np.array(self.latencies) * 1000
+        return {
+            'frames_written': self.frames_written,
+            'frames_dropped': len(self.dropped_frame_ids),
+            'dropped_frame_ids': self.dropped_frame_ids,
+            'max_queue_depth': self.max_queue_depth,
+            'mean_queue_depth': self.queue_depth_total / max(1, self.frames_queued),
+            'encode_ms_mean': float(encode_ms.mean()) if len(encode_ms) else 0.0,
+            'encode_ms_p99': float(np.percentile(encode_ms, 99)) if len(encode_ms) else 0.0,
+            'encode_ms_max': float(encode_ms.max()) if len(encode_ms) else 0.0,
+            # Time from write() to the frame being encoded, including the wait in the queue
+            'latency_ms_mean': float(latency_ms.mean()) if len(latency_ms) else 0.0,
+            'latency_ms_max': float(latency_ms.max()) if len(latency_ms) else 0.0,
+        }
+
+
+class AsyncVideoWriter:
+    """Parameters:
+        release_frame: called with every frame once it has been encoded or dropped, e.g. to
+            return it to a video_acquisition.FramePool
+        queue_size: number of frames allowed to wait for the encoder
+        drop_policy: 'drop' or 'block', see the module docstring
+    """
+    def __init__(self, release_frame=None, queue_size=QUEUE_SIZE, drop_policy=DROP_POLICY):
+        if drop_policy not in ('drop', 'block'):
+            raise ValueError('Unknown video writer drop policy: {}'.format(drop_policy))
+        self.release_frame = release_frame
+        self.queue_size = queue_size
+        self.drop_policy = drop_policy
+
+        # Frames are limited by the semaphore rather than the queue, so closing an epoch is never dropped or blocked
+        self.slots = threading.BoundedSemaphore(queue_size)
+        self.pending = queue.Queue()
+        self.epoch = None
+        self.total_dropped = 0
+        self.error = None
+
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def start_epoch(self, video_writer, stats_path=None):
+        """Sends every following frame to video_writer. stats_path is where the epoch's stats
+        are saved when it ends, or None to skip saving them
+        """
+        self.epoch = EpochStats(video_writer, stats_path)
+
+    def write(self, frame, frame_id=None):
+        epoch = self.epoch
+        if epoch is None:
+            self._release(frame)
+            return
+        if not self.slots.acquire(blocking=self.drop_policy == 'block'):
+            epoch.dropped_frame_ids.append(frame_id)
+            self.total_dropped += 1
+            self._release(frame)
+            return
+        depth = self.pending.qsize() + 1
+        epoch.frames_queued += 1
+        epoch.queue_depth_total += depth
+        epoch.max_queue_depth = max(epoch.max_queue_depth, depth)
+        self.pending.put((epoch, frame, time.perf_counter()))
+
+    def end_epoch(self):
+        """Closes the current video once its queued frames are encoded, without waiting for it"""
+        if self.epoch is not None:
+            self.pending.put((self.epoch, None, None))
+            self.epoch = None
+
+    def run(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            epoch, frame, queued_time = item
+            if frame is None:
+                self.finish_epoch(epoch)
+                continue
+            try:
+                encode_start = time.perf_counter()
+                epoch.video_writer.write(frame)
+                encode_end = time.perf_counter()
+                epoch.encode_times.append(encode_end - encode_start)
+                epoch.latencies.append(encode_end - queued_time)
+                epoch.frames_written += 1
+            except Exception as e:
+                print('Video writer error: {}'.format(e))
+                self.error = e
+            self._release(frame)
+            self.slots.release()
+
+    def finish_epoch(self, epoch):
+        try:
+            epoch.video_writer.release()
+        except Exception as e:
+            print(e)
+        summary = epoch.summary()
+        if summary['frames_dropped']:
+            print('Video writer dropped {} frames, max queue depth {}'.format(summary['frames_dropped'], summary['max_queue_depth']))
+        if epoch.stats_path is not None:
+            try:
+                with open(epoch.stats_path, 'w') as ctx:
+                    json.dump(summary, ctx, indent=2)
+            except Exception as e:
+                print(e)
+
+    def close(self):
+        """Ends the current epoch, waits for everything queued to be encoded and stops the thread"""
+        self.end_epoch()
+        self.pending.put(None)
+        self.thread.join()
+
+    def _release(self, frame):
+        if self.release_frame is not None:
+            self.release_frame(frame)